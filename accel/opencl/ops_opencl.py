@@ -118,15 +118,17 @@ class OpenCLBuffer(GPUBuffer):
     return self._image
 
   SUPPORTS_PADDING = True
+  processing_ops = (ProcessingOps.CONV, ProcessingOps.MATMUL)
   def processing_op(x, op:ProcessingOps, w:GPUBuffer, C:ConvArgs):
+    if op == ProcessingOps.MATMUL: return super().processing_op(op, w, C)
     assert op == ProcessingOps.CONV, f"{op} isn't supported"
     return type(x)(C.out_shape)._processing_op([("input", x.contiguous_op()), ("weight", w.contiguous_op())], "acc", C)
 
   seen = set()
-  def _processing_op(ret, bufs: List[Tuple[str, OpenCLBuffer]]=[], code:str="acc", C=None, start="0.0", reduce_shape=None, earlybufs:Set[str]=set(), earlycode:str="acc"):
-    if C is None or earlycode != "acc":
+  def _processing_op(ret, bufs: List[Tuple[str, OpenCLBuffer]]=[], code:str="acc", C=None, start="0.0", reduce_shape=None, earlybufs:Set[str]=set(), earlycode:str="acc", siblings=[]):
+    if not isinstance(C, ConvArgs) or earlycode != "acc":
       # TODO: handle an opencl conv without the conv part
-      return super()._processing_op(bufs, code, C, start, reduce_shape, earlybufs, earlycode)
+      return super()._processing_op(bufs, code, C, start, reduce_shape, earlybufs, earlycode, siblings)
     assert earlycode == "acc"
     assert start == "0.0"
 
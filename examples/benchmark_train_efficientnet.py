@@ -6,6 +6,7 @@ from extra.utils import get_parameters
 from models.efficientnet import EfficientNet
 import tinygrad.optim as optim
 from tinygrad.tensor import Tensor
+from tinygrad.ops import create_schedule, plan_memory
 from tinygrad.llops.ops_gpu import CL
 
 import gc
@@ -18,6 +19,7 @@ CNT = int(os.getenv("CNT", 10))
 BACKWARD = int(os.getenv("BACKWARD", 0))
 TRAINING = int(os.getenv("TRAINING", 1))
 ADAM = int(os.getenv("ADAM", 0))
+MEMPLAN = int(os.getenv("MEMPLAN", 0))
 
 if __name__ == "__main__":
   print(f"NUM:{NUM} BS:{BS} CNT:{CNT}")
@@ -40,17 +42,22 @@ if __name__ == "__main__":
     if BACKWARD:
       optimizer.zero_grad()
       loss.backward()
+    if MEMPLAN:
+      outs = tuple(x.lazydata for x in [loss]+[p.grad for p in parameters if p.grad is not None])
+      plan = plan_memory(create_schedule(*outs), outs)
+      print(f"memory plan (report only): {plan.planned_bytes/1e9:.2f} GB in {len(plan.arenas)} arenas, {plan.naive_bytes/1e9:.2f} GB naive, {plan.live_bytes/1e9:.2f} GB live")
+    if BACKWARD:
       optimizer.step()
     mt = time.monotonic()
     loss.realize()
     for p in parameters:
       p.realize()
     et = time.monotonic()
-    mem_used = CL.mem_used
+    mem_used, mem_high = CL.mem_used, CL.mem_high
     loss = loss.detach().cpu().data[0]
     cl = time.monotonic()
 
-    print(f"{(st-cpy)*1000.0:7.2f} ms cpy,  {(cl-st)*1000.0:7.2f} ms run, {(mt-st)*1000.0:7.2f} ms build, {(et-mt)*1000.0:7.2f} ms realize, {(cl-et)*1000.0:7.2f} ms CL, {loss:7.2f} loss, {tensors_allocated():4d} tensors, {mem_used/1e9:.2f} GB used")
+    print(f"{(st-cpy)*1000.0:7.2f} ms cpy,  {(cl-st)*1000.0:7.2f} ms run, {(mt-st)*1000.0:7.2f} ms build, {(et-mt)*1000.0:7.2f} ms realize, {(cl-et)*1000.0:7.2f} ms CL, {loss:7.2f} loss, {tensors_allocated():4d} tensors, {mem_used/1e9:.2f} GB used, {mem_high/1e9:.2f} GB peak")
 
 
 
@@ -19,7 +19,7 @@ import numpy as np
 
 import tinygrad.ops as ops
 
-from tinygrad.llops.ops_gpu import CL, CLProgram, CLBuffer
+from tinygrad.llops.ops_gpu import CL, CLProgram, CLBuffer, CLTuner
 from extra.utils import fetch
 from extra.onnx import get_run_onnx
 from test.test_onnx import run_onnx_torch
@@ -74,60 +74,10 @@ def compile(input, output_fn):
   ops.GRAPH = False
   print("kernel count:", len(CL.CACHE))
 
-  # optimize local workgroups
+  # optimize local workgroups, OPTWG=2 only uses local sizes that divide the global size
   OPTWG = int(os.getenv("OPTWG", 0))
   if OPTWG:
-    MAX_WORKGROUP = CL.cl_ctx.devices[0].max_work_group_size
-    local_cl_cache = []
-    for i, (prg, args) in enumerate(CL.CACHE):
-      args = list(args)
-      if args[1] is None and len(args[0]) == 2:
-        args[1] = [min(MAX_WORKGROUP, args[0][0]), 1]
-        try:
-          e = prg.clprg(CL().cl_queue, *args)
-        except cl.LogicError:
-          # INVALID_WORK_GROUP_SIZE
-          args[1] = None
-          continue
-        if OPTWG == 2 and args[0][0] % args[1][0] != 0:
-          args[1] = None
-
-      if args[1] is None and len(args[0]) == 3:
-        """
-        if args[0][1] == 1 and args[0][2] == 1:
-          args[1] = [min(1024, args[0][0]), 1, 1]
-        else:
-          args[1] = [1,min(16,args[0][1]),min(args[0][2], 4)]
-          args[1][0] = min(32, min(args[0][0], 1024 // (args[1][1] * args[1][2])))
-        """
-        runtimes = []
-        for l2 in [16,args[0][1],MAX_WORKGROUP]:
-          for l3 in [4,16,args[0][2],MAX_WORKGROUP]:
-            for l1 in [max(1, MAX_WORKGROUP//(l2*l3)), args[0][0], 4, 16, MAX_WORKGROUP]:
-              if l1 > args[0][0] or l2 > args[0][1] or l3 > args[0][2]: continue
-              local_args = (l1, l2, l3)
-              if prod(local_args) > MAX_WORKGROUP: continue
-              args[1] = local_args
-              if OPTWG == 2:
-                bad = any(g%l != 0 for g,l in zip(args[0], args[1]))
-                if bad: continue
-              try:
-                e = prg.clprg(CL().cl_queue, *args)
-              except cl.LogicError:
-                # INVALID_WORK_GROUP_SIZE
-                continue
-              CL().cl_queue.finish()
-              runtime = e.profile.end - e.profile.start
-              #print(runtime, args[0], args[1])
-              runtimes.append((runtime, local_args))
-        #print(sorted(runtimes)[0:5])
-        if len(runtimes) > 0:
-          args[1] = sorted(runtimes)[0][1]
-        else:
-          args[1] = None
-          print("couldn't optimize", args[0])
-
-      local_cl_cache.append((prg, args))
+    local_cl_cache = [(prg, [args[0], CLTuner.local_size(prg, args[0], *args[2:], exact=OPTWG == 2) if args[1] is None else args[1], *args[2:]]) for prg, args in CL.CACHE]
   else:
     local_cl_cache = CL.CACHE[:]
   CL.CACHE = None
@@ -0,0 +1,7 @@
+import numpy as np
+from tinygrad.tensor import Tensor
+from tinygrad.ops import Device
+
+# fxn on the inputs on device matches fxn on the CPU
+def helper_test_device(device, fxn, *xs, atol=1e-3, rtol=1e-4):
+  np.testing.assert_allclose(fxn(*[Tensor(x, device=device) for x in xs]).numpy(), fxn(*[Tensor(x, device=Device.CPU) for x in xs]).numpy(), atol=atol, rtol=rtol)
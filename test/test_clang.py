@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import os
+import ctypes
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from tinygrad.ops import Device, Passes
+import tinygrad.llops.ops_clang as ops_clang
+from tinygrad.llops.ops_clang import ClangProgram, ClangBuffer
+from test.helpers import helper_test_device
+
+PRG = "void add1(float* restrict output, const float *a_g) { for (int gid = 0; gid < 4; gid++) output[gid] = a_g[gid] + 1.0f; }"
+
+def run_add1(prg):
+  a, out = np.arange(4, dtype=np.float32), np.empty(4, dtype=np.float32)
+  prg([4, 1, 1], None, out, a)
+  return out
+
+@unittest.skipIf(shutil.which(ops_clang.CC) is None, "needs a C compiler")
+class TestClangProgram(unittest.TestCase):
+  def setUp(self):
+    self.cachedir, self.old_cachedir = tempfile.TemporaryDirectory(), ops_clang.CLANGCACHEDIR
+    ops_clang.CLANGCACHEDIR = self.cachedir.name
+  def tearDown(self):
+    ops_clang.CLANGCACHEDIR = self.old_cachedir
+    self.cachedir.cleanup()
+
+  def test_identical_kernels_share_program(self):
+    p1 = ClangProgram("add1", PRG)
+    p2 = ClangProgram("add1", "\n" + PRG + "   \n\n")
+    assert p1 is p2 and p1.name.startswith("add1_")
+    np.testing.assert_allclose(run_add1(p1), [1,2,3,4])
+
+  def test_disk_cache(self):
+    stats = ClangProgram.cache_stats()
+    ClangProgram.build(PRG)
+    ClangProgram.build(PRG)
+    assert len(os.listdir(self.cachedir.name)) == 1
+    assert ClangProgram.cache_stats()["disk_hits"] == stats["disk_hits"] + 1
+
+  def test_no_cache_dir(self):
+    ops_clang.CLANGCACHEDIR = ""
+    assert os.path.dirname(ClangProgram.libpath(PRG)) == os.path.dirname(ClangProgram.libpath(PRG + "\n// other")) == ClangProgram.tmpdir().name
+    ClangProgram.build(PRG + "\n// no cache")
+    assert len(os.listdir(self.cachedir.name)) == 0 and len(os.listdir(ClangProgram.tmpdir().name)) >= 1
+
+  def test_corrupt_library(self):
+    # NOTE: a library that's already loaded can't be overwritten, so this is a fresh source
+    prg = PRG + "\n// corrupt"
+    with open(ClangProgram.libpath(prg), "wb") as f: f.write(b"garbage")
+    lib = ClangProgram.build(prg)
+    a, out = np.arange(4, dtype=np.float32), np.empty(4, dtype=np.float32)
+    lib.add1(ctypes.c_void_p(out.ctypes.data), ctypes.c_void_p(a.ctypes.data))
+    np.testing.assert_allclose(out, [1,2,3,4])
+
+  def test_no_openmp(self):
+    # a compiler without OpenMP, like Apple's clang, builds the kernels for one thread
+    cc = os.path.join(self.cachedir.name, "cc")
+    with open(cc, "w") as f: f.write(f'#!/bin/sh\nfor a; do [ "$a" = "-fopenmp" ] && exit 1; done\nexec {shutil.which(ops_clang.CC)} "$@"\n')
+    os.chmod(cc, 0o755)
+    try:
+      with mock.patch.object(ops_clang, "CC", cc):
+        ClangProgram.flags.cache_clear()
+        assert "-fopenmp" not in ClangProgram.flags()
+        prg = PRG.replace("{ for", "{\n#pragma omp parallel for\nfor")
+        np.testing.assert_allclose(run_add1(ClangProgram("add1", prg)), [1,2,3,4])
+    finally: ClangProgram.flags.cache_clear()
+
+@unittest.skipIf(shutil.which(ops_clang.CC) is None or "CLANG" not in Device._buffers, "needs a C compiler")
+class TestClangBuffer(unittest.TestCase):
+  def test_fused_kernel(self):
+    with Passes.enable(merge_elementwise_ops=True):
+      helper_test_device(Device.CLANG, lambda x: (x.swish() * 2.0).sum(axis=1), np.random.randn(64, 1000).astype(np.float32), atol=1e-4)
+
+  def test_movement_ops(self):
+    helper_test_device(Device.CLANG, lambda x: x.permute(order=(2,0,1))[1:7, :, 2:5], np.random.randn(4, 6, 8).astype(np.float32), atol=0, rtol=0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,11 @@
 import unittest
 import numpy as np
+import torch
 from tinygrad.tensor import Tensor
+from tinygrad.helpers import get_conv_args
+import tinygrad.ops as ops
+from tinygrad.ops import ProcessingOps
+from tinygrad.llops.ops_cpu import CPUBuffer
 
 class TestConv(unittest.TestCase):
   def test_simple(self):
@@ -121,5 +126,54 @@ class TestConv(unittest.TestCase):
     x = x.reshape((1, 12, 128, 256))
     x.numpy()
 
+class TestTiledConvCPU(unittest.TestCase):
+  def setUp(self): self.tile, self.threads = CPUBuffer.CONV_TILE, CPUBuffer.THREADS
+  def tearDown(self): CPUBuffer.CONV_TILE, CPUBuffer.THREADS = self.tile, self.threads
+
+  def helper(self, bs, cin, cout, hw, k, groups=1, **kwargs):
+    x, w = np.random.randn(bs, cin, hw, hw).astype(np.float32), np.random.randn(cout, cin//groups, k, k).astype(np.float32)
+    C = get_conv_args(x.shape, w.shape, groups=groups, **kwargs)
+    xp = np.pad(x, ((0,0), (0,0), (C.py,C.py_), (C.px,C.px_)))
+    out = CPUBuffer.processing_op(CPUBuffer.fromCPU(xp), ProcessingOps.CONV, CPUBuffer.fromCPU(w), C)
+    ref = torch.nn.functional.conv2d(torch.tensor(x), torch.tensor(w), groups=groups, **kwargs).numpy()
+    np.testing.assert_allclose(out, ref, atol=1e-4, rtol=1e-4)
+
+  def test_tiles(self):
+    # a few output rows per tile, on a thread pool
+    CPUBuffer.CONV_TILE, CPUBuffer.THREADS = 1000, 4
+    self.helper(3, 8, 6, 17, 3, padding=1)
+    self.helper(2, 4, 6, 15, 3, stride=2, dilation=2)
+  def test_1x1(self): self.helper(2, 16, 8, 9, 1)
+  def test_1x1_strided(self): self.helper(2, 16, 8, 9, 1, stride=2)
+  def test_grouped(self): self.helper(2, 8, 12, 9, 3, groups=4, padding=1)
+  def test_depthwise(self): self.helper(2, 6, 12, 11, 5, groups=6, padding=2, stride=2)
+
+class TestWinograd(unittest.TestCase):
+  def setUp(self): self.flags = ops.NOCONV, ops.WINOGRAD, CPUBuffer.WINOGRAD
+  def tearDown(self): ops.NOCONV, ops.WINOGRAD, CPUBuffer.WINOGRAD = self.flags
+
+  def helper(self, bs, cin, cout, hw, groups=1, padding=1):
+    x, w = np.random.randn(bs, cin, *hw).astype(np.float32), np.random.randn(cout, cin//groups, 3, 3).astype(np.float32)
+    ops.WINOGRAD, CPUBuffer.WINOGRAD = 0, 0
+    direct = Tensor(x).conv2d(Tensor(w), groups=groups, padding=padding).numpy()
+    # on the CPU llop, and in mul and reduce like the compiled backends
+    for noconv in [0, 1]:
+      ops.NOCONV, ops.WINOGRAD, CPUBuffer.WINOGRAD = noconv, 1, 1
+      np.testing.assert_allclose(Tensor(x).conv2d(Tensor(w), groups=groups, padding=padding).numpy(), direct, atol=1e-4, rtol=1e-4)
+
+  def test_even(self): self.helper(2, 4, 6, (8, 8))
+  def test_odd(self): self.helper(3, 5, 2, (9, 7), padding=0)
+  def test_asymmetric_padding(self): self.helper(1, 3, 4, (6, 11), padding=(1,0,2,1))
+  def test_grouped(self): self.helper(2, 8, 6, (7, 7), groups=2)
+
+  def test_backward(self):
+    x, w = np.random.randn(2, 4, 7, 7).astype(np.float32), np.random.randn(6, 4, 3, 3).astype(np.float32)
+    tx, tw = torch.tensor(x, requires_grad=True), torch.tensor(w, requires_grad=True)
+    torch.nn.functional.conv2d(tx, tw, padding=1).relu().sum().backward()
+    ax, aw = Tensor(x), Tensor(w)
+    ax.conv2d(aw, padding=1).relu().sum().backward()
+    np.testing.assert_allclose(ax.grad.numpy(), tx.grad.numpy(), atol=1e-4, rtol=1e-4)
+    np.testing.assert_allclose(aw.grad.numpy(), tw.grad.numpy(), atol=1e-4, rtol=1e-4)
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+import os
+import sys
+import gc
+import json
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import tinygrad.ops as ops
+from tinygrad.ops import Device, Passes
+from tinygrad.tensor import Tensor
+from test.helpers import helper_test_device
+
+try:
+  import tinygrad.llops.ops_gpu as ops_gpu
+  from tinygrad.llops.ops_gpu import CL, CLProgram, CLBuffer, CLTuner, GPUBuffer
+except ImportError:
+  ops_gpu = None
+
+PRG = "__kernel void add1(__global float* restrict output, __global const float *a_g) { int gid = get_global_id(0); output[gid] = a_g[gid] + 1.0f; }"
+
+def run_add1(fxn):
+  a, out = CLBuffer(4*4), CLBuffer(4*4)
+  CL.enqueue_copy(a.cl, np.arange(4, dtype=np.float32), is_blocking=True)
+  fxn([4, 1, 1], None, out.cl, a.cl)
+  ret = np.empty(4, dtype=np.float32)
+  CL.enqueue_copy(ret, out.cl, is_blocking=True)
+  return ret
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestCLCache(unittest.TestCase):
+  def setUp(self):
+    self.cachedir, self.old_cachedir = tempfile.TemporaryDirectory(), ops_gpu.CLCACHEDIR
+    ops_gpu.CLCACHEDIR = self.cachedir.name
+  def tearDown(self):
+    ops_gpu.CLCACHEDIR = self.old_cachedir
+    self.cachedir.cleanup()
+
+  def test_binary_roundtrip(self):
+    np.testing.assert_allclose(run_add1(lambda *args: CLProgram.build(PRG).add1(CL().cl_queue, *args)), [1,2,3,4])
+    assert len(os.listdir(self.cachedir.name)) == 1
+    np.testing.assert_allclose(run_add1(lambda *args: CLProgram.build(PRG).add1(CL().cl_queue, *args)), [1,2,3,4])
+    assert len(os.listdir(self.cachedir.name)) == 1
+
+  def test_options_in_key(self):
+    CLProgram.build(PRG)
+    CLProgram.build(PRG, ("-cl-fast-relaxed-math",))
+    assert len(os.listdir(self.cachedir.name)) == 2
+
+  def test_corrupt_binary(self):
+    CLProgram.build(PRG)
+    for fn in os.listdir(self.cachedir.name):
+      with open(os.path.join(self.cachedir.name, fn), "wb") as f: f.write(b"garbage")
+    np.testing.assert_allclose(run_add1(lambda *args: CLProgram.build(PRG).add1(CL().cl_queue, *args)), [1,2,3,4])
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestCLProgramDedup(unittest.TestCase):
+  def test_identical_kernels_share_program(self):
+    stats = CLProgram.cache_stats()
+    p1 = CLProgram("add1", PRG)
+    p2 = CLProgram("add1", "\n" + PRG + "   \n\n")
+    assert p1 is p2 and p1.name.startswith("add1_")
+    assert CLProgram.cache_stats()["hits"] == stats["hits"] + 1
+
+  def test_name_is_content_hash(self):
+    p1 = CLProgram("add1", PRG)
+    p2 = CLProgram("add1", PRG.replace("1.0f", "2.0f"))
+    assert p1.name != p2.name and p1.name == CLProgram("add1", PRG).name
+    np.testing.assert_allclose(run_add1(p2), [2,3,4,5])
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestCLBufferPool(unittest.TestCase):
+  def setUp(self):
+    self.old_limit = ops_gpu.CLCACHELIMIT
+    CL.flush_buffer_cache()
+  def tearDown(self):
+    ops_gpu.CLCACHELIMIT = self.old_limit
+    CL.flush_buffer_cache()
+
+  def test_reuse(self):
+    used = CL.mem_used
+    a = CLBuffer(1024)
+    buf = a.cl
+    assert CL.mem_used == used + 1024 and CL.mem_high >= CL.mem_used
+    del a
+    assert CL.mem_used == used + 1024 and CL.mem_cached == 1024
+    b = CLBuffer(1024)
+    assert b.cl is buf and CL.mem_used == used + 1024 and CL.mem_cached == 0
+    del b
+    CL.flush_buffer_cache()
+    assert CL.mem_used == used
+
+  def test_limit_evicts_lru(self):
+    ops_gpu.CLCACHELIMIT = 4096
+    a, b, c = CLBuffer(2048), CLBuffer(1024), CLBuffer(2048)
+    oldest = a.cl
+    del a, b, c
+    assert CL.mem_cached <= 4096 and oldest not in CL.BUFFER_CACHE[2048]
+    assert len(CL.BUFFER_CACHE[1024]) == 1 and len(CL.BUFFER_CACHE[2048]) == 1
+
+  def test_oom_flushes_and_retries(self):
+    a = CLBuffer(1024)
+    del a
+    real = ops_gpu.cl.Buffer(CL().cl_ctx, ops_gpu.cl.mem_flags.READ_WRITE, 2048)
+    with mock.patch.object(ops_gpu.cl, "Buffer", side_effect=[ops_gpu.cl.MemoryError("out of memory"), real]):
+      b = CLBuffer(2048)
+    assert b.cl is real and CL.mem_cached == 0
+
+  def test_failed_alloc_del(self):
+    with mock.patch.object(ops_gpu.cl, "Buffer", side_effect=ops_gpu.cl.MemoryError("out of memory")), mock.patch.object(sys, "unraisablehook") as hook:
+      with self.assertRaises(ops_gpu.cl.MemoryError): CLBuffer(2048)
+      gc.collect()
+    # __del__ of the half built CLBuffer doesn't raise or touch the pool
+    assert not hook.called and len(CL.BUFFER_CACHE[2048]) == 0 and CL.mem_cached == 0
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestLocalReduce(unittest.TestCase):
+  def setUp(self): self.old, GPUBuffer.LOCAL_REDUCE = GPUBuffer.LOCAL_REDUCE, True
+  def tearDown(self): GPUBuffer.LOCAL_REDUCE = self.old
+
+  def helper(self, x, fxn, *args): helper_test_device(Device.GPU, fxn, x, *args)
+
+  def test_strategy(self):
+    assert GPUBuffer.reduce_strategy(1, 1<<20) == ("twostage", 256)
+    assert GPUBuffer.reduce_strategy(512, 1024) == ("workgroup", 1)
+    assert GPUBuffer.reduce_strategy(64*512, 49) == ("serial", 1)
+    assert GPUBuffer.reduce_strategy(8192, 4096) == ("serial", 1)
+
+  def test_full_sum(self): self.helper(np.random.randn(1<<20).astype(np.float32), lambda x: x.sum())
+  def test_full_max(self): self.helper(np.random.randn(300, 1000).astype(np.float32) - 10, lambda x: x.max())
+  def test_global_avgpool(self): self.helper(np.random.randn(8, 64, 32, 32).astype(np.float32), lambda x: x.mean(axis=(2,3)))
+  def test_outer_axis(self): self.helper(np.random.randn(40000, 3).astype(np.float32), lambda x: x.sum(axis=0))
+  def test_permuted(self): self.helper(np.random.randn(16, 3000).astype(np.float32), lambda x: x.transpose().max(axis=0))
+  def test_ragged(self): self.helper(np.random.randn(7, 1001).astype(np.float32), lambda x: x.sum(axis=1))
+
+  def test_siblings(self):
+    with Passes.enable(merge_sibling_reduces=True):
+      self.helper(np.random.randn(8, 5000).astype(np.float32), lambda x: x.sum(axis=1) * x.max(axis=1))
+
+  def test_fused(self):
+    with Passes.enable(merge_elementwise_into_reduce=True, merge_one_reduce_into_elementwise=True):
+      self.helper(np.random.randn(1<<18).astype(np.float32), lambda x,y: (x*x).sum() + y, np.ones((1,), dtype=np.float32))
+      self.helper(np.random.randn(64, 4096).astype(np.float32), lambda x,y: (x*2).sum(axis=1) + y, np.random.randn(64).astype(np.float32))
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestFloat4(unittest.TestCase):
+  def setUp(self): self.old, GPUBuffer.FLOAT4 = GPUBuffer.FLOAT4, True
+  def tearDown(self): GPUBuffer.FLOAT4 = self.old
+
+  def helper(self, fxn, *shapes, vectorized=True):
+    with mock.patch.object(CLTuner, "launch", wraps=CLTuner.launch) as launch:
+      helper_test_device(Device.GPU, fxn, *[np.random.randn(*shp).astype(np.float32) for shp in shapes], atol=1e-5, rtol=1e-5)
+    assert ("vstore4" in launch.call_args[0][2](False)) == vectorized
+
+  def test_contiguous(self): self.helper(lambda x,y: (x*y).relu().exp(), (64, 256), (64, 256))
+  def test_tail(self): self.helper(lambda x,y: x+y, (7, 1001), (7, 1001))
+  def test_broadcast_last_axis(self): self.helper(lambda x,y: x*y, (8, 16, 32), (8, 16, 1))
+  def test_broadcast_const(self): self.helper(lambda x: x*2+1, (45, 65))
+  def test_strided_outer(self): self.helper(lambda x,y: x.permute(order=(1,0,2))+y, (16, 8, 12), (8, 16, 12))
+  def test_sliced(self): self.helper(lambda x: x[1:5, 4:12]*2, (6, 16))
+  def test_padded_const(self): self.helper(lambda x: Tensor([2.], device=x.device).reshape((1,1,1,1)).expand((1,1,4,8)).pad2d((1,3,0,0)) + x, (1, 1, 4, 12))
+
+  def test_fallback(self):
+    self.helper(lambda x,y: x.transpose()+y, (32, 16), (16, 32), vectorized=False)
+    self.helper(lambda x: x.pad2d((1,1,1,1))*2, (2, 3, 6, 6), vectorized=False)
+    self.helper(lambda x: x[1:5, 3:9]*2, (6, 16), vectorized=False)
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestUnrollUpcast(unittest.TestCase):
+  def helper(self, fxn, *shapes, has=(), hasnt=()):
+    with mock.patch.object(CLTuner, "launch", wraps=CLTuner.launch) as launch:
+      helper_test_device(Device.GPU, fxn, *[np.random.randn(*shp).astype(np.float32) for shp in shapes], atol=1e-4)
+    prgs = [args[2](False) for args,_ in launch.call_args_list]
+    assert any(all(x in prg for x in has) for prg in prgs) and not any(x in prg for x in hasnt for prg in prgs)
+
+  def test_pool_unrolled(self): self.helper(lambda x: x.max_pool2d(), (4, 8, 16, 16), has=("idx+17",), hasnt=("for (",))
+  def test_split(self): self.helper(lambda x: x.sum(axis=1), (64, 30), has=("axis_0 < 5", "idx+5"))
+  def test_prime(self): self.helper(lambda x: x.sum(axis=1), (64, 31), has=("axis_0 < 31",))
+  def test_upcast(self): self.helper(lambda x: x.sum(axis=0), (33, 4096), has=("acc_3", "idx+3"))
+  def test_upcast_fused(self):
+    with Passes.enable(merge_one_reduce_into_elementwise=True):
+      self.helper(lambda x,y: x.max(axis=1) + y, (4096, 7), (4096,), has=("acc_3",))
+  def test_no_upcast(self):
+    self.helper(lambda x: x.sum(axis=0), (33, 4093), hasnt=("acc_1",))
+    self.helper(lambda x: x.sum(axis=0), (33, 64), hasnt=("acc_1",))
+
+  def test_conv(self):
+    with mock.patch.object(ops, "NOCONV", 1), mock.patch.object(ops, "WINOGRAD", 0):
+      self.helper(lambda x,w: x.conv2d(w, padding=1), (2, 8, 32, 32), (16, 8, 3, 3), has=("acc_3",))
+      self.helper(lambda x,w: x.conv2d(w, stride=2), (2, 8, 33, 33), (16, 8, 3, 3))
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestTiledGemm(unittest.TestCase):
+  # the convs run in the tiled kernel, not as mul and reduce
+  def setUp(self): self.old, ops.NOCONV, ops.WINOGRAD = (GPUBuffer.LOCAL_GEMM, ops.NOCONV, ops.WINOGRAD), 0, 0
+  def tearDown(self): GPUBuffer.LOCAL_GEMM, ops.NOCONV, ops.WINOGRAD = self.old
+
+  def helper(self, fxn, *shapes):
+    xs = [np.random.randn(*shp).astype(np.float32) for shp in shapes]
+    for local in [False, True]:
+      GPUBuffer.LOCAL_GEMM = local
+      helper_test_device(Device.GPU, fxn, *xs, rtol=1e-3)
+
+  def test_conv(self): self.helper(lambda x,w: x.conv2d(w, padding=1), (2, 8, 17, 19), (33, 8, 3, 3))
+  def test_conv_strided(self): self.helper(lambda x,w: x.conv2d(w, stride=(2,3), padding=(2,1)), (3, 5, 20, 21), (7, 5, 5, 3))
+  def test_conv_dilated(self): self.helper(lambda x,w: x.conv2d(w, dilation=2), (1, 4, 15, 15), (6, 4, 3, 3))
+  def test_conv_grouped(self): self.helper(lambda x,w: x.conv2d(w, groups=3, padding=1), (2, 6, 9, 9), (9, 2, 3, 3))
+  def test_conv_1x1(self): self.helper(lambda x,w: x.conv2d(w), (2, 64, 7, 7), (40, 64, 1, 1))
+  def test_matmul(self): self.helper(lambda x,y: x @ y, (3, 45, 65), (3, 65, 30))
+
+  def test_winograd(self):
+    with mock.patch.object(ops, "WINOGRAD", 1), mock.patch.object(GPUBuffer, "WINOGRAD_CONV", True), mock.patch.object(ops, "winograd_conv", wraps=ops.winograd_conv) as winograd_conv:
+      self.helper(lambda x,w: x.conv2d(w, padding=1), (2, 8, 17, 19), (16, 8, 3, 3))
+      self.helper(lambda x,w: x.conv2d(w, padding=(0,2)), (1, 3, 10, 9), (4, 3, 3, 3))
+    assert winograd_conv.call_count == 4
+
+  @unittest.skipUnless(ops.LAZY, "eager buffers are realized before they can merge")
+  def test_fused_epilogue(self):
+    with Passes.enable(merge_one_reduce_into_elementwise=True):
+      for local in [False, True]:
+        GPUBuffer.LOCAL_GEMM = local
+        for fxn in [lambda x,w,b: x.conv2d(w, padding=1) + b, lambda x,w,b: x.conv2d(w, padding=1).relu()]:
+          x, w, b = Tensor.randn(2, 4, 12, 12, device=Device.GPU).realize(), Tensor.randn(8, 4, 3, 3, device=Device.GPU).realize(), Tensor.randn(1, 8, 1, 1, device=Device.GPU).realize()
+          kernel_count = CL.kernel_count
+          out = fxn(x, w, b).realize()
+          assert CL.kernel_count == kernel_count + 1
+          np.testing.assert_allclose(out.numpy(), fxn(*[Tensor(t.numpy()) for t in (x, w, b)]).numpy(), atol=1e-3, rtol=1e-3)
+
+# every lookup in the database finds this launch
+class ForcedLaunch(dict):
+  def __init__(self, launch): super().__init__(); self.launch = launch
+  def __contains__(self, key): return True
+  def __getitem__(self, key): return self.launch
+
+@unittest.skipIf(ops_gpu is None or "GPU" not in Device._buffers, "needs pyopencl and a device")
+class TestCLTuner(unittest.TestCase):
+  def setUp(self):
+    # a local reduce picks its own local size, it isn't tuned
+    self.tmpdir, self.old = tempfile.TemporaryDirectory(), (ops_gpu.CLTUNE, ops_gpu.CLTUNEDB, CLTuner.db, CLTuner.launches, GPUBuffer.LOCAL_REDUCE)
+    ops_gpu.CLTUNE, ops_gpu.CLTUNEDB, CLTuner.db, CLTuner.launches, GPUBuffer.LOCAL_REDUCE = 1, os.path.join(self.tmpdir.name, "cltune.json"), None, {}, False
+  def tearDown(self):
+    ops_gpu.CLTUNE, ops_gpu.CLTUNEDB, CLTuner.db, CLTuner.launches, GPUBuffer.LOCAL_REDUCE = self.old
+    self.tmpdir.cleanup()
+
+  def helper(self, x, fxn): helper_test_device(Device.GPU, fxn, x)
+
+  def test_tune_and_persist(self):
+    x = np.random.randn(7, 1001).astype(np.float32)
+    self.helper(x, lambda x: (x*2).relu())
+    self.helper(x, lambda x: x.sum(axis=1))
+    with open(ops_gpu.CLTUNEDB) as f: db = json.load(f)
+    assert len(db) >= 2 and all(wpt in CLTuner.WPTS and local_size in (None,)+CLTuner.LOCAL_SIZES for wpt, local_size in db.values())
+    # a new process doesn't tune again
+    ops_gpu.CLTUNE, CLTuner.db, CLTuner.launches = 0, None, {}
+    self.helper(x, lambda x: (x*2).relu())
+    assert CLTuner.db == db
+
+  def test_corrupt_db(self):
+    with open(ops_gpu.CLTUNEDB, "w") as f: f.write("garbage")
+    self.helper(np.random.randn(1001).astype(np.float32), lambda x: x+1)
+    with open(ops_gpu.CLTUNEDB) as f: assert len(json.load(f)) == 1
+
+  def test_strided_launches(self):
+    for launch in [(1, 64), (2, None), (4, 16), (8, 256)]:
+      with mock.patch.object(CLTuner, "db", ForcedLaunch(launch)), mock.patch.object(CLTuner, "launches", {}):
+        self.helper(np.random.randn(7, 1001).astype(np.float32), lambda x: (x*2).relu())
+        self.helper(np.random.randn(7, 1001).astype(np.float32), lambda x: x.max(axis=1))
+
+  def test_launch_memo(self):
+    x = np.random.randn(7, 1001).astype(np.float32)
+    self.helper(x, lambda x: (x*2).relu())
+    # the second run of the same kernel doesn't render, hash or tune it
+    with mock.patch.object(CLTuner, "pick", side_effect=AssertionError), mock.patch.object(CLTuner, "key", side_effect=AssertionError):
+      self.helper(x, lambda x: (x*2).relu())
+
+  def test_local_size(self):
+    prg = CLProgram("add1", PRG)
+    a, out = CLBuffer(4*4), CLBuffer(4*4)
+    local_size = CLTuner.local_size(prg, [4, 1, 1], out.cl, a.cl, exact=True)
+    assert local_size is None or all(g%l == 0 for g,l in zip([4, 1, 1], local_size))
+    np.testing.assert_allclose(run_add1(lambda global_size, _, *args: prg(global_size, local_size, *args)), [1,2,3,4])
+    CLTuner.db = None
+    assert CLTuner.local_size(prg, [4, 1, 1], out.cl, a.cl, exact=True) == local_size
+
+if __name__ == '__main__':
+  unittest.main()
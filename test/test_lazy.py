@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+import time
+import unittest
+import numpy as np
+from tinygrad.helpers import prod
+from tinygrad.tensor import Tensor, Device
+from tinygrad.ops import LoadOps, UnaryOps, ReduceOps, BinaryOps, MovementOps, LazyOp, LazyBuffer, LAZY, get_lazybuffers, get_lazyops, create_schedule, plan_memory, Passes
+
+class TestSchedule(unittest.TestCase):
+  def test_deep_graph(self):
+    # this used to run out of stack in the recursive realize
+    # NOTE: the reduce keeps the elementwise ops from all merging into one giant kernel
+    x = Tensor.ones(4, requires_grad=False)
+    for _ in range(3000): x = (x+1).mean(axis=0, keepdim=True).expand(shape=(4,))
+    np.testing.assert_allclose(x.numpy(), np.full((4,), 3001, dtype=np.float32))
+
+  @unittest.skipUnless(LAZY, "nothing is scheduled if it's not lazy")
+  def test_schedule_toposort(self):
+    a, b = Tensor.ones(4, requires_grad=False), Tensor.ones(4, requires_grad=False)
+    out = (a+b)*(a+b).relu()
+    sched = out.lazydata.schedule()
+    assert sched[-1].buf is out.lazydata
+    assert all(x.optype == LoadOps for x in [si.buf for si in sched[0:2]])
+    # every dependency is scheduled before the kernel that reads it
+    for i,si in enumerate(sched): assert all(d.realized is not None or d in [x.buf for x in sched[:i]] for d in si.deps)
+    np.testing.assert_allclose(out.numpy(), np.full((4,), 4, dtype=np.float32))
+
+  @unittest.skipUnless(LAZY, "nothing is scheduled if it's not lazy")
+  def test_schedule_realized(self):
+    a = Tensor.ones(4, requires_grad=False).realize()
+    assert len(a.lazydata.schedule()) == 0
+    assert len((a+a).lazydata.schedule()) == 1
+
+class TestSiblingReduces(unittest.TestCase):
+  def test_sibling_values(self):
+    x = np.random.randn(4, 8, 3).astype(np.float32)
+    tx = Tensor(x, requires_grad=False)
+    s, sq, mx = tx.sum(axis=(0,2), keepdim=True), (tx*tx).sum(axis=(0,2), keepdim=True), tx.max(axis=(0,2), keepdim=True)
+    np.testing.assert_allclose(s.numpy(), x.sum(axis=(0,2), keepdims=True), atol=1e-5)
+    np.testing.assert_allclose(sq.numpy(), (x*x).sum(axis=(0,2), keepdims=True), atol=1e-5)
+    np.testing.assert_allclose(mx.numpy(), x.max(axis=(0,2), keepdims=True), atol=1e-5)
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_siblings_one_kernel(self):
+    tx = Tensor.randn(4, 8, requires_grad=False).realize()
+    s, sq = tx.sum(axis=1, keepdim=True), (tx*tx).sum(axis=1, keepdim=True)
+    sched = create_schedule(s.lazydata, sq.lazydata)
+    assert len(sched) == 1 and sched[0].siblings == (sq.lazydata,)
+    np.testing.assert_allclose((s+sq).numpy(), tx.numpy().sum(axis=1, keepdims=True) + (tx.numpy()**2).sum(axis=1, keepdims=True), atol=1e-5)
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_unused_sibling_not_realized(self):
+    tx = Tensor.randn(4, 8, requires_grad=False).realize()
+    s, sq = tx.sum(axis=1, keepdim=True), (tx*tx).sum(axis=1, keepdim=True)
+    assert all(len(si.siblings) == 0 for si in s.lazydata.schedule())
+    s.realize()
+    assert sq.lazydata.realized is None
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_mean_var_one_kernel(self):
+    x = np.random.default_rng(0).standard_normal((8, 4, 5, 5)).astype(np.float32) + 100
+    tx = Tensor(x, requires_grad=False).realize()
+    mean, var = tx.mean(axis=(0,2,3), keepdim=True), tx.var(axis=(0,2,3), keepdim=True)
+    # with OPT=2 the sum is merged into the multiply of the mean instead
+    with Passes.enable(merge_one_reduce_into_elementwise=False):
+      sched = [si for si in create_schedule(mean.lazydata, var.lazydata) if si.buf.optype == ReduceOps]
+    assert len(sched) == 1 and len(sched[0].siblings) == 1
+    np.testing.assert_allclose(var.numpy(), x.var(axis=(0,2,3), keepdims=True), rtol=1e-3)
+    np.testing.assert_allclose(mean.numpy(), x.mean(axis=(0,2,3), keepdims=True), rtol=1e-5)
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_dependent_not_sibling(self):
+    tx = Tensor.randn(4, 8, requires_grad=False).realize()
+    mean = tx.mean(axis=1, keepdim=True)
+    y = tx - mean
+    var = (y*y).mean(axis=1, keepdim=True)
+    assert all(len(si.siblings) == 0 for si in var.lazydata.schedule())
+    np.testing.assert_allclose(var.numpy(), tx.numpy().var(axis=1, keepdims=True), atol=1e-5)
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_merged_reduce_not_sibling(self):
+    for order in [lambda s, out: (s, out), lambda s, out: (out, s)]:
+      tx = Tensor.randn(4, 8, requires_grad=False).realize()
+      mx = tx.max(axis=1, keepdim=True)
+      s, out = tx.sum(axis=1, keepdim=True), mx+1
+      with Passes.enable(merge_one_reduce_into_elementwise=True):
+        sched = [si for si in create_schedule(*order(s.lazydata, out.lazydata)) if si.buf.optype not in (LoadOps, MovementOps)]
+      # the max is a sibling of the sum that the add reads, or it's merged into the add. it's only computed once
+      assert len(sched) == 2
+      assert sum(mx.lazydata in si.siblings for si in sched) + sum(si.buf is out.lazydata and mx.lazydata not in si.deps for si in sched) == 1
+      np.testing.assert_allclose(out.numpy(), tx.numpy().max(axis=1, keepdims=True)+1, atol=1e-6)
+
+class TestLazyCache(unittest.TestCase):
+  def test_same_structure_same_key(self):
+    a, b = Tensor.ones(4).lazydata, Tensor.ones(4).lazydata
+    assert LazyOp(BinaryOps.ADD, (LazyOp(UnaryOps.EXP, (a,)), b)).key is LazyOp(BinaryOps.ADD, (LazyOp(UnaryOps.EXP, (a,)), b)).key
+    assert LazyOp(BinaryOps.ADD, (LazyOp(UnaryOps.EXP, (a,)), b)).key is not LazyOp(BinaryOps.ADD, (LazyOp(UnaryOps.EXP, (b,)), b)).key
+
+  def test_cache_hit(self):
+    a = Tensor.ones(4, 4).lazydata
+    hits = LazyBuffer.cache_stats()["hits"]
+    e = a.unary_op(UnaryOps.EXP)
+    x1 = e.binary_op(BinaryOps.MUL, a)
+    x2 = a.unary_op(UnaryOps.EXP).binary_op(BinaryOps.MUL, a)
+    assert x1 is x2
+    assert LazyBuffer.cache_stats()["hits"] == hits + 2
+    assert 0 <= LazyBuffer.cache_stats()["hit_rate"] <= 1
+
+  @unittest.skipUnless(LAZY, "nothing is scheduled if it's not lazy")
+  def test_cache_hit_after_realize(self):
+    a = Tensor.ones(4, 4).lazydata
+    x1 = a.movement_op(MovementOps.PERMUTE, (1,0))
+    x1.realize()
+    # the op is deleted after realize, the key in the lazycache isn't
+    assert a.movement_op(MovementOps.PERMUTE, (1,0)) is x1
+
+  def test_deep_key(self):
+    # keys are built from the src keys, this doesn't recurse
+    a = Tensor.ones(4).lazydata
+    op = LazyOp(UnaryOps.EXP, (a,))
+    for _ in range(20000): op = LazyOp(UnaryOps.EXP, (op,))
+    assert op.key is not None
+
+@unittest.skipUnless(LAZY, "needs a schedule")
+class TestMemoryPlan(unittest.TestCase):
+  def check_plan(self, sched, plan, outs):
+    # buffers that share an arena are never live at the same time, and the outputs live past the schedule
+    steps = {x:i for i,si in enumerate(sched) for x in (si.buf,)+si.siblings}
+    alive = {x:(steps[x], len(sched) if x in outs else max([steps[x]]+[i for i,si in enumerate(sched) if any(d is x or d.optype == MovementOps and x in get_lazybuffers(d.op) for d in si.deps)])) for x in plan.assignment}
+    for x,a in plan.assignment.items():
+      assert plan.arenas[a] >= 4*np.prod(x.shape)
+      for y,b in plan.assignment.items():
+        if x is not y and a == b: assert alive[x][1] < alive[y][0] or alive[y][1] < alive[x][0], f"{x} and {y} overlap in arena {a}"
+    assert plan.live_bytes <= plan.planned_bytes <= plan.naive_bytes
+
+  def test_chain_reuses(self):
+    x = Tensor.randn(64, 64, requires_grad=False).realize()
+    for _ in range(10): x = (x+1).sum(axis=1, keepdim=True).expand(shape=(64, 64))
+    sched = x.lazydata.schedule()
+    plan = plan_memory(sched)
+    self.check_plan(sched, plan, (x.lazydata,))
+    assert len(plan.arenas) <= 3 and plan.planned_bytes < plan.naive_bytes/2
+
+  def test_backward(self):
+    x, w = Tensor.randn(8, 16).realize(), Tensor.randn(16, 4).realize()
+    out = x.matmul(w).relu().logsoftmax().mean()
+    out.backward()
+    outs = (out.lazydata, x.grad.lazydata, w.grad.lazydata)
+    sched = create_schedule(*outs)
+    plan = plan_memory(sched, outs)
+    self.check_plan(sched, plan, outs)
+
+class TestPasses(unittest.TestCase):
+  def test_enable_per_call(self):
+    x = Tensor.randn(4, 4, requires_grad=False).realize()
+    with Passes.enable(merge_elementwise_ops=False, merge_unary_ops=False):
+      a = ((x+1)*2).lazydata
+    with Passes.enable(merge_elementwise_ops=True):
+      b = ((x+3)*4).lazydata
+    if LAZY:
+      assert isinstance(a.op.src[0], LazyBuffer) and isinstance(b.op.src[0], LazyOp)
+    np.testing.assert_allclose(a.toCPU(), (x.numpy()+1)*2, atol=1e-6)
+    np.testing.assert_allclose(b.toCPU(), (x.numpy()+3)*4, atol=1e-6)
+
+  def test_enable_restores(self):
+    before = {k:v["enabled"] for k,v in Passes.stats().items()}
+    with self.assertRaises(RuntimeError):
+      with Passes.enable(**{k:not v for k,v in before.items()}): raise RuntimeError
+    assert {k:v["enabled"] for k,v in Passes.stats().items()} == before
+
+  @unittest.skipUnless(LAZY, "eager buffers are realized before they can merge")
+  def test_stats(self):
+    Passes.reset_stats()
+    x = Tensor.randn(4, 4, requires_grad=False).realize()
+    with Passes.enable(merge_elementwise_ops=True):
+      (x+1)*2
+    stats = Passes.stats()["merge_elementwise_ops"]
+    assert stats["calls"] == 2 and stats["hits"] == 1 and stats["ms"] >= 0
+    with Passes.enable(merge_elementwise_ops=False):
+      (x+1)*2
+    assert Passes.stats()["merge_elementwise_ops"]["calls"] == 2
+
+  @unittest.skipUnless(LAZY and getattr(Device._buffers[Device.DEFAULT], "start_for_op", None), "siblings are merged by the codegen")
+  def test_stats_once_per_reduce(self):
+    tx = Tensor.randn(4, 8, requires_grad=False).realize()
+    s, sq = tx.sum(axis=1, keepdim=True), (tx*tx).sum(axis=1, keepdim=True)
+    Passes.reset_stats()
+    with Passes.enable(merge_elementwise_into_reduce=True, merge_sibling_reduces=True):
+      sched = create_schedule(s.lazydata, sq.lazydata)
+    # the input of each reduce is looked at once, and the square is merged into its reduce
+    stats = Passes.stats()["merge_elementwise_into_reduce"]
+    assert len(sched) == 1 and stats["calls"] == 2 and stats["hits"] == 1
+
+class TestFusedCPU(unittest.TestCase):
+  def test_chunked(self):
+    from tinygrad.llops.ops_cpu import CPUBuffer
+    a, b = np.random.randn(64, 1000).astype(np.float32), np.random.randn(1000, 64).astype(np.float32)
+    bufs = {"a": CPUBuffer.fromCPU(a), "b": CPUBuffer.fromCPU(b).movement_op(MovementOps.PERMUTE, (1,0)),
+            "c": CPUBuffer.fromCPU(np.full((1,1), 2.0, dtype=np.float32)).movement_op(MovementOps.EXPAND, (64, 1000)),
+            "m1": CPUBuffer.fromCPU(np.full((1,1), -1.0, dtype=np.float32)).movement_op(MovementOps.EXPAND, (64, 1000))}
+    assert prod(a.shape) > CPUBuffer.CHUNK
+    ast = (BinaryOps.MUL, (BinaryOps.ADD, (UnaryOps.EXP, (UnaryOps.NEG, "a")), "b"), (BinaryOps.POW, (BinaryOps.ADD, "c", (UnaryOps.RELU, "a")), "m1"))
+    out = CPUBuffer.fused_op(a.shape, ast, bufs)
+    np.testing.assert_allclose(out, (np.exp(-a) + b.T) * (2.0 + np.maximum(a, 0)) ** -1.0, rtol=1e-6)
+
+  @unittest.skipUnless(Device.DEFAULT == "CPU", "only the CPU fuses like this")
+  def test_fused_kernel(self):
+    a = Tensor.randn(64, 1000)
+    with Passes.enable(merge_elementwise_ops=True):
+      out = (a.swish() + 1.0).numpy()
+    x = a.numpy()
+    np.testing.assert_allclose(out, x / (1 + np.exp(-x)) + 1.0, rtol=1e-5, atol=1e-6)
+
+class TestGraphSpeed(unittest.TestCase):
+  def test_elementwise_chain(self):
+    a, b = Tensor.ones(4).lazydata, Tensor.ones(4).lazydata
+    st = time.monotonic()
+    op = LazyOp(BinaryOps.ADD, (a, b))
+    for i in range(10000):
+      op = LazyOp(BinaryOps.MUL if i%2 else BinaryOps.ADD, (op, b if i%3 else a))
+      lbs = get_lazybuffers(op)  # LazyBuffer.__init__ does this for every new buffer
+    et = time.monotonic() - st
+    print(f"built 10k node elementwise chain in {et*1e3:.2f} ms")
+    assert lbs == [a, b] and len(get_lazyops(op)) == 10001
+
+  def test_shared_subtrees(self):
+    # x*x reuses the same LazyOp twice, it's only walked once
+    a = Tensor.ones(4).lazydata
+    op = LazyOp(BinaryOps.ADD, (a, a))
+    for _ in range(1000): op = LazyOp(BinaryOps.MUL, (op, op))
+    assert get_lazybuffers(op) == [a] and len(get_lazyops(op)) == 1001
+
+if __name__ == '__main__':
+  unittest.main()
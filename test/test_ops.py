@@ -93,6 +93,14 @@ class TestOps(unittest.TestCase):
   def test_multidot(self):
     helper_test_op([(10,45,65), (10,65,45)], lambda x,y: x @ y, Tensor.dot, atol=1e-4)
     helper_test_op([(3,3,45,65), (3,3,65,45)], lambda x,y: x @ y, Tensor.dot, atol=1e-4)
+  def test_batched_broadcastdot(self):
+    helper_test_op([(2,3,45,65), (3,65,45)], lambda x,y: x @ y, Tensor.dot, atol=1e-4)
+  def test_vectordot(self):
+    helper_test_op([(65,), (65,45)], lambda x,y: x @ y, Tensor.dot, atol=1e-4)
+  def test_transposed_dot(self):
+    helper_test_op([(45,65), (45,30)], lambda x,y: x.T @ y, lambda x,y: x.transpose().dot(y), atol=1e-4)
+  def test_odd_dot(self):
+    helper_test_op([(7,13), (13,5)], lambda x,y: x @ y, Tensor.dot, atol=1e-4)
   def test_sum(self):
     helper_test_op([(45,3)], lambda x: x.sum(), Tensor.sum)
     helper_test_op([(3,4,5,6)], lambda x: x.sum(axis=3), lambda x: Tensor.sum(x, axis=3))
@@ -110,6 +118,16 @@ class TestOps(unittest.TestCase):
     helper_test_op([(3,4,5,6)], lambda x: x.max(axis=1)[0], lambda x: Tensor.max(x, axis=1))
   def test_mean_axis(self):
     helper_test_op([(3,4,5,6)], lambda x: x.mean(axis=(1,2)), lambda x: Tensor.mean(x, axis=(1,2)))
+  def test_var(self):
+    helper_test_op([(45,3)], lambda x: x.var(unbiased=False), Tensor.var)
+    helper_test_op([(3,4,5,6)], lambda x: x.var(axis=(0,2,3), unbiased=False), lambda x: Tensor.var(x, axis=(0,2,3)))
+  def test_var_size1_axis(self):
+    helper_test_op([(2,1)], lambda x: x.var(axis=1, unbiased=False), lambda x: Tensor.var(x, axis=1))
+    helper_test_op([(1,3,1,1)], lambda x: x.var(axis=(0,2,3), unbiased=False), lambda x: Tensor.var(x, axis=(0,2,3)))
+  def test_var_offset(self):
+    # the naive E[x^2]-E[x]^2 loses everything in float32 here
+    helper_test_op(None, lambda x: x.var(axis=1, unbiased=False), lambda x: Tensor.var(x, axis=1), forward_only=True,
+      vals=[(np.random.default_rng(0).random((4,64))+1e4).astype(np.float32).tolist()])
   def test_logsoftmax(self):
     helper_test_op([(45,65)], lambda x: torch.nn.LogSoftmax(dim=1)(x), Tensor.logsoftmax, atol=1e-7, grad_atol=1e-7)
   def test_tanh(self):
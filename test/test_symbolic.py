@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import unittest
+from tinygrad.symbolic import Variable, NumNode
+
+class TestSymbolic(unittest.TestCase):
+  def helper_test_variable(self, v, n, m, s):
+    self.assertEqual(v.render(), s)
+    self.assertEqual(v.min, n)
+    self.assertEqual(v.max, m)
+
+  def test_mod_in_range(self):
+    self.helper_test_variable(Variable("a", 0, 5)%6, 0, 5, "a")
+
+  def test_div_in_range(self):
+    self.helper_test_variable(Variable("a", 0, 5)//6, 0, 0, "0")
+
+  def test_mod_of_mul(self):
+    self.helper_test_variable((Variable("a", 0, 100)*6)%3, 0, 0, "0")
+
+  def test_div_of_div(self):
+    self.helper_test_variable((Variable("a", 0, 100)//2)//3, 0, 16, "(a//6)")
+
+  def test_mod_of_mod(self):
+    self.helper_test_variable((Variable("a", 0, 100)%12)%4, 0, 3, "(a%4)")
+
+  def test_sum_div(self):
+    self.helper_test_variable((Variable("a", 0, 7)*8 + Variable("b", 0, 7))//8, 0, 7, "a")
+
+  def test_sum_mod(self):
+    self.helper_test_variable((Variable("a", 0, 7)*8 + Variable("b", 0, 7))%8, 0, 7, "b")
+
+  def test_sum_folds_constants(self):
+    self.helper_test_variable(Variable("a", 0, 5)+2+(-2), 0, 5, "a")
+
+  def test_compare(self):
+    a = Variable("a", 0, 5)
+    self.assertEqual((a >= 0).render(), "1")
+    self.assertEqual((a < 6).render(), "1")
+    self.assertEqual((a < 3).render(), "(a<3)")
+    self.helper_test_variable(Variable.ands([a >= 0, a < 3]), 0, 1, "(a<3)")
+    self.assertIsInstance(Variable.ands([a < 3, a >= 6]), NumNode)
+
+  def test_eval(self):
+    import numpy as np
+    a = Variable("a", 0, 15)
+    node = Variable.sum([(a//4)*3, a%4, NumNode(1)])
+    np.testing.assert_equal(node.eval({"a": np.arange(16)}), [(i//4)*3+i%4+1 for i in range(16)])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -29,6 +29,17 @@ def get_conv_args(x_shape, w_shape, stride=1, groups=1, padding=0, dilation=1, o
   assert cout % groups == 0 and (out_shape is None or out_shape == (bs, cout, oy, ox))
   return ConvArgs(H, W, groups, cout//groups, cin, oy, ox, iy, ix, sy, sx, bs, cout, py, py_, px, px_, dy, dx, (bs, cout, oy, ox))
 
+# a batched GEMM, (bs, m, k) @ (bs, k, n)
+MatmulArgs = namedtuple('MatmulArgs', ['bs', 'm', 'k', 'n', 'out_shape'])
+def get_matmul_args(x_shape, w_shape):
+  bs,m,k = x_shape
+  bs_,k_,n = w_shape
+  if bs != bs_ or k != k_: raise Exception(f"can't matmul {x_shape} with {w_shape}")
+  return MatmulArgs(bs, m, k, n, (bs, m, n))
+
+# Winograd F(2x2,3x3) does 2.25x fewer multiplies on 3x3 convs that don't stride. depthwise convs are cheaper without it
+def winograd_eligible(C:ConvArgs) -> bool: return C.H == C.W == 3 and C.sy == C.sx == C.dy == C.dx == 1 and C.cin > 1
+
 def get_available_llops():
   import importlib, inspect
   _buffers, DEFAULT = {}, "CPU"
@@ -0,0 +1,362 @@
+from __future__ import annotations
+import os, abc, hashlib, itertools, tempfile
+from typing import Optional, Tuple, Union, Any, List, Dict, Callable, Set, IO
+from tinygrad.helpers import ConvArgs, MatmulArgs, prod
+from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps, Op
+from tinygrad.shapetracker import ShapeTracker, View, strides_for_shape
+
+# kernels are named by a hash of their canonical source, so identical kernels share one program and the name doesn't depend on compile order
+def canonicalize(prg:str) -> str: return '\n'.join(line.rstrip() for line in prg.split('\n') if line.strip())
+
+# each backend's programs are built once for each name, canonical source and options, and the builds are cached on disk
+# the backend provides the path of a build in the cache (None to not cache it), loading it back, compiling it and binding the kernel
+class CompiledProgram(abc.ABC):
+  programs : Dict[Tuple[str, str, Tuple[str, ...], Optional[Tuple]], CompiledProgram]
+  hits, misses, disk_hits, disk_misses = 0, 0, 0, 0
+  def __init_subclass__(cls): cls.programs, cls.hits, cls.misses, cls.disk_hits, cls.disk_misses = {}, 0, 0, 0, 0
+
+  def __new__(cls, name:str, prg:str, options:Tuple[str, ...]=tuple(), argdtypes=None):
+    key = (name, canonicalize(prg), tuple(options), None if argdtypes is None else tuple(argdtypes))
+    if key in cls.programs: cls.hits += 1
+    else: cls.programs[key], cls.misses = super().__new__(cls), cls.misses + 1
+    return cls.programs[key]
+
+  def __init__(self, name:str, prg:str, options:Tuple[str, ...]=tuple(), argdtypes=None):
+    if getattr(self, 'name', None) is not None: return  # cache hit, we return and don't reinit
+    prg, options = canonicalize(prg), tuple(options)
+    hashed = f"{name}_{hashlib.sha256(chr(0).join([prg, *options]).encode()).hexdigest()[:8]}"
+    self.prg, self.options, self.argdtypes = prg.replace(f"{name}(", f"{hashed}("), options, argdtypes
+    self.bind(type(self).build(self.prg, self.options), hashed)
+    self.name = hashed
+
+  @classmethod
+  def cache_stats(cls) -> Dict[str, int]:
+    return {"hits": cls.hits, "misses": cls.misses, "disk_hits": cls.disk_hits, "disk_misses": cls.disk_misses, "programs": len(cls.programs)}
+
+  @classmethod
+  def build(cls, prg:str, options:Tuple[str, ...]=tuple()) -> Any:
+    fn = cls.cachepath(prg, options)
+    if fn is not None and os.path.isfile(fn) and (ret := cls.load(fn, options)) is not None:
+      cls.disk_hits += 1
+      return ret
+    cls.disk_misses += 1
+    return cls.compile(prg, options, fn)
+
+  # the file is written next to where it goes and renamed, so another process never loads half of it
+  @staticmethod
+  def save(fn:str, write:Callable[[IO[bytes]], Any]):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(fn), delete=False) as tmp: write(tmp)
+    os.replace(tmp.name, fn)
+
+  @staticmethod
+  @abc.abstractmethod
+  def cachepath(prg:str, options:Tuple[str, ...]) -> Optional[str]: ...
+  # None if the file is truncated or broken, then it's compiled again
+  @staticmethod
+  @abc.abstractmethod
+  def load(fn:str, options:Tuple[str, ...]) -> Any: ...
+  @staticmethod
+  @abc.abstractmethod
+  def compile(prg:str, options:Tuple[str, ...], fn:Optional[str]) -> Any: ...
+  @abc.abstractmethod
+  def bind(self, lib:Any, name:str): ...
+
+# a ShapeTracker over raw device memory, the ops are rendered as C-like kernels with one thread per output
+# a backend sets the dialect, and provides raw (the memory), kernel, fromCPU, toCPU and the runtime that builds and launches a kernel
+class CompiledBuffer(abc.ABC):
+  code_for_op : Dict[Op, str] = {
+    UnaryOps.NOOP: "(A)", UnaryOps.NEG: "(-(A))", UnaryOps.RELU: "max(A, (float)0.)", UnaryOps.EXP: "exp(A)", UnaryOps.LOG: "log(A)", UnaryOps.SIGN: "sign(A)",
+    BinaryOps.ADD: "(A+B)", BinaryOps.SUB: "(A-B)", BinaryOps.MUL: "(A*B)", BinaryOps.DIV: "(A/B)", BinaryOps.POW: "pow(A,B)", BinaryOps.CMPEQ: "(A==B)",
+    ReduceOps.SUM: "(acc + A)", ReduceOps.MAX: "max(A, acc)",
+    # welford's online variance, one pass over A. acc is always the variance so far
+    ReduceOps.VAR: "(acc_a = A, acc_n += 1.0f, acc_d = acc_a - acc_mean, acc_mean += acc_d/acc_n, acc_m2 += acc_d*(acc_a - acc_mean), acc_m2/acc_n)"
+  }
+  start_for_op : Dict[Op, str] = {ReduceOps.SUM: "0.0", ReduceOps.MAX: "-INFINITY", ReduceOps.VAR: "0.0f"}
+  # the variables a reduce keeps next to acc, declared with it
+  state_for_op : Dict[Op, str] = {ReduceOps.VAR: "float acc_n = 0.0f, acc_mean = 0.0f, acc_m2 = 0.0f, acc_a, acc_d;"}
+  prelude, buffer_prefix, inline_prefix = "", "__global ", "inline "
+  runtime : Callable
+
+  def __init__(self, shape:Union[ShapeTracker, Tuple[int, ...]], hostbuf:Optional[CompiledBuffer]=None, backing:Optional[Any]=None):
+    self.st = shape if isinstance(shape, ShapeTracker) else ShapeTracker(tuple(shape))
+    self.shape = self.st.shape
+    self._buf : Any = hostbuf._buf if hostbuf is not None else None
+    self._base_shape : Tuple[int, ...] = hostbuf._base_shape if hostbuf is not None else self.shape
+    self._backing : Optional[Any] = hostbuf._backing if hostbuf is not None else backing
+    # early copy in for large buffers
+    if self._backing is not None and self._backing.shape != (1,): self.raw
+
+  @property
+  @abc.abstractmethod
+  def raw(self) -> Any: ...
+  def __repr__(self): return f"<{type(self).__name__} with shape {self.shape!r}>"
+
+  # the kernel runs body once for each gid in range(global_size), a strided kernel can be launched with any number of threads
+  @classmethod
+  @abc.abstractmethod
+  def kernel(cls, name:str, args:List[str], body:str, global_size:int, strided:bool=False) -> str: ...
+
+  # prg is the source before the kernel, a backend can pick the threads and the local size here
+  @classmethod
+  def launch(cls, name:str, prg:str, args:List[str], body:str, global_size:int, *bufs):
+    cls.runtime(name, prg + cls.kernel(name, args, body, global_size), argdtypes=tuple(None for _ in bufs))([global_size, 1, 1], None, *bufs)
+
+  def contiguous_view(x, name:str) -> str:
+    return f"{x.inline_prefix}float get_{name}({x.buffer_prefix}const float *x, int gid) {{ int valid = 1; int idx = gid; {x.st.expr().replace('//', '/')}; return valid ? x[idx] : 0.0;}}"
+
+  def contiguous_view_constant_fold(x, name:str) -> Tuple[str, bool]:
+    if x._base_shape == (1,) and x._backing is not None:
+      return f"{x.inline_prefix}float get_{name}(int gid) {{ int valid = 1; int idx = gid; {x.st.expr().replace('//', '/')}; return valid ? {x._backing[0]} : 0.0;}}", False
+    else:
+      return x.contiguous_view(name), True
+
+  # 4 outputs in a row read 4 floats in a row, or the same float, if the view is contiguous or the last axis is and divides by 4
+  FLOAT4 = False
+  def float4_view(x, name:str) -> Optional[str]:
+    if x._base_shape == (1,) and x._backing is not None:
+      # a padded constant isn't the same in all 4 lanes, those read 4 floats one by one
+      if len(x.st.views) == 1 and isinstance(x.st.views[0], View): return f"{x.inline_prefix}float4 get4_{name}(int gid) {{ return (float4)(get_{name}(gid)); }}"
+      return f"{x.inline_prefix}float4 get4_{name}(int gid) {{ return (float4)(get_{name}(gid), get_{name}(gid+1), get_{name}(gid+2), get_{name}(gid+3)); }}"
+    if x.st.contiguous: load = "vload4(0, x+idx)"
+    elif len(x.st.views) == 1 and isinstance(x.st.views[0], View) and x.shape[-1] % 4 == 0 and x.st.views[0].strides[-1] in (0, 1):
+      load = "vload4(0, x+idx)" if x.st.views[0].strides[-1] == 1 else "(float4)(x[idx])"
+    else: return None
+    return f"{x.inline_prefix}float4 get4_{name}({x.buffer_prefix}const float *x, int gid) {{ int valid = 1; int idx = gid; {x.st.expr().replace('//', '/')}; return valid ? {load} : (float4)(0.0f);}}"
+
+  def unary_op(x, op:UnaryOps): return type(x)(x.shape)._processing_op([("A", x)], x.code_for_op[op])
+  def binary_op(x, op:BinaryOps, y:CompiledBuffer): return type(x)(x.shape)._processing_op([("A", x), ("B", y)], x.code_for_op[op])
+  def contiguous_op(x): return x if x.st.contiguous else x.unary_op(UnaryOps.NOOP)
+  def movement_op(x, op:MovementOps, arg) -> CompiledBuffer: return type(x)(ShapeTracker(x.st).movement_op(op, arg), x)
+  def reduce_op(x, op:ReduceOps, new_shape:Tuple[int, ...]):
+    # nothing is reduced, the variance of one element is 0
+    if x.shape == tuple(new_shape): return x.binary_op(BinaryOps.SUB, x) if op == ReduceOps.VAR else x.unary_op(UnaryOps.NOOP)
+    return type(x)(new_shape)._processing_op([("A", x)], code="acc", earlycode=x.code_for_op[op], earlybufs=set("A"), start=x.start_for_op[op])
+
+  # each thread computes a tm x tn tile of the output from the strided views of the inputs, so the transposes are free
+  # the conv, and with local memory the matmul too, are tiled GEMMs
+  processing_ops : Tuple[ProcessingOps, ...] = (ProcessingOps.MATMUL,)
+  def processing_op(x, op:ProcessingOps, w:CompiledBuffer, C:Union[ConvArgs, MatmulArgs]):
+    if isinstance(C, ConvArgs) or x.local_gemm(): return type(x)(C.out_shape)._processing_op([("input", x), ("weight", w)], C=C)
+    assert op == ProcessingOps.MATMUL and isinstance(C, MatmulArgs), f"{op} isn't supported"
+    x, w = [y if len(y.st.views) == 1 and isinstance(y.st.views[0], View) else y.contiguous_op() for y in (x, w)]
+    xv, wv = x.st.views[0], w.st.views[0]
+    assert isinstance(xv, View) and isinstance(wv, View)
+    (xsb, xsm, xsk), (wsb, wsk, wsn) = xv.strides, wv.strides
+    tm, tn = [next(t for t in (4, 2, 1) if s % t == 0) for s in (C.m, C.n)]
+    ret = type(x)(C.out_shape)
+    tiles = itertools.product(range(tm), range(tn))
+    prg = ret.prelude + ret.kernel("matmul", [f"{ret.buffer_prefix}float* restrict output", f"{ret.buffer_prefix}const float *x_g", f"{ret.buffer_prefix}const float *w_g"], f"""
+      int j = (gid % {C.n//tn})*{tn}, i = ((gid / {C.n//tn}) % {C.m//tm})*{tm}, b = gid / {(C.n//tn)*(C.m//tm)};
+      {ret.buffer_prefix}const float *xp = x_g + {xv.offset} + b*{xsb} + i*{xsm};
+      {ret.buffer_prefix}const float *wp = w_g + {wv.offset} + b*{wsb} + j*{wsn};
+      {' '.join(f"float acc_{r}_{c} = 0.0f;" for r,c in itertools.product(range(tm), range(tn)))}
+      for (int k = 0; k < {C.k}; k++) {{
+        {' '.join(f"float x_{r} = xp[{r*xsm} + k*{xsk}];" for r in range(tm))}
+        {' '.join(f"float w_{c} = wp[k*{wsk} + {c*wsn}];" for c in range(tn))}
+        {' '.join(f"acc_{r}_{c} += x_{r} * w_{c};" for r,c in itertools.product(range(tm), range(tn)))}
+      }}
+      {' '.join(f"output[(b*{C.m} + i + {r})*{C.n} + j + {c}] = acc_{r}_{c};" for r,c in tiles)}""", C.bs*(C.m//tm)*(C.n//tn))
+    type(ret).runtime("matmul", prg, argdtypes=(None, None, None))([C.bs*(C.m//tm)*(C.n//tn), 1, 1], None, ret.raw, x.raw, w.raw)
+    return ret
+
+  # a reduce runs serially in each thread, on a workgroup per output that tree reduces in local memory,
+  # or in two stages through a buffer of partial results when there are too few outputs to fill the device
+  # NOTE: the workgroups need local memory, a backend without it has LOCAL_SIZE 0
+  LOCAL_SIZE = 0
+  # the serial reduce unrolls up to UNROLL steps, and a thread does up to UPCAST outputs if there's UPCAST_MIN threads left
+  UNROLL, UPCAST, UPCAST_MIN = 9, 4, 1024
+  combine_for_op : Dict[Op, str] = {ReduceOps.SUM: "(A+B)", ReduceOps.MAX: "max(A,B)"}
+  @classmethod
+  def reduce_strategy(cls, outputs:int, rsize:int) -> Tuple[str, int]:
+    if cls.LOCAL_SIZE == 0 or rsize < cls.LOCAL_SIZE or outputs >= 4096: return "serial", 1
+    groups = min(256, rsize // (16*cls.LOCAL_SIZE))
+    return ("twostage", groups) if outputs < 32 and groups > 1 else ("workgroup", 1)
+
+  @classmethod
+  def local_kernel(cls, name:str, args:List[str], body:str, local_size:int) -> str:
+    return f"__kernel __attribute__((reqd_work_group_size({local_size}, 1, 1))) void {name}({','.join(args)}) {{ int lid = get_local_id(0);\n{body}\n}}"
+
+  # a batch of groups (M x K) @ (K x N) GEMMs, each thread keeps RM x RN outputs in registers. with local memory, a workgroup computes a TM x TN tile
+  # and stages TK deep tiles of A and B there. a(m,k), b(k,n) and out(m,n) are C expressions that can use g and the ints bprep declares,
+  # the elementwise code runs on acc before the store
+  GEMM_TILE = (32, 32, 8, 4, 4)
+  @classmethod
+  def local_gemm(cls) -> bool: return cls.LOCAL_SIZE > 0
+  def tiled_gemm(ret, bufs:List[Tuple[str, CompiledBuffer]], code:str, groups:int, M:int, N:int, K:int, a:str, b:str, out:str, bprep:str="") -> CompiledBuffer:
+    TM, TN, TK, RM, RN = ret.GEMM_TILE
+    views = {name:buf.contiguous_view_constant_fold(name) for name, buf in bufs}
+    args = [f"{ret.buffer_prefix}float* restrict output"] + [f"{ret.buffer_prefix}const float *{name}_g" for name, _ in bufs if views[name][1]]
+    rawbufs = [ret.raw, *[buf.raw for name, buf in bufs if views[name][1]]]
+    tiles = list(itertools.product(range(RM), range(RN)))
+    loads = chr(10).join(f'        float {name} = ' + (f'get_{name}({name}_g, gid);' if views[name][1] else f'get_{name}(gid);') for name, _ in bufs if name not in ("input", "weight"))
+    epilogue = chr(10).join(f"""      if (mb+{r} < {M} && nb+{c} < {N}) {{ int m = mb+{r}, n = nb+{c}, gid = {out}; float acc = acc_{r}_{c};
+{loads}
+        output[gid] = {code}; }}""" for r,c in tiles)
+    prg = ret.prelude + chr(10).join([x[0] for x in views.values()]) + "\n"
+    if not ret.local_gemm():
+      MT, NT = (M+RM-1)//RM, (N+RN-1)//RN
+      type(ret).runtime("gemm", prg + ret.kernel("gemm", args, f"""
+      int nb = (gid%{NT})*{RN}, mb = ((gid/{NT})%{MT})*{RM}, g = gid/{NT*MT};
+      {' '.join(f"float acc_{r}_{c} = 0.0f;" for r,c in tiles)}
+      for (int k = 0; k < {K}; k++) {{
+        {' '.join(f"float a_{r}; {{ int m = mb+{r}; a_{r} = m < {M} ? {a} : 0.0f; }}" for r in range(RM))}
+        {' '.join(f"float b_{c}; {{ int n = nb+{c}; {bprep} b_{c} = n < {N} ? {b} : 0.0f; }}" for c in range(RN))}
+        {' '.join(f"acc_{r}_{c} += a_{r} * b_{c};" for r,c in tiles)}
+      }}
+{epilogue}""", groups*MT*NT), argdtypes=tuple(None for _ in args))([groups*MT*NT, 1, 1], None, *rawbufs)
+      return ret
+    threads = (TM//RM)*(TN//RN)
+    type(ret).runtime("gemm", prg + ret.local_kernel("gemm", args, f"""
+      int g = get_group_id(2), tm = get_group_id(1)*{TM}, tn = get_group_id(0)*{TN};
+      int mb = tm + (lid/{TN//RN})*{RM}, nb = tn + (lid%{TN//RN})*{RN};
+      __local float As[{TK*TM}], Bs[{TK*TN}];
+      {' '.join(f"float acc_{r}_{c} = 0.0f;" for r,c in tiles)}
+      for (int k0 = 0; k0 < {K}; k0 += {TK}) {{
+        for (int i = lid; i < {TK*TM}; i += {threads}) {{ int k = k0 + i%{TK}, m = tm + i/{TK}; As[(i%{TK})*{TM} + i/{TK}] = (m < {M} && k < {K}) ? {a} : 0.0f; }}
+        for (int i = lid; i < {TK*TN}; i += {threads}) {{ int k = k0 + i/{TN}, n = tn + i%{TN}; {bprep} Bs[i] = (n < {N} && k < {K}) ? {b} : 0.0f; }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+        for (int k = 0; k < {TK}; k++) {{
+          {' '.join(f"float a_{r} = As[k*{TM} + mb-tm + {r}];" for r in range(RM))}
+          {' '.join(f"float b_{c} = Bs[k*{TN} + nb-tn + {c}];" for c in range(RN))}
+          {' '.join(f"acc_{r}_{c} = mad(a_{r}, b_{c}, acc_{r}_{c});" for r,c in tiles)}
+        }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+      }}
+{epilogue}""", threads), argdtypes=tuple(None for _ in args))([(N+TN-1)//TN*threads, (M+TM-1)//TM, groups], [threads, 1, 1], *rawbufs)
+    return ret
+
+  # the conv is a GEMM of the weights and the input windows, with the padding in the loads of the input
+  def conv_op(ret, bufs:List[Tuple[str, CompiledBuffer]], code:str, C:ConvArgs) -> CompiledBuffer:
+    iy, ix = dict(bufs)["input"].shape[2:]
+    return ret.tiled_gemm(bufs, code, C.groups, C.rcout, C.bs*C.oy*C.ox, C.cin*C.H*C.W, f"get_weight(weight_g, (g*{C.rcout} + m)*{C.cin*C.H*C.W} + k)",
+      f"((y >= 0 && y < {iy} && x >= 0 && x < {ix}) ? get_input(input_g, ((n/{C.oy*C.ox}*{C.groups*C.cin} + g*{C.cin} + k/{C.H*C.W})*{iy} + y)*{ix} + x) : 0.0f)",
+      f"((n/{C.oy*C.ox})*{C.cout} + g*{C.rcout} + m)*{C.oy*C.ox} + n%{C.oy*C.ox}",
+      f"int y = ((n/{C.ox})%{C.oy})*{C.sy} - {C.py} + ((k/{C.W})%{C.H})*{C.dy}, x = (n%{C.ox})*{C.sx} - {C.px} + (k%{C.W})*{C.dx};")
+
+  #REQUIRES_SIMPLE_REDUCE = True
+  # siblings are extra (output, earlycode, start) reduces over the same loop, they each get their own acc and are written as is
+  def _processing_op(ret, bufs: List[Tuple[str, CompiledBuffer]]=[], code:str="acc", C:Optional[Union[ConvArgs, MatmulArgs]]=None, start="0.0", reduce_shape=None, earlybufs:Set[str]=set(), earlycode:str="acc", siblings:List[Tuple[CompiledBuffer, str, str]]=[], groups:Optional[int]=None) -> CompiledBuffer:
+    if isinstance(C, ConvArgs): return ret.conv_op(bufs, code, C)
+    if isinstance(C, MatmulArgs): return ret.tiled_gemm(bufs, code, C.bs, C.m, C.n, C.k, f"get_input(input_g, (g*{C.m} + m)*{C.k} + k)", f"get_weight(weight_g, (g*{C.k} + k)*{C.n} + n)", f"(g*{C.m} + m)*{C.n} + n")
+
+    # this takes a ret index to an inp index, indexing 0 on the reduced strides
+    # if it's not a reduce, this should be a NOOP
+    reduce_shape = (bufs[0][1].shape, ret.shape) if reduce_shape is None else reduce_shape
+    view = View(reduce_shape[1], strides_for_shape(reduce_shape[0]))
+    loop : List[Tuple[str, str]] = []
+    raxes : List[Tuple[int, int]] = []
+    if reduce_shape[1] != reduce_shape[0]:   # this is a reduce
+      # reverse operation of expand, this validates inputs
+      # generate loops with combined adjacent reduce axis
+      acc = 1
+      for shp,stride in ShapeTracker(reduce_shape[1]).movement_op(MovementOps.EXPAND, reduce_shape[0]).views[-1].shape_strides[::-1]:
+        if stride == 0:
+          loop.append((f"for (int axis_{len(loop)} = 0; axis_{len(loop)} < {shp}; axis_{len(loop)}++) {{", f"idx += {acc}; }} idx -= {shp*acc};"))
+          raxes.append((shp, acc))
+        acc *= shp
+
+    kernel_name = "reduce" if len(loop) > 0 else "elementwise"
+    views = {name:buf.contiguous_view_constant_fold(name) for name, buf in bufs}
+    buf_types = [f"{ret.buffer_prefix}const float *{name}_g" for name, _ in bufs if name not in views or views[name][1]]
+    args = [f"{ret.buffer_prefix}float* restrict output"] + [f"{ret.buffer_prefix}float* restrict output_{i}" for i in range(len(siblings))] + buf_types
+    def loads(early:bool, idx:str="idx", names:Optional[Set[str]]=None) -> str:
+      return chr(10).join([f'        float {name} = ' + (f'get_{name}({name}_g, {idx});' if views[name][1] else f'get_{name}({idx});') for name, _ in bufs if (name in earlybufs) == early and (names is None or name in names)])
+    # the reduces are known by their start, they run in parallel if all of them can be combined
+    op_for_start = {v:k for k,v in ret.start_for_op.items()}
+    accs = [("acc", start)] + [(f"acc_{i}", s) for i,(_,_,s) in enumerate(siblings)]
+    starts = [f"float {n} = {s}; " + (ret.state_for_op.get(op_for_start[s], "").replace("acc", n) if s in op_for_start else "") for n,s in accs]
+    accumulate = ' '.join([f"acc = {earlycode};"] + [f"acc_{i} = " + ec.replace('acc', f'acc_{i}') + ";" for i,(_,ec,_) in enumerate(siblings)])
+
+    rsize = prod(reduce_shape[0])//prod(reduce_shape[1])
+    rops : List[Op] = [op_for_start[s] for s in [start]+[s for _,_,s in siblings] if s in op_for_start]
+    combinable = len(rops) == len(siblings)+1 and all(op in ret.combine_for_op for op in rops)
+    strategy, ngroups = ret.reduce_strategy(prod(ret.shape), rsize) if len(loop) and combinable else ("serial", 1)
+    if groups is not None: strategy, ngroups = "workgroup", groups
+    if strategy == "twostage" and len(siblings): strategy, ngroups = "workgroup", 1
+    if strategy == "twostage":
+      # the first stage writes groups partial results for each output, the second reduces them and runs the rest of the ast
+      partial = CompiledBuffer._processing_op(type(ret)(ret.shape + (ngroups,)), [(name, buf) for name, buf in bufs if name in earlybufs], start=start, reduce_shape=reduce_shape, earlybufs=earlybufs, earlycode=earlycode, groups=ngroups)
+      return CompiledBuffer._processing_op(ret, [("partial", partial)] + [(name, buf) for name, buf in bufs if name not in earlybufs], code, start=start,
+        reduce_shape=(ret.shape + (ngroups,), ret.shape + (1,)), earlybufs={"partial"}, earlycode=ret.code_for_op[rops[0]].replace("A", "partial"))
+
+    rawbufs = [ret.raw, *[x.raw for x,_,_ in siblings], *[buf.raw for name, buf in bufs if name not in views or views[name][1]]]
+    # an elementwise kernel can do 4 outputs per thread with vector loads and stores, the last outputs if there's less than 4 are done one at a time
+    # NOTE: A==B is an int4 of -1 and 0 on vectors, so those don't vectorize
+    float4 = {name:buf.float4_view(name) for name, buf in bufs} if ret.FLOAT4 and not len(loop) and not len(siblings) and "==" not in code else {}
+    if len(float4) and all(v is not None for v in float4.values()):
+      N = prod(ret.shape)
+      loads4 = chr(10).join([f'        float4 {name} = ' + (f'get4_{name}({name}_g, idx);' if views[name][1] else f'get4_{name}(idx);') for name, _ in bufs])
+      prg = ret.prelude + chr(10).join([x[0] for x in views.values()] + [x for x in float4.values() if x is not None]) + "\n"
+      type(ret).launch(kernel_name, prg, args, f"""
+      int idx = gid*4;
+      if (idx+4 <= {N}) {{
+{loads4}
+        vstore4({code}, 0, output+idx);
+      }}""" + (f""" else for (; idx < {N}; idx++) {{
+{loads(False)}
+        output[idx] = {code};
+      }}""" if N%4 else ""), (N+3)//4, *rawbufs)
+    elif strategy == "serial":
+      # the innermost reduce loops are unrolled while that's at most UNROLL steps, the next loop is split to fill the rest
+      rloops : List[Tuple[int, int]] = raxes[:]
+      unrolled : List[Tuple[int, int]] = []
+      while len(rloops) and prod(n for n,_ in unrolled)*rloops[0][0] <= ret.UNROLL: unrolled.append(rloops.pop(0))
+      if len(rloops) and (d := max(d for d in range(1, ret.UNROLL//prod(n for n,_ in unrolled)+1) if rloops[0][0]%d == 0)) > 1:
+        unrolled.append((d, rloops[0][1]))
+        rloops[0] = (rloops[0][0]//d, rloops[0][1]*d)
+      offsets = [sum(c*a for c,(_,a) in zip(cs, unrolled[::-1])) for cs in itertools.product(*[range(n) for n,_ in unrolled[::-1]])]
+      rloop = [(f"for (int axis_{i} = 0; axis_{i} < {shp}; axis_{i}++) {{", f"idx += {acc}; }} idx -= {shp*acc};") for i,(shp,acc) in enumerate(rloops)]
+
+      # a thread does upcast outputs in a row on the last axis that isn't reduced, the inputs that don't change along it are loaded once for all of them
+      uaxis = max([i for i,s in enumerate(reduce_shape[1]) if s > 1], default=0)
+      upcast = next((u for u in range(ret.UPCAST, 1, -1) if len(loop) and not len(siblings) and combinable and len(reduce_shape[0]) == len(reduce_shape[1]) and
+                     reduce_shape[1][uaxis]%u == 0 and prod(ret.shape)//u >= ret.UPCAST_MIN), 1)
+      ustride = strides_for_shape(reduce_shape[0])[uaxis]
+      shared = {name for name, buf in bufs if len(buf.st.views) == 1 and isinstance(buf.st.views[0], View) and buf.shape == reduce_shape[0] and buf.st.views[0].strides[uaxis] == 0}
+      def step(o:int) -> str:
+        if upcast == 1: return f"{{\n{loads(True, f'idx+{o}' if o else 'idx')}\n        {accumulate} }}"
+        return f"{{\n{loads(True, f'idx+{o}' if o else 'idx', shared)}\n" + chr(10).join(f"        {{ float acc = acc_{u};\n{loads(True, f'idx+{o+u*ustride}' if o+u*ustride else 'idx', set(earlybufs)-shared)}\n        acc = {earlycode}; acc_{u} = acc; }}" for u in range(upcast)) + " }"
+      if upcast == 1: end = f"""idx = gid;
+{loads(False)}
+      output[gid] = {code}; {' '.join([f"output_{i}[gid] = acc_{i};" for i in range(len(siblings))])}"""
+      else: end = chr(10).join(f"""      {{ float acc = acc_{u}; int idx = gid*{upcast}+{u};
+{loads(False)}
+        output[gid*{upcast}+{u}] = {code}; }}""" for u in range(upcast))
+
+      global_size = prod(ret.shape)//upcast
+      type(ret).launch(kernel_name, ret.prelude + chr(10).join([x[0] for x in views.values()]) + "\n", args, f"""
+      {' '.join(starts) if upcast == 1 else ' '.join(f"float acc_{u} = {start};" for u in range(upcast))} int idx = gid{f'*{upcast}' if upcast > 1 else ''}; {view.expr.replace('//', '/')};
+      {' '.join([ls for ls, _ in rloop[::-1]])}
+      {(chr(10)+'      ').join(step(o) for o in offsets)}
+      {' '.join([le for _, le in rloop])} {end}""", global_size, *rawbufs)
+    else:
+      # the threads of a workgroup stride over the flattened reduce axes, then tree reduce their accs
+      L, div, roffset = ret.LOCAL_SIZE, 1, []
+      for i,(shp,acc) in enumerate(raxes):
+        roffset.append(f"((r/{div})" + (f"%{shp})" if i != len(raxes)-1 else ")") + f"*{acc}")
+        div *= shp
+      names = ["acc"] + [f"acc_{i}" for i in range(len(siblings))]
+      combines = [ret.combine_for_op[op].replace("A", f"part_{n}[lid]").replace("B", f"part_{n}[lid+s]") for n,op in zip(names, rops)]
+      prg = ret.prelude + chr(10).join([x[0] for x in views.values()]) + "\n" + ret.local_kernel(kernel_name, args, f"""
+      int gid = get_group_id(0)/{ngroups}, chunk = get_group_id(0)%{ngroups};
+      {' '.join(f"__local float part_{n}[{L}];" for n in names)}
+      {' '.join(starts)} int idx = gid; {view.expr.replace('//', '/')}; int base = idx;
+      for (int r = chunk*{L} + lid; r < {rsize}; r += {ngroups*L}) {{
+        idx = base + {'+'.join(roffset)};
+{loads(True)}
+        {accumulate}
+      }}
+      {' '.join(f"part_{n}[lid] = {n};" for n in names)}
+      barrier(CLK_LOCAL_MEM_FENCE);
+      for (int s = {L//2}; s > 0; s >>= 1) {{
+        if (lid < s) {{ {' '.join(f"part_{n}[lid] = {c};" for n,c in zip(names, combines))} }}
+        barrier(CLK_LOCAL_MEM_FENCE);
+      }}
+      if (lid == 0) {{
+        {' '.join(f"{n} = part_{n}[0];" for n in names)} idx = gid;
+{loads(False)}
+        output[get_group_id(0)] = {code}; {' '.join([f"output_{i}[gid] = acc_{i};" for i in range(len(siblings))])}
+      }}""", L)
+      type(ret).runtime(kernel_name, prg, argdtypes=tuple(None for _ in args))([prod(ret.shape)*L, 1, 1], [L, 1, 1], *rawbufs)
+    return ret
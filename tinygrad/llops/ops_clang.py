@@ -0,0 +1,99 @@
+from __future__ import annotations
+import os, ctypes, functools, hashlib, platform, subprocess, tempfile
+import numpy as np
+from typing import List, Optional, Tuple
+from tinygrad.helpers import prod
+from tinygrad.ops import DEBUG
+from tinygrad.llops.compiled import CompiledProgram, CompiledBuffer
+
+CC = os.getenv("CC", "cc")
+# CLANGFLAGS adds flags, like -march=native to build for this cpu
+CFLAGS = ("-shared", "-fPIC", "-O2", "-fno-math-errno", *os.getenv("CLANGFLAGS", "").split())
+LDFLAGS = ("-lm",) + (("-lmvec",) if platform.system() == "Linux" and platform.machine() == "x86_64" else ())
+CLANGCACHEDIR = os.getenv("CLANGCACHEDIR", os.path.join(os.path.expanduser("~"), ".cache", "tinygrad", "clang"))  # set it empty to always compile
+OMP_MIN_SIZE = 16384  # smaller kernels run on one thread
+
+class ClangProgram(CompiledProgram):
+  kernel_count = -1
+  def bind(self, lib:ctypes.CDLL, name:str): self.lib, self.fxn = lib, lib[name]
+
+  # Apple's clang has no OpenMP, there the kernels run on one thread
+  @staticmethod
+  @functools.lru_cache(None)
+  def flags() -> Tuple[str, ...]:
+    try: subprocess.run([CC, *CFLAGS, "-fopenmp", "-x", "c", "-", "-o", os.devnull], input=b"int f(void) { return 0; }", capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError): return CFLAGS
+    return CFLAGS + ("-fopenmp",)
+
+  # -march=native builds for this cpu, so a cache shared between machines is keyed by what the compiler expands the flags to
+  @staticmethod
+  @functools.lru_cache(None)
+  def host_cpu() -> str:
+    try: out = subprocess.run([CC, *ClangProgram.flags(), "-###", "-c", "-x", "c", os.devnull, "-o", os.devnull], capture_output=True, text=True).stderr
+    except OSError: out = ""
+    return ' '.join([platform.machine(), platform.processor(), *sorted(set(t.strip('"\'') for t in out.split() if os.sep not in t))])
+
+  # with no cache dir the libraries go in one temporary directory that is removed when the process exits
+  @staticmethod
+  @functools.lru_cache(None)
+  def tmpdir() -> tempfile.TemporaryDirectory: return tempfile.TemporaryDirectory(prefix="tinygrad_clang_")
+
+  # the shared libraries are cached on disk by the hash of the source, the compiler, the flags and the cpu
+  @staticmethod
+  def libpath(prg:str) -> str: return os.path.join(CLANGCACHEDIR or ClangProgram.tmpdir().name, hashlib.sha256('\0'.join([prg, CC, *ClangProgram.flags(), *LDFLAGS, ClangProgram.host_cpu()]).encode()).hexdigest() + ".so")
+  @staticmethod
+  def cachepath(prg:str, options:Tuple[str, ...]) -> Optional[str]: return ClangProgram.libpath(prg) if CLANGCACHEDIR else None
+
+  @staticmethod
+  def load(fn:str, options:Tuple[str, ...]) -> Optional[ctypes.CDLL]:
+    try: return ctypes.CDLL(fn)
+    except OSError: return None
+
+  @staticmethod
+  def compile(prg:str, options:Tuple[str, ...], fn:Optional[str]) -> ctypes.CDLL:
+    fn = fn or ClangProgram.libpath(prg)
+    ClangProgram.save(fn, lambda f: subprocess.check_output([CC, *ClangProgram.flags(), "-x", "c", "-", "-o", f.name, *LDFLAGS], input=prg.encode()))
+    return ctypes.CDLL(fn)
+
+  def __call__(self, global_size, local_size, *args):
+    ClangProgram.kernel_count += 1
+    self.fxn(*[ctypes.c_void_p(x.ctypes.data) for x in args])
+    if DEBUG >= 1: print(f"**CLANG** {ClangProgram.kernel_count:6d} {self.name:20s} args {len(args):5d}  size {prod(global_size):8d}")
+    if DEBUG >= 4: print(self.prg)
+
+# the same kernels as the GPU, in plain C. the loop over the outputs is split over OpenMP threads and vectorized
+class ClangBuffer(CompiledBuffer):
+  # with gcc on x86_64 linux, glibc's libmvec has vector versions of the math functions so those loops vectorize too
+  # pow is mostly by a constant, that folds away the branches
+  prelude = """#include <math.h>
+#if defined(__GNUC__) && !defined(__clang__) && defined(__x86_64__) && defined(__linux__)
+float expf(float) __attribute__((simd("notinbranch")));
+float logf(float) __attribute__((simd("notinbranch")));
+float powf(float, float) __attribute__((simd("notinbranch")));
+#endif
+static inline float max_(float a, float b) { return a > b ? a : b; }
+static inline float pow_(float a, float b) { return b == -1.0f ? 1.0f/a : (b == 2.0f ? a*a : (b == 0.5f ? sqrtf(a) : powf(a, b))); }
+#define max max_
+#define pow pow_
+#define exp expf
+#define log logf
+#define sign(x) (float)(((x) > 0) - ((x) < 0))
+"""
+  buffer_prefix, inline_prefix = "", "static inline "
+  UNROLL = 1  # the compiler unrolls the loops with constant bounds itself
+  runtime = ClangProgram
+
+  @classmethod
+  def kernel(cls, name:str, args:List[str], body:str, global_size:int, strided:bool=False) -> str:
+    return f"void {name}({','.join(args)}) {{\n#pragma omp parallel for simd if({global_size} >= {OMP_MIN_SIZE})\nfor (int gid = 0; gid < {global_size}; gid++) {{\n{body}\n}}\n}}"
+
+  @property
+  def raw(self):
+    if self._buf is None:
+      self._buf = self._backing if self._backing is not None else np.empty(prod(self._base_shape), dtype=np.float32)
+      self._backing = None
+    return self._buf
+
+  @staticmethod
+  def fromCPU(x): return ClangBuffer(x.shape, backing=x.view(np.ndarray).astype(np.float32).ravel())
+  def toCPU(self): return self.contiguous_op().raw[:prod(self.shape)].reshape(self.shape).copy()
@@ -1,6 +1,11 @@
-import operator
+from __future__ import annotations
+import os, operator
 import numpy as np
-from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Dict, Union
+from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps, WINOGRAD, WINOGRAD_G
+from tinygrad.shapetracker import ShapeTracker, View, ZeroView
+from tinygrad.helpers import prod, winograd_eligible
 
 class CPUBuffer(np.ndarray):
   fxn_for_op = {
@@ -17,6 +22,7 @@ class CPUBuffer(np.ndarray):
   def float(x): return x.astype(np.float32)
   def flip(x, axis): return np.flip(x, axis)
   def amax(x, *args, **kwargs): return np.amax(x, *args, **kwargs)
+  def popvar(x, axis): return x.var(axis, keepdims=True)
   def permute(x, order): return x.transpose(order)
   def custompad(x, padding): return np.pad(x, padding).view(CPUBuffer) if any(x != 0 or y != 0 for x,y in padding) else x
   def expand(x, new_shape): return np.broadcast_to(x, new_shape).view(CPUBuffer)
@@ -27,17 +33,61 @@ class CPUBuffer(np.ndarray):
   def fromCPU(x): return x.view(CPUBuffer)
   def toCPU(x): return x
 
+  # the fused elementwise ops write into preallocated chunks, the middle buffers are never full size
+  CHUNK = 32768
+  ufunc_for_op = {
+    UnaryOps.NOOP: np.positive, UnaryOps.NEG: np.negative, UnaryOps.RELU: lambda x, out: np.maximum(x, 0, out=out),
+    UnaryOps.EXP: np.exp, UnaryOps.LOG: np.log, UnaryOps.SIGN: np.sign,
+    BinaryOps.ADD: np.add, BinaryOps.SUB: np.subtract, BinaryOps.MUL: np.multiply,
+    BinaryOps.DIV: np.true_divide, BinaryOps.POW: np.power, BinaryOps.CMPEQ: np.equal
+  }
+  ufunc_for_pow = {-1.0: np.reciprocal, 0.5: np.sqrt, 1.0: np.positive, 2.0: np.square}
+
+  # ast is nested (op, *srcs) tuples with the names of bufs as leaves
+  # numpy's buffered nditer walks the inputs in CHUNK sized pieces, the broadcasted scalars (constants) are passed to the ufuncs as numbers
+  @staticmethod
+  def fused_op(shape:Tuple[int, ...], ast:Union[str, Tuple], bufs:Dict[str, CPUBuffer]) -> CPUBuffer:
+    inputs = {k:np.broadcast_to(v.resolve(), shape) for k,v in bufs.items()}
+    consts = {k:float(x.flat[0]) for k,x in inputs.items() if x.size > 0 and all(st == 0 for st in x.strides)}
+    names, steps = [k for k in inputs if k not in consts], []
+    def compile(x) -> Tuple[str, Union[int, float]]:
+      if isinstance(x, str): return ("const", consts[x]) if x in consts else ("in", names.index(x))
+      fxn, srcs = CPUBuffer.ufunc_for_op[x[0]], [compile(y) for y in x[1:]]
+      if x[0] == BinaryOps.POW and srcs[1][0] == "const" and srcs[1][1] in CPUBuffer.ufunc_for_pow: fxn, srcs = CPUBuffer.ufunc_for_pow[srcs[1][1]], srcs[:1]
+      steps.append((fxn, srcs))
+      return ("tmp", len(steps)-1)
+    compile(ast)
+
+    def run(ins, tmps):
+      regs = {"in": ins, "tmp": tmps}
+      for (fxn, srcs), out in zip(steps, tmps): fxn(*[v if k == "const" else regs[k][v] for k,v in srcs], out=out)
+      return tmps[-1]
+    if len(steps) == 1 or prod(shape) <= CPUBuffer.CHUNK: return run([inputs[k] for k in names], [np.empty(shape, dtype=np.float32) for _ in steps]).view(CPUBuffer)
+
+    temps = [np.empty(CPUBuffer.CHUNK, dtype=np.float32) for _ in steps[:-1]]
+    it = np.nditer([inputs[k] for k in names] + [None], flags=["external_loop", "buffered", "zerosize_ok"], order="C", itershape=shape,
+                   op_flags=[["readonly"] if i < len(names) else ["writeonly", "allocate"] for i in range(len(names)+1)], op_dtypes=[np.float32]*(len(names)+1), buffersize=CPUBuffer.CHUNK)
+    with it:
+      for chunk in it: run(chunk[:-1], [t[:chunk[-1].shape[0]] for t in temps] + [chunk[-1]])
+      return it.operands[-1].view(CPUBuffer)
+
+  def resolve(x): return x
   def unary_op(x, op): return CPUBuffer.fxn_for_op[op](x)
-  def binary_op(x, op, y): return CPUBuffer.fxn_for_op[op](x, y)
+  def binary_op(x, op, y): return CPUBuffer.fxn_for_op[op](x, y.resolve())
 
   def reduce_op(x, op, new_shape):
     assert len(x.shape) == len(new_shape)
     axis = tuple([i for i,(a,b) in enumerate(zip(x.shape, new_shape)) if a != b])
-    if x.shape == new_shape: return x[:]   # this is just a copy, regardless of the reduce op
+    if x.shape == new_shape: return x - x if op == ReduceOps.VAR else x[:]   # this is just a copy, and the variance of one element is 0
     elif op == ReduceOps.SUM: return x.sum(axis, keepdims=True)
     elif op == ReduceOps.MAX: return x.amax(axis, keepdims=True)
+    elif op == ReduceOps.VAR: return x.popvar(axis)
+
+  # movement ops don't copy, they return a CPUView of the contiguous data
+  def movement_op(x, op, arg=None): return CPUView.create(ShapeTracker(x.shape).movement_op(op, arg), np.ascontiguousarray(x).ravel())
 
-  def movement_op(x, op, arg=None):
+  # NOTE: this is the eager version, TorchBuffer uses it
+  def eager_movement_op(x, op, arg=None):
     if op == MovementOps.RESHAPE: return x.reshape(arg)
     elif op == MovementOps.PERMUTE: return x.permute(arg)
     elif op == MovementOps.FLIP: return x.flip(arg)
@@ -47,11 +97,98 @@ class CPUBuffer(np.ndarray):
     elif op == MovementOps.STRIDED: return x.contiguous().as_strided([x[0] for x in arg], [x[1] for x in arg])
 
   PREPAD = True
+  processing_ops = (ProcessingOps.CONV, ProcessingOps.MATMUL)
+  # the conv is GEMMs over tiles of (image, output rows), the im2col of a tile is at most CONV_TILE floats
+  # numpy releases the GIL in the copies and in BLAS, so the tiles run on a thread pool
+  CONV_TILE = 1 << 18
+  THREADS = os.cpu_count() or 1
+  pool = ThreadPoolExecutor(THREADS)
   def processing_op(x,op,w,C):
+    # BLAS takes the transposed views as they are
+    if op == ProcessingOps.MATMUL: return np.matmul(x.resolve(), w.resolve()).view(CPUBuffer)
     assert op == ProcessingOps.CONV, f"{op} isn't supported"
+    if CPUBuffer.WINOGRAD and winograd_eligible(C): return x.winograd_op(w, C)
+    # if x is a padded CPUView, the pad is the only copy made here
     tx = x.movement_op(MovementOps.STRIDED, (
       (C.bs, C.groups*C.cin*x.shape[2]*x.shape[3]), (C.groups, C.cin*x.shape[2]*x.shape[3]),
-      (C.oy, C.sy*x.shape[3]), (C.ox, C.sx), (C.cin, x.shape[2]*x.shape[3]), (C.H, C.dy*x.shape[3]), (C.W, C.dx)))
-    tw = w.reshape(C.groups, C.rcout, C.cin, C.H, C.W)
-    out = np.einsum("nGhwCHW, GkCHW -> nGkhw", tx.contiguous(), tw.contiguous())
+      (C.oy, C.sy*x.shape[3]), (C.ox, C.sx), (C.cin, x.shape[2]*x.shape[3]), (C.H, C.dy*x.shape[3]), (C.W, C.dx))).resolve()
+    tw = np.ascontiguousarray(w.resolve()).reshape(C.groups, C.rcout, C.cin*C.H*C.W)
+    out = np.empty((C.bs, C.groups, C.rcout, C.oy, C.ox), dtype=np.float32)
+    # a 1x1 conv that doesn't stride is a matmul on the input, the im2col is free
+    direct = C.H == C.W == C.sy == C.sx == 1 and tx.strides[3] == tx.itemsize and tx.strides[2] == C.ox*tx.itemsize
+    rows = max(1, min(C.oy, CPUBuffer.CONV_TILE // (C.ox*C.cin*C.H*C.W)))
+    def tile(n, y):
+      if C.cin == 1 and C.groups > 1:
+        # depthwise, the GEMMs would be tiny. it's a multiply-add per tap over the views of all the groups
+        dst = out[n, :, :, y:y+rows]
+        for i in range(C.H*C.W):
+          tap = tw[:, :, i, None, None] * tx[n, :, None, y:y+rows, :, 0, i//C.W, i%C.W]
+          if i == 0: dst[:] = tap
+          else: dst += tap
+        return
+      for g in range(C.groups):
+        col = tx[n, g, y:y+rows].transpose(2,3,4,0,1).reshape(C.cin, -1) if direct else tx[n, g, y:y+rows].reshape(-1, C.cin*C.H*C.W).T
+        np.matmul(tw[g], col, out=out[n, g, :, y:y+rows].reshape(C.rcout, -1))
+    tiles = [(n, y) for n in range(C.bs) for y in range(0, C.oy, rows)]
+    if len(tiles) == 1 or CPUBuffer.THREADS == 1: [tile(*t) for t in tiles]
+    else: list(CPUBuffer.pool.map(lambda t: tile(*t), tiles))
     return out.reshape(C.bs, C.groups*C.rcout, C.oy, C.ox).view(CPUBuffer)
+
+  # Y = A^T [(G g G^T) * (B^T d B)] A over 4x4 tiles of the input that overlap by 2, the 16 products are batched GEMMs over the channels
+  # the sparse B^T and A^T are adds of strided slices, each image is a tile on the thread pool
+  WINOGRAD = WINOGRAD
+  def winograd_op(x,w,C):
+    ty, tx = (C.oy+1)//2, (C.ox+1)//2
+    x = x.movement_op(MovementOps.PAD, ((0,0), (0,0), (0,max(0, 2*ty+2-x.shape[2])), (0,max(0, 2*tx+2-x.shape[3])))).resolve()
+    tw = np.ascontiguousarray(w.resolve()).reshape(C.groups, C.rcout, C.cin, 3, 3)
+    tu = np.einsum("ak,gockl,bl->abgoc", WINOGRAD_G, tw, WINOGRAD_G).reshape(16, C.groups, C.rcout, C.cin)
+    out = np.empty((C.bs, C.groups*C.rcout, C.oy, C.ox), dtype=np.float32)
+    def bt(d, out):
+      np.subtract(d[0], d[2], out=out[0]); np.add(d[1], d[2], out=out[1]); np.subtract(d[2], d[1], out=out[2]); np.subtract(d[1], d[3], out=out[3])
+      return out
+    def tile(n):
+      e = bt([x[n, :, k:k+2*ty:2] for k in range(4)], np.empty((4, C.groups*C.cin, ty, x.shape[3]), dtype=np.float32))
+      tv = bt([e[..., k:k+2*tx:2] for k in range(4)], np.empty((4, 4, C.groups*C.cin, ty, tx), dtype=np.float32).transpose(1,0,2,3,4))
+      m = np.matmul(tu, tv.transpose(1,0,2,3,4).reshape(16, C.groups, C.cin, ty*tx)).reshape(4, 4, C.groups*C.rcout, ty, tx)
+      for i,a in enumerate([m[0]+m[1]+m[2], m[1]-m[2]-m[3]]):
+        for j,y in enumerate([a[0]+a[1]+a[2], a[1]-a[2]-a[3]]):
+          out[n, :, i::2, j::2] = y[:, :(C.oy-i+1)//2, :(C.ox-j+1)//2]
+    if C.bs == 1 or CPUBuffer.THREADS == 1: [tile(n) for n in range(C.bs)]
+    else: list(CPUBuffer.pool.map(tile, range(C.bs)))
+    return out.view(CPUBuffer)
+
+def as_view(flat:np.ndarray, v:View) -> np.ndarray: return np.lib.stride_tricks.as_strided(flat[v.offset:], shape=v.shape, strides=[s*flat.itemsize for s in v.strides], writeable=False)
+
+# a ShapeTracker over the flat contiguous data of a CPUBuffer. the array itself is a zero strided placeholder with the right shape
+class CPUView(CPUBuffer):
+  st : ShapeTracker
+  src : np.ndarray
+  @staticmethod
+  def create(st:ShapeTracker, src:np.ndarray) -> CPUView:
+    ret = np.broadcast_to(np.zeros((), dtype=src.dtype), st.shape).view(CPUView)
+    ret.st, ret.src = st, src
+    return ret
+
+  def __repr__(x): return f"<CPUView {x.st.views}>"
+  def movement_op(x, op, arg=None): return CPUView.create(ShapeTracker(x.st).movement_op(op, arg), x.src)
+
+  # the Views are strided numpy views of the data before them, a ZeroView is the only copy
+  def resolve(x) -> CPUBuffer:
+    ret, views = x.src, x.st.views
+    for i,v in enumerate(views):
+      if isinstance(v, ZeroView): continue
+      ret = np.ascontiguousarray(ret).ravel()
+      if i+1 < len(views) and isinstance(zv := views[i+1], ZeroView):
+        old = View(zv.old_shape, v.strides, v.offset - sum(st*a for st,(a,_) in zip(v.strides, zv.arg)))
+        out = np.zeros(zv.shape, dtype=ret.dtype)
+        out[tuple(slice(max(0,a)-a, min(s,b)-a) for s,(a,b) in zip(zv.old_shape, zv.arg))] = \
+          as_view(ret, old)[tuple(slice(max(0,a), min(s,b)) for s,(a,b) in zip(zv.old_shape, zv.arg))]
+        ret = out.ravel()
+      else:
+        ret = as_view(ret, v)
+    return ret.view(CPUBuffer)
+
+  def toCPU(x): return np.asarray(x.resolve())
+  def unary_op(x, op): return x.resolve().unary_op(op)
+  def binary_op(x, op, y): return x.resolve().binary_op(op, y)
+  def reduce_op(x, op, new_shape): return x.resolve().reduce_op(op, new_shape)
@@ -1,29 +1,49 @@
 from __future__ import annotations
-import os, functools
+import os, hashlib, tempfile, json, itertools
 import numpy as np
 import pyopencl as cl  # type: ignore
-from collections import defaultdict
-from typing import List, Tuple, Optional, Dict, Union, Set, Tuple
-from tinygrad.helpers import prod, ConvArgs
-from tinygrad.ops import DEBUG, UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps
-from tinygrad.shapetracker import ShapeTracker, View, strides_for_shape
+from collections import defaultdict, OrderedDict
+from typing import List, Tuple, Optional, Dict, Callable
+from tinygrad.helpers import prod
+from tinygrad.ops import DEBUG, ProcessingOps
+from tinygrad.llops.compiled import CompiledProgram, CompiledBuffer
 
 CLCACHE = int(os.getenv("CLCACHE", "1"))
+CLCACHELIMIT = int(os.getenv("CLCACHELIMIT", "0"))  # the most bytes the free buffer pool holds, 0 is no limit
+CLCACHEDIR = os.getenv("CLCACHEDIR", os.path.join(os.path.expanduser("~"), ".cache", "tinygrad", "cl"))  # set it empty to always compile
+CLTUNE = int(os.getenv("CLTUNE", "0"))  # time the launches of the kernels that aren't in the tuning database, and save the fastest
+CLTUNEDB = os.getenv("CLTUNEDB", os.path.join(os.path.expanduser("~"), ".cache", "tinygrad", "cltune.json"))  # set it empty to not persist
 class CLBuffer:
   def __init__(self, size):
-    if len(CL.BUFFER_CACHE[size]) > 0: self.cl = CL.BUFFER_CACHE[size].pop()
+    if len(CL.BUFFER_CACHE[size]) > 0:
+      self.cl = CL.BUFFER_CACHE[size].pop()
+      del CL.BUFFER_LRU[id(self.cl)]
+      CL.mem_cached -= size
     else:
+      try:
+        self.cl = cl.Buffer(CL().cl_ctx, cl.mem_flags.READ_WRITE, size)
+      except cl.MemoryError:
+        CL.flush_buffer_cache()
+        self.cl = cl.Buffer(CL().cl_ctx, cl.mem_flags.READ_WRITE, size)
       CL.mem_used += size
-      # TODO: on GPU OOM, clear the cache
-      self.cl = cl.Buffer(CL().cl_ctx, cl.mem_flags.READ_WRITE, size)
+      CL.mem_high = max(CL.mem_high, CL.mem_used)
 
   def __del__(self):
-    if CLCACHE: CL.BUFFER_CACHE[self.cl.size].append(self.cl)
+    # if the allocation failed, there's nothing to free
+    if getattr(self, "cl", None) is None: return
+    if CLCACHE:
+      CL.BUFFER_CACHE[self.cl.size].append(self.cl)
+      CL.BUFFER_LRU[id(self.cl)] = self.cl
+      CL.mem_cached += self.cl.size
+      # evict the least recently freed buffers, of any size
+      while CLCACHELIMIT and CL.mem_cached > CLCACHELIMIT: CL.evict_buffer()
     else: CL.mem_used -= self.cl.size
 
 class CL:
-  CACHE, kernel_count, mem_used = None, -1, 0
+  CACHE, kernel_count = None, -1
+  mem_used, mem_cached, mem_high = 0, 0, 0  # bytes allocated on the device (including the free pool), bytes in the free pool, and the most ever allocated
   BUFFER_CACHE : Dict[int, List[cl.Buffer]] = defaultdict(list)
+  BUFFER_LRU : OrderedDict[int, cl.Buffer] = OrderedDict()  # the same buffers as BUFFER_CACHE, least recently freed first
   cl_ctx : Optional[cl.Context] = None
   cl_queue : Optional[cl.CommandQueue] = None
   def __init__(self):
@@ -35,50 +55,206 @@ class CL:
     if len(devices) > 1 or DEBUG >= 1: print(f"using {CL.cl_ctx.devices}")
     CL.cl_queue = cl.CommandQueue(self.cl_ctx, properties=cl.command_queue_properties.PROFILING_ENABLE)  # this is an in-order command queue
 
+  @staticmethod
+  def context() -> cl.Context:
+    if CL.cl_ctx is None: CL()
+    assert CL.cl_ctx is not None
+    return CL.cl_ctx
+
+  @staticmethod
+  def queue() -> cl.CommandQueue:
+    if CL.cl_queue is None: CL()
+    assert CL.cl_queue is not None
+    return CL.cl_queue
+
+  # NOTE: this drops the pool's reference, the memory is freed once nothing else (like CL.CACHE) holds the buffer
+  @staticmethod
+  def evict_buffer():
+    _, buf = CL.BUFFER_LRU.popitem(last=False)
+    CL.BUFFER_CACHE[buf.size].remove(buf)
+    CL.mem_cached -= buf.size
+    CL.mem_used -= buf.size
+
+  @staticmethod
+  def flush_buffer_cache():
+    while len(CL.BUFFER_LRU): CL.evict_buffer()
+
   @staticmethod
   def enqueue_copy(a, b, is_blocking=False):
     if CL.CACHE is not None: assert False, "can't copy while caching"
     if DEBUG >= 1: print(f"**CL**        copy in {b.shape}" if isinstance(b, np.ndarray) else f"**CL**        copy OUT {a.shape}")
     cl.enqueue_copy(CL().cl_queue, a, b, is_blocking=is_blocking)
 
-@functools.lru_cache(maxsize=None)
-class CLProgram:
-  kernel_cnt = 0
-  def __init__(self, name:str, prg:str, options:Tuple[str, ...]=tuple(), argdtypes=None):
-    self.name, self.prg, self.options, self.argdtypes = f"{name}_{CLProgram.kernel_cnt}", prg.replace(f"{name}(", f"{name}_{CLProgram.kernel_cnt}("), options, argdtypes
-    self.clprogram = cl.Program(CL().cl_ctx, self.prg)
-    self.clprg = self.clprogram.build(options=list(self.options)).__getattr__(self.name)
+class CLProgram(CompiledProgram):
+  def bind(self, lib:cl.Program, name:str):
+    self.clprogram, self.clprg = lib, lib.__getattr__(name)
     if self.argdtypes is not None: self.clprg.set_scalar_arg_dtypes(self.argdtypes)
-    CLProgram.kernel_cnt += 1
+
+  # the binaries are cached on disk, the driver version is in the key so a driver update recompiles
+  @staticmethod
+  def cachepath(prg:str, options:Tuple[str, ...]) -> Optional[str]:
+    if not CLCACHEDIR: return None
+    device = CL.context().devices[0]
+    return os.path.join(CLCACHEDIR, hashlib.sha256('\0'.join([prg, *options, device.name, device.platform.version, device.driver_version]).encode()).hexdigest())
+
+  @staticmethod
+  def load(fn:str, options:Tuple[str, ...]) -> Optional[cl.Program]:
+    try:
+      with open(fn, "rb") as f: return cl.Program(CL.context(), CL.context().devices[:1], [f.read()]).build(options=list(options))
+    except cl.Error: return None
+
+  @staticmethod
+  def compile(prg:str, options:Tuple[str, ...], fn:Optional[str]) -> cl.Program:
+    ret = cl.Program(CL.context(), prg).build(options=list(options))
+    try:
+      if fn is not None: CLProgram.save(fn, lambda f: f.write(ret.get_info(cl.program_info.BINARIES)[0]))
+    except OSError: pass
+    return ret
+
   def __call__(self, *args):
     CL.kernel_count += 1
     if CL.CACHE is not None: CL.CACHE.append((self, args))
-    else: e = self.clprg(CL().cl_queue, *args)
+    else:
+      try:
+        e = self.clprg(CL().cl_queue, *args)
+      except cl.MemoryError:   # the buffers are allocated on first use, free the pool and try again
+        CL.flush_buffer_cache()
+        e = self.clprg(CL().cl_queue, *args)
     if DEBUG >= 2: CL.cl_queue.finish()
     if DEBUG >= 1:
       print(f"**CL** {CL.kernel_count:6d} {self.name:20s} args {len(args[2:]):5d}  size {prod(args[0]):8d}  kernels {str(args[0]):20s} {str(args[1]):20s}" + \
             ("" if DEBUG <= 1 or CL.CACHE is not None else f"runtime {(e.profile.end - e.profile.start)/1e3:9.2f} us"))
     if DEBUG >= 4: print(self.prg)
 
+# the winning launch of each (kernel, global size) on a device is kept in a json database, later runs use it without timing anything
+class CLTuner:
+  db : Optional[Dict[str, list]] = None
+  launches : Dict[Tuple, Tuple[CLProgram, int, Optional[int]]] = {}  # the program, threads and local size picked for each launch
+  WPTS, LOCAL_SIZES = (1, 2, 4, 8), (16, 32, 64, 128, 256)
+  device : Optional[str] = None
+
+  @staticmethod
+  def key(prg:str, global_size) -> str:
+    if CLTuner.device is None:
+      device = CL.context().devices[0]
+      CLTuner.device = '\0'.join([device.name, device.platform.version, device.driver_version])
+    return hashlib.sha256('\0'.join([prg, CLTuner.device, str(list(global_size))]).encode()).hexdigest()
+
+  @staticmethod
+  def load() -> Dict[str, list]:
+    if CLTuner.db is None:
+      CLTuner.db = {}
+      try:
+        if CLTUNEDB and os.path.isfile(CLTUNEDB):
+          with open(CLTUNEDB) as f: CLTuner.db = json.load(f)
+      except (OSError, ValueError): pass   # a corrupt database is tuned again
+    return CLTuner.db
+
+  # the database on disk is reread so tuning in several processes at once doesn't lose entries
+  @staticmethod
+  def save(key:str, value:list):
+    db = CLTuner.load()
+    db[key] = value
+    if not CLTUNEDB: return
+    dirname = os.path.dirname(os.path.abspath(CLTUNEDB))
+    try:
+      os.makedirs(dirname, exist_ok=True)
+      with open(CLTUNEDB) as f: db = CLTuner.db = {**json.load(f), **db}
+    except (OSError, ValueError): pass
+    try:
+      with tempfile.NamedTemporaryFile("w", dir=dirname, delete=False) as tmp: json.dump(db, tmp)
+      os.replace(tmp.name, CLTUNEDB)
+    except OSError: pass
+
+  # the fastest of a few runs in ns, inf if the device can't launch it like this
+  @staticmethod
+  def time(prg:CLProgram, global_size, local_size, *args, runs=3) -> float:
+    try:
+      events = [prg.clprg(CL.queue(), global_size, local_size, *args) for _ in range(runs)]
+    except (cl.LogicError, cl.RuntimeError): return float('inf')   # INVALID_WORK_GROUP_SIZE or OUT_OF_RESOURCES
+    CL.queue().finish()
+    return min(e.profile.end - e.profile.start for e in events)
+
+  @staticmethod
+  def local_sizes(global_size, exact=False) -> List[Optional[Tuple[int, ...]]]:
+    mx = CL.context().devices[0].max_work_group_size
+    axes = [sorted(set(l for l in [1, 4, 16, 64, 256, g] if l <= min(g, mx) and (not exact or g%l == 0))) for g in global_size]
+    return [None] + [l for l in itertools.product(*axes) if prod(l) <= mx]
+
+  # the local size for a program with fixed global size, like the ones in CL.CACHE. exact only picks local sizes that divide it
+  @staticmethod
+  def local_size(prg:CLProgram, global_size, *args, exact=False) -> Optional[Tuple[int, ...]]:
+    key = CLTuner.key('\0'.join([prg.prg, *prg.options, str(exact)]), global_size)
+    if key not in CLTuner.load():
+      runtime, local_size = min([(CLTuner.time(prg, global_size, l, *args), l) for l in CLTuner.local_sizes(global_size, exact)], key=lambda x: x[0])
+      CLTuner.save(key, [None if local_size is None else list(local_size), runtime])
+    best = CLTuner.load()[key][0]
+    return None if best is None else tuple(best)
+
+  # a generated kernel does global_size gids, each of threads rounded up to the local size strides over wpt of them
+  @staticmethod
+  def threads(global_size:int, wpt:int, local_size:Optional[int]) -> int:
+    threads = (global_size+wpt-1)//wpt
+    return threads if local_size is None else (threads+local_size-1)//local_size*local_size
+
+  # source is what render(strided) is made of, a kernel that runs again with the same global size isn't rendered or hashed
+  @staticmethod
+  def launch(name:str, source:Tuple[str, ...], render:Callable[[bool], str], global_size:int, *bufs):
+    key = (name, global_size, *source)
+    if key not in CLTuner.launches: CLTuner.launches[key] = CLTuner.pick(name, render, global_size, *bufs)
+    prg, threads, local_size = CLTuner.launches[key]
+    prg([threads, 1, 1], None if local_size is None else [local_size, 1, 1], *bufs)
+
+  @staticmethod
+  def pick(name:str, render:Callable[[bool], str], global_size:int, *bufs) -> Tuple[CLProgram, int, Optional[int]]:
+    argdtypes = tuple(None for _ in bufs)
+    key = CLTuner.key(render(False), [global_size])
+    if key not in CLTuner.load() and CLTUNE:
+      mx = CL.context().devices[0].max_work_group_size
+      runtimes = []
+      for wpt, local_size in itertools.product(CLTuner.WPTS, (None,)+CLTuner.LOCAL_SIZES):
+        # every thread gets a gid and a workgroup fits in the device
+        if (wpt > 1 and global_size < 2*wpt) or (local_size is not None and (local_size > mx or local_size > (global_size+wpt-1)//wpt)): continue
+        threads = CLTuner.threads(global_size, wpt, local_size)
+        prg = CLProgram(name, render(threads != global_size), argdtypes=argdtypes)
+        runtimes.append((CLTuner.time(prg, [threads, 1, 1], None if local_size is None else [local_size, 1, 1], *bufs), wpt, local_size))
+      CLTuner.save(key, list(min(runtimes, key=lambda x: x[0])[1:]))
+    db = CLTuner.load()
+    wpt, local_size = db[key] if key in db else (1, None)
+    threads = CLTuner.threads(global_size, wpt, local_size)
+    return CLProgram(name, render(threads != global_size), argdtypes=argdtypes), threads, local_size
+
 # **** end CL wrappers ****
 
-class GPUBuffer:
-  code_for_op = {
-    UnaryOps.NOOP: "(A)", UnaryOps.NEG: "(-(A))", UnaryOps.RELU: "max(A, (float)0.)", UnaryOps.EXP: "exp(A)", UnaryOps.LOG: "log(A)", UnaryOps.SIGN: "sign(A)",
-    BinaryOps.ADD: "(A+B)", BinaryOps.SUB: "(A-B)", BinaryOps.MUL: "(A*B)", BinaryOps.DIV: "(A/B)", BinaryOps.POW: "pow(A,B)", BinaryOps.CMPEQ: "(A==B)",
-    ReduceOps.SUM: "(acc + A)", ReduceOps.MAX: "max(A, acc)"
-  }
-  start_for_op = {ReduceOps.SUM: "0.0", ReduceOps.MAX: "-INFINITY"}
-
-  def __init__(self, shape:Union[ShapeTracker, Tuple[int, ...]], hostbuf:Optional[GPUBuffer]=None, backing:Optional[np.ndarray]=None):
-    self.st = shape if isinstance(shape, ShapeTracker) else ShapeTracker(tuple(shape))
-    self.shape = self.st.shape
-    self._buf : Optional[CLBuffer] = hostbuf._buf if hostbuf is not None else None
-    self._base_shape : Tuple[int, ...] = hostbuf._base_shape if hostbuf is not None else self.shape
-    self._backing : Optional[np.ndarray] = hostbuf._backing if hostbuf is not None else backing
-    # early copy in for large buffers
-    if self._backing is not None and self._backing.shape != (1,): self.cl
-  
+class GPUBuffer(CompiledBuffer):
+  runtime = CLProgram
+  LOCAL_SIZE = 256
+  SUPPORTS_PADDING = True
+  processing_ops = (ProcessingOps.CONV, ProcessingOps.MATMUL)
+  FLOAT4 = bool(int(os.getenv("CLFLOAT4", "1")))
+  # a CPU device runs the work-items of a workgroup one after another, so it only reduces and multiplies in workgroups when these are set
+  LOCAL_REDUCE : Optional[bool] = None if os.getenv("CLLOCALREDUCE") is None else bool(int(os.getenv("CLLOCALREDUCE", "0")))
+  LOCAL_GEMM : Optional[bool] = None if os.getenv("CLLOCALGEMM") is None else bool(int(os.getenv("CLLOCALGEMM", "0")))
+  # an eligible 3x3 conv as winograd's mul and reduce, it's slower than the tiled kernel on pocl so it's opt in
+  WINOGRAD_CONV = bool(int(os.getenv("CLWINOGRAD", "0")))
+
+  @classmethod
+  def kernel(cls, name:str, args:List[str], body:str, global_size:int, strided:bool=False) -> str:
+    if not strided: return f"__kernel void {name}({','.join(args)}) {{ int gid = get_global_id(0);\n{body}\n}}"
+    return f"__kernel void {name}({','.join(args)}) {{ for (int gid = get_global_id(0); gid < {global_size}; gid += get_global_size(0)) {{\n{body}\n}}}}"
+
+  @classmethod
+  def launch(cls, name:str, prg:str, args:List[str], body:str, global_size:int, *bufs):
+    CLTuner.launch(name, (prg, *args, body), lambda strided: prg + cls.kernel(name, args, body, global_size, strided), global_size, *bufs)
+
+  @classmethod
+  def reduce_strategy(cls, outputs:int, rsize:int) -> Tuple[str, int]:
+    if not (cls.LOCAL_REDUCE if cls.LOCAL_REDUCE is not None else CL.context().devices[0].type != cl.device_type.CPU): return "serial", 1
+    return super().reduce_strategy(outputs, rsize)
+
+  @classmethod
+  def local_gemm(cls) -> bool: return cls.LOCAL_GEMM if cls.LOCAL_GEMM is not None else CL.context().devices[0].type != cl.device_type.CPU
+
   @property
   def cl(self):
     if self._buf is None: self._buf = CLBuffer(4*prod(self._base_shape))
@@ -87,7 +263,8 @@ class GPUBuffer:
       self._backing = None
     return self._buf.cl
 
-  def __repr__(self): return f"<GPUBuffer with shape {self.shape!r}>"
+  @property
+  def raw(self): return self.cl
 
   @staticmethod
   def fromCPU(x): return GPUBuffer(x.shape, backing=x.view(np.ndarray).astype(np.float32).ravel())
@@ -96,51 +273,3 @@ class GPUBuffer:
     data = np.empty(self.shape, dtype=np.float32)
     CL.enqueue_copy(data, self.contiguous_op().cl, is_blocking=True)
     return data
-
-  def contiguous_view(x, name:str) -> str:
-    return f"inline float get_{name}(__global const float *x, int gid) {{ int valid = 1; int idx = gid; {x.st.expr().replace('//', '/')}; return valid ? x[idx] : 0.0;}}"
-
-  def contiguous_view_constant_fold(x, name:str) -> Tuple[str, bool]:
-    if x._base_shape == (1,) and x._backing is not None:
-      return f"inline float get_{name}(int gid) {{ int valid = 1; int idx = gid; {x.st.expr().replace('//', '/')}; return valid ? {x._backing[0]} : 0.0;}}", False
-    else:
-      return x.contiguous_view(name), True
-
-  def unary_op(x, op:UnaryOps): return type(x)(x.shape)._processing_op([("A", x)], GPUBuffer.code_for_op[op])
-  def binary_op(x, op:BinaryOps, y:GPUBuffer): return type(x)(x.shape)._processing_op([("A", x), ("B", y)], GPUBuffer.code_for_op[op])
-  def contiguous_op(x): return x if x.st.contiguous else x.unary_op(UnaryOps.NOOP)
-  def movement_op(x, op:MovementOps, arg) -> GPUBuffer: return type(x)(ShapeTracker(x.st).movement_op(op, arg), x)
-  def reduce_op(x, op:ReduceOps, new_shape:Tuple[int, ...]): return type(x)(new_shape)._processing_op([("A", x)], code="acc", earlycode=GPUBuffer.code_for_op[op], earlybufs=set("A"), start=GPUBuffer.start_for_op[op])
-
-  #REQUIRES_SIMPLE_REDUCE = True
-  def _processing_op(ret, bufs: List[Tuple[str, GPUBuffer]]=[], code:str="acc", C:Optional[ConvArgs]=None, start="0.0", reduce_shape=None, earlybufs:Set[str]=set(), earlycode:str="acc") -> GPUBuffer:
-    assert C is None
-
-    # this takes a ret index to an inp index, indexing 0 on the reduced strides
-    # if it's not a reduce, this should be a NOOP
-    reduce_shape = (bufs[0][1].shape, ret.shape) if reduce_shape is None else reduce_shape
-    view = View(reduce_shape[1], strides_for_shape(reduce_shape[0]))
-    loop : List[Tuple[str, str]] = []
-    if reduce_shape[1] != reduce_shape[0]:   # this is a reduce
-      # reverse operation of expand, this validates inputs
-      # generate loops with combined adjacent reduce axis
-      acc = 1
-      for shp,stride in ShapeTracker(reduce_shape[1]).movement_op(MovementOps.EXPAND, reduce_shape[0]).views[-1].shape_strides[::-1]:
-        if stride == 0: loop.append((f"for (int axis_{len(loop)} = 0; axis_{len(loop)} < {shp}; axis_{len(loop)}++) {{", f"idx += {acc}; }} idx -= {shp*acc};"))
-        acc *= shp
-
-    kernel_name = "reduce" if len(loop) > 0 else "elementwise"
-    views = {name:buf.contiguous_view_constant_fold(name) for name, buf in bufs}
-    buf_types = [f"__global const float *{name}_g" for name, _ in bufs if name not in views or views[name][1]] 
-    conv_prg = CLProgram(kernel_name, f"""{chr(10).join([x[0] for x in views.values()])}
-    __kernel void {kernel_name}({','.join(["__global float* restrict output"] + buf_types)}) {{ 
-      float acc = {start}; int gid = get_global_id(0); int idx = gid; {view.expr.replace('//', '/')};
-      {' '.join([ls for ls, _ in loop[::-1]])}
-{chr(10).join([f'        float {name} = ' + (f'get_{name}({name}_g, idx);' if views[name][1] else f'get_{name}(idx);') for name, _ in bufs if name in earlybufs])}
-        acc = {earlycode};
-      {' '.join([le for _, le in loop])} idx = gid;
-{chr(10).join([f'      float {name} = ' + (f'get_{name}({name}_g, idx);' if views[name][1] else f'get_{name}(idx);') for name, _ in bufs if name not in earlybufs])}
-      output[gid] = {code};
-    }}""", argdtypes=tuple(None if i < 1+len(buf_types) else np.int32 for i in range(1+len(buf_types))))
-    conv_prg([prod(ret.shape), 1, 1], None, ret.cl, *[buf.cl for name, buf in bufs if name not in views or views[name][1]])
-    return ret
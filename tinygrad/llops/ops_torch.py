@@ -5,13 +5,17 @@ from tinygrad.ops import MovementOps, ProcessingOps
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 class TorchBuffer(torch.Tensor):
   def custompad(x, padding): return torch.nn.functional.pad(x, [item for sublist in padding[::-1] for item in sublist])
+  def popvar(x, axis): return x.var(axis, unbiased=False, keepdim=True)
 
   @staticmethod
   def fromCPU(data): return TorchBuffer(torch.from_numpy(data).requires_grad_(False)).to(device)
   def toCPU(x): return x.cpu().numpy()
 
-  unary_op, binary_op, reduce_op, movement_op = CPUBuffer.unary_op, CPUBuffer.binary_op, CPUBuffer.reduce_op, CPUBuffer.movement_op
+  unary_op, binary_op, reduce_op, movement_op = CPUBuffer.unary_op, CPUBuffer.binary_op, CPUBuffer.reduce_op, CPUBuffer.eager_movement_op
+  def resolve(x): return x
 
+  processing_ops = (ProcessingOps.CONV, ProcessingOps.MATMUL)
   def processing_op(x,op,w,C):
+    if op == ProcessingOps.MATMUL: return torch.matmul(x, w)
     assert op == ProcessingOps.CONV, f"{op} isn't supported"
     return torch.conv2d(x, w, stride=(C.sy, C.sx), groups=C.groups, dilation=(C.dy, C.dx))
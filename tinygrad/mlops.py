@@ -1,4 +1,4 @@
-from tinygrad.helpers import prod, argsort, reduce_shape, get_conv_args
+from tinygrad.helpers import prod, argsort, reduce_shape, get_conv_args, get_matmul_args
 from tinygrad.ops import UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps
 from tinygrad.tensor import Function
 
@@ -61,6 +61,20 @@ class Max(Function):
     grad_output_expanded = grad_output.movement_op(MovementOps.EXPAND, input.shape)
     return max_is_amount.binary_op(BinaryOps.MUL, grad_output_expanded)
 
+# population variance, computed in one pass by the llops
+class Var(Function):
+  def forward(ctx, input, axis=None):
+    shape = reduce_shape(input.shape, axis)
+    # the mean reduces the same input, realized with the variance it's a sibling in the same kernel
+    ctx.save_for_backward(input, input.reduce_op(ReduceOps.SUM, shape).binary_op(BinaryOps.MUL, input.const(prod(shape)/prod(input.shape), shape)))
+    return input.reduce_op(ReduceOps.VAR, shape)
+
+  def backward(ctx, grad_output):
+    input, mean = ctx.saved_tensors
+    # 2*(x-mean)/n, the gradient through the mean sums to zero
+    grad_output_scaled = grad_output.binary_op(BinaryOps.MUL, input.const(2*prod(grad_output.shape)/prod(input.shape), grad_output.shape)).movement_op(MovementOps.EXPAND, input.shape)
+    return input.binary_op(BinaryOps.SUB, mean.movement_op(MovementOps.EXPAND, input.shape)).binary_op(BinaryOps.MUL, grad_output_scaled)
+
 # ************* binary ops *************
 
 class Add(Function):
@@ -187,3 +201,19 @@ class Conv2D(Function):
       dw = xdw.processing_op(ProcessingOps.CONV, grad_output_dw, Cdw).movement_op(MovementOps.PERMUTE, (1,0,2,3))
 
     return dx, dw
+
+class Matmul(Function):
+  def forward(ctx, x, w):
+    ctx.save_for_backward(x, w)
+    return x.processing_op(ProcessingOps.MATMUL, w, get_matmul_args(x.shape, w.shape))
+
+  def backward(ctx, grad_output):
+    x, w = ctx.saved_tensors
+    dx, dw = None, None
+    if ctx.needs_input_grad[0]:   # dx = grad_output @ w^T
+      wt = w.movement_op(MovementOps.PERMUTE, (0,2,1))
+      dx = grad_output.processing_op(ProcessingOps.MATMUL, wt, get_matmul_args(grad_output.shape, wt.shape))
+    if ctx.needs_input_grad[1]:   # dw = x^T @ grad_output
+      xt = x.movement_op(MovementOps.PERMUTE, (0,2,1))
+      dw = xt.processing_op(ProcessingOps.MATMUL, grad_output, get_matmul_args(xt.shape, grad_output.shape))
+    return dx, dw
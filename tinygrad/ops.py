@@ -1,20 +1,21 @@
 from __future__ import annotations
 from enum import Enum
-from typing import Optional, Tuple, NamedTuple, Union, Any, List, Dict, Type
+from typing import Optional, Tuple, NamedTuple, Union, Any, List, Dict, Type, Callable, Set
 from copy import copy
-import os, sys, functools, itertools, operator, weakref
-from tinygrad.helpers import ConvArgs, get_available_llops, prod
+import os, sys, time, itertools, weakref, contextlib
+import numpy as np
+from tinygrad.helpers import ConvArgs, MatmulArgs, get_available_llops, prod, winograd_eligible
 from tinygrad.shapetracker import ShapeTracker
 
-# lazy can recurse a lot
+# the realize is scheduled with a loop, but the LazyOp ASTs can still recurse a lot
 sys.setrecursionlimit(10000)
 
 # these are the llops your accelerator must implement, along with toCpu
 UnaryOps = Enum("UnaryOps", ["NOOP", "NEG", "RELU", "EXP", "LOG", "SIGN"])
 BinaryOps = Enum("BinaryOps", ["ADD", "SUB", "MUL", "DIV", "POW", "CMPEQ"])
-ReduceOps = Enum("ReduceOps", ["SUM", "MAX"])
+ReduceOps = Enum("ReduceOps", ["SUM", "MAX", "VAR"])
 MovementOps = Enum("MovementOps", ["RESHAPE", "PERMUTE", "EXPAND", "FLIP", "STRIDED", "PAD", "SHRINK"])
-ProcessingOps = Enum("ProcessingOps", ["CONV"])
+ProcessingOps = Enum("ProcessingOps", ["CONV", "MATMUL"])
 LoadOps = Enum("LoadOps", ["FROMCPU"])
 
 Op = Union[UnaryOps, BinaryOps, ReduceOps, MovementOps, ProcessingOps, LoadOps]
@@ -24,12 +25,54 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 GRAPH = int(os.getenv("GRAPH", "0"))
 OPT = int(os.getenv("OPT", "1"))
 NOCONV = int(os.getenv("NOCONV", "0"))
+WINOGRAD = int(os.getenv("WINOGRAD", "1"))
+# the transforms of Winograd F(2x2,3x3), up here so the llops can import them like WINOGRAD
+WINOGRAD_BT = np.array([[1,0,-1,0], [0,1,1,0], [0,-1,1,0], [0,1,0,-1]], dtype=np.float32)
+WINOGRAD_G = np.array([[1,0,0], [0.5,0.5,0.5], [0.5,-0.5,0.5], [0,0,1]], dtype=np.float32)
+WINOGRAD_AT = np.array([[1,1,1,0], [0,1,-1,-1]], dtype=np.float32)
+
+# **** graph rewrite passes ****
+
+# a pass is a rewrite pattern over the graph, it returns the rewrite or None if it doesn't match. OPT picks which are enabled
+class GraphPass:
+  def __init__(self, fxn:Callable, opt:int):
+    self.fxn, self.name, self.enabled = fxn, fxn.__name__, OPT>=opt
+    self.calls, self.hits, self.tm = 0, 0, 0.0
+
+  def __call__(self, *args) -> Any:
+    if not self.enabled: return None
+    st = time.perf_counter()
+    ret = self.fxn(*args)
+    self.calls, self.hits, self.tm = self.calls+1, self.hits+(ret is not None), self.tm+time.perf_counter()-st
+    return ret
 
-# TODO: movement ops that only change shape are really nops. treat them as such
-REMOVE_MOVEMENT_NOPS, MERGE_UNARY_OPS, MERGE_ELEMENTWISE_INTO_REDUCE = OPT>=1, OPT>=1, OPT>=1
-MERGE_ELEMENTWISE_OPS, MERGE_ONE_REDUCE_INTO_ELEMENTWISE = OPT>=2, OPT>=2
-SHUFFLE_MOVEMENT_OPS = OPT>=3
-SHUFFLE_PAD_OPS = OPT>=4  # NOTE: 0/0 is NaN if you pad, so this can change the output
+class Passes:
+  registry : Dict[str, GraphPass] = {}
+
+  @staticmethod
+  def register(opt:int) -> Callable[[Callable], GraphPass]:
+    def _register(fxn:Callable) -> GraphPass:
+      Passes.registry[fxn.__name__] = ret = GraphPass(fxn, opt)
+      return ret
+    return _register
+
+  # with Passes.enable(merge_elementwise_ops=True, shuffle_movement_ops=False): ...
+  @staticmethod
+  @contextlib.contextmanager
+  def enable(**passes:bool):
+    old = {k:Passes.registry[k].enabled for k in passes}
+    for k,v in passes.items(): Passes.registry[k].enabled = v
+    try: yield
+    finally:
+      for k,v in old.items(): Passes.registry[k].enabled = v
+
+  @staticmethod
+  def stats() -> Dict[str, Dict[str, Union[bool, int, float]]]:
+    return {k:{"enabled": p.enabled, "calls": p.calls, "hits": p.hits, "ms": p.tm*1e3} for k,p in Passes.registry.items()}
+
+  @staticmethod
+  def reset_stats():
+    for p in Passes.registry.values(): p.calls, p.hits, p.tm = 0, 0, 0.0
 
 # **** enumerate supported devices ****
 
@@ -104,109 +147,311 @@ def _ast(x: Union[LazyBuffer, LazyOp], buf_names: Dict[LazyBuffer, str], code_fo
   if len(srcs_code) >= 2: code = code.replace("B", srcs_code[1])
   return code
 
+# the same ast with the buffers replaced by their names, for backends that don't render code
+def _ast_tuple(x: Union[LazyBuffer, LazyOp], buf_names: Dict[LazyBuffer, str]) -> Union[str, Tuple]:
+  return buf_names[x] if isinstance(x, LazyBuffer) else (x.op, *[_ast_tuple(src, buf_names) for src in x.src])
+
 # **** realize functions ****
+# these plan the realization of a LazyBuffer without realizing anything
+# they return the LazyBuffers that have to be realized first, and the function that runs once they are
 
-def _realize_loadops(self:LazyBuffer) -> Tuple[DeviceBuffer, List[DeviceBuffer], OpType]:
-  assert self.op.op == LoadOps.FROMCPU
-  return Device._buffers[self.device].fromCPU(self.op.arg), [], LoadOps
+RealizeFxn = Callable[[], Tuple[DeviceBuffer, List[DeviceBuffer], OpType]]
 
-def _realize_movementops(self:LazyBuffer) -> Tuple[DeviceBuffer, List[DeviceBuffer], OpType]:
-  real_src = self.op.src[0].realize(self.device)
-  return real_src.movement_op(self.op.op, self.op.arg), [real_src], MovementOps
+def _realize_loadops(self:LazyBuffer) -> Tuple[List[LazyBuffer], RealizeFxn]:
+  assert self.op.op == LoadOps.FROMCPU
+  op = self.op
+  return [], lambda: (Device._buffers[self.device].fromCPU(op.arg), [], LoadOps)
+
+def _realize_movementops(self:LazyBuffer) -> Tuple[List[LazyBuffer], RealizeFxn]:
+  op, src = self.op, self.op.buffers[0]
+  return [src], lambda: (src.realize().movement_op(op.op, op.arg), [src.realized], MovementOps)
+
+@Passes.register(opt=1)
+def merge_elementwise_into_reduce(src:LazyBuffer) -> Optional[LazyOp]:
+  return src.op if src.realized is None and src.optype == BinaryOps and len(src.children) <= 1 else None
+
+ReduceInput = Tuple[Union["LazyOp", "LazyBuffer"], List["LazyBuffer"]]
+
+# the input of a reduce and the buffers it reads, the schedule works this out once for each reduce
+def _reduce_input(x:LazyBuffer, inputs:Dict[LazyBuffer, ReduceInput]) -> ReduceInput:
+  if x not in inputs:
+    src = x.op.buffers[0]
+    merged = merge_elementwise_into_reduce(src)
+    inputs[x] = (merged, get_lazybuffers(merged)) if merged is not None else (src, [src])
+  return inputs[x]
+
+# sibling reduces have the same input and output shapes, and read the same unrealized buffers
+# NOTE: if a sibling had another unrealized input, it could depend on this reduce. like the variance does on the mean
+# they are children of the inputs, or children of an elementwise op on the inputs
+# only the siblings the schedule needs anyway are merged, an unused reduce isn't realized early
+@Passes.register(opt=1)
+def merge_sibling_reduces(self:LazyBuffer, real_srcs:List[LazyBuffer], needed:Set[LazyBuffer], inputs:Dict[LazyBuffer, ReduceInput]) -> Optional[List[LazyBuffer]]:
+  unrealized = set(x for x in real_srcs if x.realized is None)
+  ret : List[LazyBuffer] = []
+  for x in real_srcs:
+    for c in x.children:
+      for s in ([c] if c.optype == ReduceOps else list(c.children) if c.optype == BinaryOps and c.realized is None else []):
+        if s is self or s in ret or s not in needed or s.optype != ReduceOps or s.realized is not None or s.device != self.device: continue
+        if s.shape == self.shape and s.op.buffers[0].shape == self.op.buffers[0].shape and set(y for y in _reduce_input(s, inputs)[1] if y.realized is None) == unrealized: ret.append(s)
+  return ret if len(ret) else None
 
 # TODO: unify _realize_reduceops, _realize_processingops, and _realize_binaryops
-def _realize_reduceops(self:LazyBuffer) -> Tuple[DeviceBuffer, List[DeviceBuffer], OpType]:
+def _realize_reduceops(self:LazyBuffer, needed:Set[LazyBuffer], inputs:Dict[LazyBuffer, ReduceInput]) -> Tuple[List[LazyBuffer], RealizeFxn, Tuple[LazyBuffer, ...]]:
   # TODO: this can also corealize a binary op after the reduce, not just before
-  src = self.op.src[0]
-  if MERGE_ELEMENTWISE_INTO_REDUCE and getattr(self.dbuffer, "start_for_op", None) and src.realized is None and src.optype == BinaryOps and len(src.children) <= 1:
+  op, src = self.op, self.op.buffers[0]
+  if getattr(self.dbuffer, "start_for_op", None):
     # TODO: this code is (somewhat) repeated in _realize_binaryops
-    real_srcs : Dict[LazyBuffer, DeviceBuffer] = {x:x.realize(self.device) for x in get_lazybuffers(src.op)}
-    buf_names : Dict[LazyBuffer, str] = {x:f"arg_{i}" for i,x in enumerate(real_srcs.keys())}
-
-    return self.dbuffer(self.shape)._processing_op([(buf_names[lb], db) for lb,db in real_srcs.items()], \
-      earlycode=_ast(LazyOp(self.op.op, (src.op,), self.op.arg), buf_names, self.dbuffer.code_for_op), earlybufs=buf_names.values(), start=self.dbuffer.start_for_op[self.op.op]), \
-      list(real_srcs.values()), ReduceOps
+    real_srcs : List[LazyBuffer] = _reduce_input(self, inputs)[1][:]
+    # sibling reduces are computed in the same kernel, so the inputs are only read once
+    siblings = merge_sibling_reduces(self, real_srcs, needed, inputs) or []
+    real_srcs += [x for x in dict.fromkeys(itertools.chain.from_iterable(_reduce_input(s, inputs)[1] for s in siblings)) if x not in real_srcs]
+    buf_names : Dict[LazyBuffer, str] = {x:f"arg_{i}" for i,x in enumerate(real_srcs)}
+    earlycodes = [_ast(LazyOp(x.op.op, (_reduce_input(x, inputs)[0],), x.op.arg), buf_names, self.dbuffer.code_for_op) for x in [self]+siblings]
+    starts = [self.dbuffer.start_for_op[x.op.op] for x in [self]+siblings]
+    def fxn():
+      rets = [x.dbuffer(x.shape) for x in [self]+siblings]
+      rets[0]._processing_op([(buf_names[x], x.realized) for x in real_srcs], earlycode=earlycodes[0], earlybufs=buf_names.values(), start=starts[0],
+        siblings=list(zip(rets[1:], earlycodes[1:], starts[1:])))
+      return (tuple(rets) if len(siblings) else rets[0]), [x.realized for x in real_srcs], ReduceOps
+    return real_srcs, fxn, tuple(siblings)
   else:
-    real_src = src.realize(self.device)
-    return real_src.reduce_op(self.op.op, self.op.arg), [real_src], ReduceOps
-
-def _realize_processingops(self:LazyBuffer) -> Tuple[DeviceBuffer, List[DeviceBuffer], OpType]:
-  real_src_x, real_src_w = [x.realize(self.device) for x in self.op.src]
-  return real_src_x.processing_op(self.op.op, real_src_w, self.op.arg), [real_src_x, real_src_w], ProcessingOps
-
-def _realize_binaryops(self:LazyBuffer) -> Tuple[DeviceBuffer, List[DeviceBuffer], OpType]:
-  real_srcs : Dict[LazyBuffer, DeviceBuffer] = {x:None for x in get_lazybuffers(self.op)}
+    return [src], lambda: (src.realize().reduce_op(op.op, op.arg), [src.realized], ReduceOps), tuple()
+
+def _realize_processingops(self:LazyBuffer) -> Tuple[List[LazyBuffer], RealizeFxn]:
+  op, (src_x, src_w) = self.op, self.op.src
+  assert isinstance(src_x, LazyBuffer) and isinstance(src_w, LazyBuffer)
+  return [src_x, src_w], lambda: (src_x.realize().processing_op(op.op, src_w.realize(), op.arg), [src_x.realized, src_w.realized], ProcessingOps)
+
+# if there's *one* processing or reduce op in the srcs, we can corealize it. we can corealize binary op sibilings as well
+# NOTE: if it references the same conv multiple times, they should already be merged by the dictionary
+# a reduce that isn't needed any more is planned already, like a sibling of another reduce, and isn't computed again
+@Passes.register(opt=2)
+def merge_one_reduce_into_elementwise(srcs:List[LazyBuffer], needed:Set[LazyBuffer]) -> Optional[Tuple[LazyBuffer, LazyBuffer]]:
+  # NOTE: a MATMUL is always its own kernel
+  psrcs = [(k,x) for k,x in zip(srcs, map(get_movementroot_contiguous, srcs)) if x.optype in [ProcessingOps,ReduceOps] and x.realized is None and x in needed and len(x.children) <= 1 and len(k.children) <= 1 and x.op.op != ProcessingOps.MATMUL]
+  return psrcs[0] if len(psrcs) == 1 else None
+
+def _realize_binaryops(self:LazyBuffer, needed:Set[LazyBuffer], inputs:Dict[LazyBuffer, ReduceInput]) -> Tuple[List[LazyBuffer], RealizeFxn]:
+  op = self.op
+  real_srcs : Dict[LazyBuffer, None] = {x:None for x in get_lazybuffers(op)}
   if getattr(self.dbuffer, "_processing_op", None) is not None:
     buf_names : Dict[LazyBuffer, str] = {x:f"arg_{i}" for i,x in enumerate(real_srcs.keys())}
     reduce_shape = (list(real_srcs.keys())[0].shape, list(real_srcs.keys())[0].shape)
-    earlycode = "acc"
+    earlycode, start = "acc", "0.0"
     conv_args : Optional[ConvArgs] = None
 
-    # if there's *one* processing or reduce op in here, we can corealize it. we can corealize binary op sibilings as well
-    # NOTE: if it references the same conv multiple times, they should already be merged by the dictionary
-    psrcs : List[Tuple[LazyBuffer, LazyBuffer]] = [(k,x) for k,x in zip(real_srcs.keys(), map(get_movementroot_contiguous, real_srcs.keys())) if x.optype in [ProcessingOps,ReduceOps] and x.realized is None and len(x.children) <= 1 and len(k.children) <= 1]
-    if len(psrcs) == 1 and MERGE_ONE_REDUCE_INTO_ELEMENTWISE:
-      if psrcs[0][1].optype == ProcessingOps:
+    psrc = merge_one_reduce_into_elementwise(list(real_srcs.keys()), needed)
+    if psrc is not None:
+      # the buffer is computed in this kernel, it isn't planned on its own or merged as a sibling
+      needed.discard(psrc[1])
+      if psrc[1].optype == ProcessingOps:
         # TODO: do something similar to what i did with reduceop to use the ast engine?
         # it's hard because conv also has convargs
-        conv_args = psrcs[0][1].op.arg
-        real_srcs[psrcs[0][1].op.src[0]], real_srcs[psrcs[0][1].op.src[1]] = None, None
-        buf_names[psrcs[0][1].op.src[0]], buf_names[psrcs[0][1].op.src[1]] = "input", "weight"   # NOTE: these will not be in the ast
-      elif psrcs[0][1].optype == ReduceOps:
-        src = psrcs[0][1].op.src[0]
-        reduce_shape = (src.shape, psrcs[0][1].shape)
-
-        if MERGE_ELEMENTWISE_INTO_REDUCE and getattr(self.dbuffer, "start_for_op", None) and src.realized is None and src.optype == BinaryOps and len(src.children) <= 1: src = src.op
-        for i,x in enumerate(get_lazybuffers(src) if isinstance(src, LazyOp) else [src]):
+        conv_args = psrc[1].op.arg
+        real_srcs[psrc[1].op.src[0]], real_srcs[psrc[1].op.src[1]] = None, None
+        buf_names[psrc[1].op.src[0]], buf_names[psrc[1].op.src[1]] = "input", "weight"   # NOTE: these will not be in the ast
+      elif psrc[1].optype == ReduceOps:
+        reduce_shape = (psrc[1].op.src[0].shape, psrc[1].shape)
+        src, srcs = _reduce_input(psrc[1], inputs) if getattr(self.dbuffer, "start_for_op", None) else (psrc[1].op.src[0], [psrc[1].op.src[0]])
+        for i,x in enumerate(srcs):
           real_srcs[x] = None
           buf_names[x] = f"earlyarg_{i}"
-        earlycode = _ast(LazyOp(psrcs[0][1].op.op, (src,), psrcs[0][1].op.arg), buf_names, self.dbuffer.code_for_op)
+        earlycode = _ast(LazyOp(psrc[1].op.op, (src,), psrc[1].op.arg), buf_names, self.dbuffer.code_for_op)
+        start = self.dbuffer.start_for_op[psrc[1].op.op]
 
-      del real_srcs[psrcs[0][0]]
-      buf_names[psrcs[0][0]] = "acc"
+      del real_srcs[psrc[0]]
+      buf_names[psrc[0]] = "acc"
 
-    for x in real_srcs.keys(): real_srcs[x] = x.realize(self.device)
+    code = _ast(op, buf_names, self.dbuffer.code_for_op)
+    earlybufs = set(x for x in buf_names.values() if x.startswith("earlyarg_"))
     # fast path, no middle buffers
-    return self.dbuffer(self.shape)._processing_op([(buf_names[lb], db) for lb,db in real_srcs.items()], \
-      _ast(self.op, buf_names, self.dbuffer.code_for_op), earlycode=earlycode, earlybufs=set(x for x in buf_names.values() if x.startswith("earlyarg_")),
-      C=conv_args, reduce_shape=reduce_shape), \
-      list(real_srcs.values()), ProcessingOps if conv_args is not None else (ReduceOps if reduce_shape[0] != reduce_shape[1] else BinaryOps)
+    def fxn():
+      return self.dbuffer(self.shape)._processing_op([(buf_names[lb], lb.realized) for lb in real_srcs.keys()], \
+        code, earlycode=earlycode, earlybufs=earlybufs, C=conv_args, start=start, reduce_shape=reduce_shape), \
+        [x.realized for x in real_srcs.keys()], ProcessingOps if conv_args is not None else (ReduceOps if reduce_shape[0] != reduce_shape[1] else BinaryOps)
+    return list(real_srcs.keys()), fxn
+  elif getattr(self.dbuffer, "fused_op", None) is not None:
+    # the backend runs the whole ast in one pass, no middle buffers either
+    buf_names = {x:f"arg_{i}" for i,x in enumerate(real_srcs.keys())}
+    ast = _ast_tuple(op, buf_names)
+    return list(real_srcs.keys()), lambda: (self.dbuffer.fused_op(self.shape, ast, {buf_names[x]:x.realized for x in real_srcs.keys()}), [x.realized for x in real_srcs.keys()], BinaryOps)
   else:
-    for x in real_srcs.keys(): real_srcs[x] = x.realize(self.device)
     # slow path, creates middle buffers
     def ast_eval(x: Union[LazyBuffer, LazyOp]) -> DeviceBuffer:
-      if isinstance(x, LazyBuffer): return real_srcs[x]
+      if isinstance(x, LazyBuffer): return x.realized
       if isinstance(x.op, UnaryOps): return ast_eval(x.src[0]).unary_op(x.op)
       if isinstance(x.op, BinaryOps): return ast_eval(x.src[0]).binary_op(x.op, ast_eval(x.src[1]))
-    return ast_eval(self.op), list(real_srcs.values()), BinaryOps
-
-_realize = {LoadOps:_realize_loadops, ReduceOps:_realize_reduceops, MovementOps:_realize_movementops, BinaryOps:_realize_binaryops, ProcessingOps:_realize_processingops}
+    return list(real_srcs.keys()), lambda: (ast_eval(op), [x.realized for x in real_srcs.keys()], BinaryOps)
+
+# the reduces and the elementwise ops also see what the schedule still needs and the inputs of the reduces
+_realize : Dict[OpType, Callable[[LazyBuffer], Tuple[List[LazyBuffer], RealizeFxn]]] = {LoadOps:_realize_loadops, MovementOps:_realize_movementops, ProcessingOps:_realize_processingops}
+
+# **** scheduler ****
+
+class ScheduleItem(NamedTuple):
+  buf: LazyBuffer
+  deps: List[LazyBuffer]  # these are realized before fxn runs
+  fxn: RealizeFxn
+  siblings: Tuple[LazyBuffer, ...] = tuple()  # these are realized by the same kernel, fxn returns all the outputs
+
+def create_schedule(*outs:LazyBuffer) -> List[ScheduleItem]:
+  # toposort with an explicit stack, deep graphs don't recurse
+  schedule : List[ScheduleItem] = []
+  plans : Dict[LazyBuffer, Tuple] = {}
+  # every unrealized buffer the outs depend on that isn't planned yet, the reduces in here can be merged as siblings
+  needed : Set[LazyBuffer] = set()
+  inputs : Dict[LazyBuffer, ReduceInput] = {}
+  walk : List[LazyBuffer] = list(outs)
+  while len(walk):
+    x = walk.pop()
+    if x.realized is not None or x in needed: continue
+    needed.add(x)
+    walk.extend(x.op.buffers)
+  stack : List[Tuple[LazyBuffer, bool]] = [(out, False) for out in outs[::-1]]
+  while len(stack):
+    x, deps_scheduled = stack.pop()
+    if deps_scheduled:
+      schedule.append(ScheduleItem(x, *plans[x]))
+      continue
+    if x.realized is not None or x in plans: continue
+    if x.optype == ReduceOps: plans[x] = _realize_reduceops(x, needed, inputs)
+    elif x.optype == BinaryOps: plans[x] = _realize_binaryops(x, needed, inputs)
+    else: plans[x] = _realize[x.optype](x)
+    # the siblings are realized by this kernel, they aren't planned again
+    for y in (plans[x][2] if len(plans[x]) > 2 else tuple()): plans[y] = plans[x]
+    needed.difference_update((x,)+(plans[x][2] if len(plans[x]) > 2 else tuple()))
+    assert all(d.device == x.device for d in plans[x][0]), f"all sources of {x} must be on {x.device}"
+    stack.append((x, True))
+    stack.extend((d, False) for d in plans[x][0][::-1])
+  return schedule
+
+def run_schedule(schedule:List[ScheduleItem]):
+  for si in schedule:
+    if si.buf.realized is not None: continue
+    ret, real_srcs, real_type = si.fxn()
+    for x, realized in zip((si.buf,)+si.siblings, ret if len(si.siblings) else (ret,)):
+      if x.realized is not None: continue   # a sibling can already be realized by its own kernel
+      x.realized = realized
+      # in lazy mode, we don't log until we realize
+      log_op(real_type, [x.op for x in get_lazyops(x.op)], x.realized, real_srcs)
+      # no need to keep the op after realization
+      del x.op
+
+class MemoryPlan(NamedTuple):
+  arenas: List[int]  # in bytes
+  assignment: Dict[LazyBuffer, int]  # the arena each buffer the schedule allocates lives in
+  naive_bytes: int  # every buffer gets its own memory
+  live_bytes: int  # the most bytes live at once, no plan can beat this
+
+  @property
+  def planned_bytes(self) -> int: return sum(self.arenas)
+
+# NOTE: this assumes float32 and that movement ops are views (like on GPU), they extend the lifetime of the buffer they view
+# NOTE: this only reports what reuse by liveness would save, the llops still allocate every buffer
+# a realized buffer can be held by tensors outside the schedule (like the ones saved for backward), so it isn't safe to reuse yet
+def plan_memory(schedule:List[ScheduleItem], outs:Tuple[LazyBuffer, ...]=tuple()) -> MemoryPlan:
+  base : Dict[LazyBuffer, LazyBuffer] = {}
+  size : Dict[LazyBuffer, int] = {}
+  last_use : Dict[LazyBuffer, int] = {}
+  for i,si in enumerate(schedule):
+    if si.buf.optype == MovementOps: base[si.buf] = base.get(si.deps[0], si.deps[0])
+    else:
+      for x in (si.buf,)+si.siblings: size[x], last_use[x] = 4*prod(x.shape), i
+    for d in si.deps: last_use[base.get(d, d)] = i
+  # the outputs (by default the last buffer scheduled) are still used after the schedule
+  for x in outs or tuple(si.buf for si in schedule[-1:]): last_use[base.get(x, x)] = len(schedule)
+
+  arenas : List[int] = []
+  assignment : Dict[LazyBuffer, int] = {}
+  free : List[int] = []
+  live, live_bytes = 0, 0
+  dies, died = sorted(size.keys(), key=lambda x: last_use[x]), 0
+  for i,si in enumerate(schedule):
+    # the buffers not used after the last step are free, the inputs of this step are not
+    while died < len(dies) and last_use[dies[died]] < i:
+      free.append(assignment[dies[died]])
+      live, died = live - size[dies[died]], died+1
+    for x in (si.buf,)+si.siblings if si.buf in size else tuple():
+      # best fit: the smallest free arena it fits in, else grow the biggest one
+      fits = [a for a in free if arenas[a] >= size[x]]
+      if len(fits): a = min(fits, key=lambda a: arenas[a])
+      elif len(free): a = max(free, key=lambda a: arenas[a])
+      else: a, arenas = len(arenas), arenas+[0]
+      if a in free: free.remove(a)
+      arenas[a], assignment[x] = max(arenas[a], size[x]), a
+      live += size[x]
+    live_bytes = max(live, live_bytes)
+  return MemoryPlan(arenas, assignment, sum(size.values()), live_bytes)
 
 # **** lazy operations ****
 
-class LazyOp(NamedTuple):
-  op: Op
-  src: Tuple[Union[LazyOp, LazyBuffer], ...]  # type: ignore
-  arg: Any = None
+class LazyOp:
   # TODO: add dest to support multiple outputs
+  __slots__ = "op", "src", "arg", "buffers", "key"
+  def __init__(self, op:Op, src:Tuple[Union[LazyOp, LazyBuffer], ...], arg:Any=None):
+    self.op, self.src, self.arg = op, src, arg
+    # the srcs already found their LazyBuffers, so this doesn't walk the AST. NOTE: each LazyBuffer is only in here once
+    self.buffers : Tuple[LazyBuffer, ...] = tuple(dict.fromkeys(itertools.chain.from_iterable(x.buffers if isinstance(x, LazyOp) else (x,) for x in src)))
+    # loadops aren't cached, and their arg is a numpy array
+    self.key : Optional[LazyOpKey] = LazyOpKey.get(self) if not isinstance(op, LoadOps) else None
+  def __repr__(self): return f"LazyOp(op={self.op}, src={self.src}, arg={self.arg})"
+
+# LazyOps with the same structure share one LazyOpKey, so keys are hashed and compared by identity in O(1)
+# the key is built from the keys of the src LazyOps and weakrefs to the src LazyBuffers, so it can outlive the LazyOp in the lazycache
+class LazyOpKey:
+  __slots__ = "structure", "__weakref__"
+  interned : Dict[Tuple, weakref.ReferenceType[LazyOpKey]] = {}
+  def __init__(self, structure:Tuple): self.structure = structure
+  # NOTE: this is a WeakValueDictionary, without the overhead
+  def __del__(self):
+    ref = type(self).interned.get(self.structure)
+    if ref is not None and ref() in (self, None): del type(self).interned[self.structure]
 
-def get_lazybuffers(op:LazyOp) -> List[LazyBuffer]: return functools.reduce(operator.add, [get_lazybuffers(x) if isinstance(x, LazyOp) else [x] for x in op.src], [])
-def get_lazyops(op:LazyOp) -> List[LazyOp]: return functools.reduce(operator.add, [get_lazyops(x) for x in op.src if isinstance(x, LazyOp)], [op])
-def get_weakop(op:LazyOp) -> LazyOp: return LazyOp(op.op, tuple(get_weakop(x) if isinstance(x, LazyOp) else weakref.ref(x) for x in op.src), op.arg)
+  @staticmethod
+  def get(op:LazyOp) -> LazyOpKey:
+    structure = (op.op, tuple(x.key if isinstance(x, LazyOp) else weakref.ref(x) for x in op.src), op.arg)
+    ref = LazyOpKey.interned.get(structure)
+    ret = ref() if ref is not None else None
+    if ret is None:
+      ret = LazyOpKey(structure)
+      LazyOpKey.interned[structure] = weakref.ref(ret)
+    return ret
+
+def get_lazybuffers(op:LazyOp) -> List[LazyBuffer]: return list(op.buffers)
+def get_lazyops(op:LazyOp) -> List[LazyOp]:
+  ret : Dict[int, LazyOp] = {}
+  stack : List[LazyOp] = [op]
+  while len(stack):
+    x = stack.pop()
+    if id(x) in ret: continue   # shared subtrees are only walked once
+    ret[id(x)] = x
+    stack.extend(y for y in x.src[::-1] if isinstance(y, LazyOp))
+  return list(ret.values())
 def get_movementroot(root:LazyBuffer) -> LazyBuffer: return get_movementroot(root.op.src[0]) if root.optype == MovementOps and root.realized is None else root
 def get_movementroot_contiguous(x:LazyBuffer) -> LazyBuffer: return get_movementroot(x) if x.optype == MovementOps and x.st.contiguous else x
 
 LAZY = int(os.getenv("LAZY", "1"))
 
 class LazyBuffer:
-  lazycache : weakref.WeakValueDictionary[LazyOp, LazyBuffer] = weakref.WeakValueDictionary()
+  lazycache : weakref.WeakValueDictionary[Tuple[str, OpType, LazyOpKey], LazyBuffer] = weakref.WeakValueDictionary()
+  lazycache_hits, lazycache_misses = 0, 0
   def __new__(cls, device, shape, optype, op):
     # loadops aren't cached
     if optype == LoadOps: return super().__new__(cls)
-    wop = (device, optype, get_weakop(op))   # NOTE: shape should be deterministic. annoying to cache with the ShapeTracker
+    wop = (device, optype, op.key)   # NOTE: shape should be deterministic. annoying to cache with the ShapeTracker
     # NOTE: we need "ret" to prevent the new buffer from being immediately deleted
-    if wop not in LazyBuffer.lazycache: LazyBuffer.lazycache[wop] = ret = super().__new__(cls)
-    return LazyBuffer.lazycache[wop]
+    ret = LazyBuffer.lazycache.get(wop)
+    if ret is None:
+      LazyBuffer.lazycache[wop] = ret = super().__new__(cls)
+      LazyBuffer.lazycache_misses += 1
+    else: LazyBuffer.lazycache_hits += 1
+    return ret
+
+  @staticmethod
+  def cache_stats() -> Dict[str, Union[int, float]]:
+    lookups = LazyBuffer.lazycache_hits + LazyBuffer.lazycache_misses
+    return {"hits": LazyBuffer.lazycache_hits, "misses": LazyBuffer.lazycache_misses, "hit_rate": LazyBuffer.lazycache_hits/max(lookups, 1),
+            "cached": len(LazyBuffer.lazycache), "interned_keys": len(LazyOpKey.interned)}
 
   def __init__(self, device, shape:Union[ShapeTracker, Tuple[int, ...]], optype:OpType, op:LazyOp):
     if getattr(self, 'device', None) is not None: return  # cache hit, we return and don't reinit
@@ -222,24 +467,25 @@ class LazyBuffer:
 
   def __repr__(self): return f"<LB {self.shape} op:{self.op.op if self.realized is None else 'realized'}>"
 
+  # this lists the kernels that produce the device buffer, nothing is run
+  def schedule(self) -> List[ScheduleItem]: return create_schedule(self)
+
   # this produces a device buffer
   def realize(self:LazyBuffer, required_device=None) -> DeviceBuffer:
     if required_device is not None: assert required_device == self.device
-    if self.realized is None:
-      # we haven't realized the Buffer yet
-      self.realized, real_srcs, real_type = _realize[self.optype](self)
-      # in lazy mode, we don't log until we realize
-      log_op(real_type, [x.op for x in get_lazyops(self.op)], self.realized, real_srcs)
-      # no need to keep the op after realization
-      del self.op
+    # we haven't realized the Buffer yet, run everything it depends on in order
+    if self.realized is None: run_schedule(self.schedule())
 
-    assert self.realized.shape == self.shape
+    assert self.realized is not None and self.realized.shape == self.shape
     assert isinstance(self.realized, Device._buffers[self.device])
     return self.realized
 
   @staticmethod
   def fromCPU(x, device): return LazyBuffer(device, x.shape, LoadOps, LazyOp(LoadOps.FROMCPU, tuple(), x.copy()))
   def toCPU(x): return x.realize().toCPU()
+  # the compiled backends fold a constant into the kernel
+  def const(x:LazyBuffer, val:float, shape:Tuple[int, ...]) -> LazyBuffer:
+    return LazyBuffer.fromCPU(np.array([val], dtype=np.float32), x.device).movement_op(MovementOps.RESHAPE, (1,)*len(shape)).movement_op(MovementOps.EXPAND, shape)
 
   def unary_op(x:LazyBuffer, op:UnaryOps) -> LazyBuffer: return elementwise_op(op, x)
   def binary_op(x:LazyBuffer, op:BinaryOps, y:LazyBuffer) -> LazyBuffer: return elementwise_op(op, x, y)
@@ -247,7 +493,8 @@ class LazyBuffer:
 
   # TODO: permute to put all the reduce axis at the end
   def reduce_op(x:LazyBuffer, op:ReduceOps, new_shape:Tuple[int, ...]) -> LazyBuffer:
-    if x.shape == tuple(new_shape): return x
+    # nothing is reduced, the variance of one element is 0
+    if x.shape == tuple(new_shape): return x.binary_op(BinaryOps.SUB, x) if op == ReduceOps.VAR else x
     if getattr(x.dbuffer, "REQUIRES_SIMPLE_REDUCE", False) and (len(new_shape) != 2 or new_shape[1] != 1):
       num, red = prod([s for s,n in zip(x.shape, new_shape) if n != 1]), prod([s for s,n in zip(x.shape, new_shape) if n == 1])
       x = x.movement_op(MovementOps.PERMUTE, [i for i,n in enumerate(new_shape) if n != 1] + [i for i,n in enumerate(new_shape) if n == 1])
@@ -281,31 +528,29 @@ class LazyBuffer:
     # some permutes are actually just reshapes
     if op == MovementOps.PERMUTE and ShapeTracker(x.shape).movement_op(op, arg).contiguous: return x.movement_op(MovementOps.RESHAPE, tuple(x.shape[i] for i in arg))
 
-    if SHUFFLE_MOVEMENT_OPS and x.optype == BinaryOps and x.realized is None and len(x.children) == 0 and (SHUFFLE_PAD_OPS or op != MovementOps.PAD) and op not in [MovementOps.EXPAND, MovementOps.STRIDED]:
-      # if this MovementOp is being applied to a BinaryOp, apply the MovementOp to all the BinaryOp inputs instead
-      def replace_with_movement_op(y:Union[LazyOp, LazyBuffer]) -> LazyBuffer:
-        if isinstance(y, LazyBuffer): return y.movement_op(op, arg)
-        assert isinstance(y.op, BinaryOps) or isinstance(y.op, UnaryOps)
-        return elementwise_op(y.op, *[replace_with_movement_op(z) for z in y.src])
-      return replace_with_movement_op(x.op)
+    shuffled = shuffle_pad_ops(x, op, arg) if op == MovementOps.PAD else shuffle_movement_ops(x, op, arg)
+    if shuffled is not None: return shuffled
 
     # create the buffer
     ret = LazyBuffer(x.device, ShapeTracker(x.st).movement_op(op, arg), MovementOps, LazyOp(op, (x,), arg))
+    return remove_movement_nops(x, ret) or ret
 
-    # NOTE: if ret is in the cache, it can already be realized
-    if REMOVE_MOVEMENT_NOPS and ret.realized is None and x.realized is None and ret.st.contiguous:
-      # MovementOps aren't stacked any more, they each have one parent, find the root
-      root = get_movementroot(x)
-      if root.st.contiguous and root != x and prod(ret.st.shape) == prod(root.shape):
-        return root.movement_op(MovementOps.RESHAPE, ret.st.shape) if ret.st.shape != root.shape else root
+  def processing_op(x:LazyBuffer, op:ProcessingOps, w:LazyBuffer, C:Union[ConvArgs, MatmulArgs]) -> LazyBuffer:
+    if isinstance(C, MatmulArgs):
+      if op in getattr(x.dbuffer, "processing_ops", ()): return LazyBuffer(x.device, C.out_shape, ProcessingOps, LazyOp(op, (x, w), C))
+      # universal matmul, just mul and reduce
+      x = x.movement_op(MovementOps.RESHAPE, (C.bs, C.m, 1, C.k)).movement_op(MovementOps.EXPAND, (C.bs, C.m, C.n, C.k))
+      w = w.movement_op(MovementOps.PERMUTE, (0, 2, 1)).movement_op(MovementOps.RESHAPE, (C.bs, 1, C.n, C.k)).movement_op(MovementOps.EXPAND, (C.bs, C.m, C.n, C.k))
+      return x.binary_op(BinaryOps.MUL, w).reduce_op(ReduceOps.SUM, (C.bs, C.m, C.n, 1)).movement_op(MovementOps.RESHAPE, C.out_shape)
 
-    return ret
+    # a backend with WINOGRAD_CONV runs an eligible conv as winograd's mul and reduce, not its own conv kernel
+    winograd = WINOGRAD and winograd_eligible(C) and getattr(x.dbuffer, "WINOGRAD_CONV", False)
 
-  def processing_op(x:LazyBuffer, op:ProcessingOps, w:LazyBuffer, C:ConvArgs) -> LazyBuffer:
     # TODO: fixup C?
-    if NOCONV or not getattr(x.dbuffer, "SUPPORTS_PADDING", False): x = x.slice(((0, x.shape[0]), (0, x.shape[1]), (-C.py, x.shape[2]+C.py_), (-C.px, x.shape[3]+C.px_)))
+    if NOCONV or not getattr(x.dbuffer, "SUPPORTS_PADDING", False) or winograd: x = x.slice(((0, x.shape[0]), (0, x.shape[1]), (-C.py, x.shape[2]+C.py_), (-C.px, x.shape[3]+C.px_)))
 
-    if NOCONV or not getattr(x.dbuffer, "processing_op", False):
+    if NOCONV or op not in getattr(x.dbuffer, "processing_ops", ()) or winograd:
+      if WINOGRAD and winograd_eligible(C): return winograd_conv(x, w, C)
       # universal conv, just mul and reduce
       # TODO: is there any way to replace strided with other movement ops?
       x = x.movement_op(MovementOps.STRIDED, (
@@ -326,11 +571,66 @@ class LazyBuffer:
     else:
       return LazyBuffer(x.device, C.out_shape, ProcessingOps, LazyOp(op, (x, w), C))
 
-def elementwise_op(op:Union[UnaryOps, BinaryOps], *srcs:LazyBuffer) -> LazyBuffer:
-  out_device, out_shape = srcs[0].device, srcs[0].shape
+# Winograd F(2x2,3x3) in mul and reduce, Y = A^T [(G g G^T) * (B^T d B)] A on 4x4 tiles of the input that overlap by 2
+def winograd_conv(x:LazyBuffer, w:LazyBuffer, C:ConvArgs) -> LazyBuffer:
+  # m y m^T on the last two axes
+  def transform(y:LazyBuffer, m:np.ndarray) -> LazyBuffer:
+    mm, shp = np.einsum("ak,bl->abkl", m, m), y.shape[:-2]
+    y = y.movement_op(MovementOps.RESHAPE, shp+(1,1)+y.shape[-2:]).movement_op(MovementOps.EXPAND, shp+mm.shape)
+    c = LazyBuffer.fromCPU(mm, y.device).movement_op(MovementOps.RESHAPE, (1,)*len(shp)+mm.shape).movement_op(MovementOps.EXPAND, shp+mm.shape)
+    return y.binary_op(BinaryOps.MUL, c).reduce_op(ReduceOps.SUM, shp+mm.shape[:2]+(1,1)).movement_op(MovementOps.RESHAPE, shp+mm.shape[:2])
+
+  ty, tx = (C.oy+1)//2, (C.ox+1)//2
+  x = x.slice(((0, x.shape[0]), (0, x.shape[1]), (0, 2*ty+2), (0, 2*tx+2)))
+  d = x.movement_op(MovementOps.STRIDED, (
+    (C.bs, C.groups*C.cin*x.shape[2]*x.shape[3]), (C.groups, C.cin*x.shape[2]*x.shape[3]), (C.cin, x.shape[2]*x.shape[3]),
+    (ty, 2*x.shape[3]), (tx, 2), (4, x.shape[3]), (4, 1)))
+  v = transform(d, WINOGRAD_BT).movement_op(MovementOps.RESHAPE, (C.bs, C.groups, 1, C.cin, ty, tx, 4, 4))
+  u = transform(w.movement_op(MovementOps.RESHAPE, (C.groups, C.rcout, C.cin, 3, 3)), WINOGRAD_G).movement_op(MovementOps.RESHAPE, (1, C.groups, C.rcout, C.cin, 1, 1, 4, 4))
+  shp = (C.bs, C.groups, C.rcout, C.cin, ty, tx, 4, 4)
+  m = v.movement_op(MovementOps.EXPAND, shp).binary_op(BinaryOps.MUL, u.movement_op(MovementOps.EXPAND, shp)).reduce_op(ReduceOps.SUM, (C.bs, C.groups, C.rcout, 1, ty, tx, 4, 4))
+  y = transform(m.movement_op(MovementOps.RESHAPE, (C.bs, C.cout, ty, tx, 4, 4)), WINOGRAD_AT)
+  y = y.movement_op(MovementOps.PERMUTE, (0, 1, 2, 4, 3, 5)).movement_op(MovementOps.RESHAPE, (C.bs, C.cout, 2*ty, 2*tx))
+  return y.slice(((0, C.bs), (0, C.cout), (0, C.oy), (0, C.ox)))
+
+# if this MovementOp is being applied to a BinaryOp, apply the MovementOp to all the BinaryOp inputs instead
+def _shuffle_movement_op(x:LazyBuffer, op:MovementOps, arg) -> Optional[LazyBuffer]:
+  if x.optype != BinaryOps or x.realized is not None or len(x.children) != 0 or op in [MovementOps.EXPAND, MovementOps.STRIDED]: return None
+  def replace_with_movement_op(y:Union[LazyOp, LazyBuffer]) -> LazyBuffer:
+    if isinstance(y, LazyBuffer): return y.movement_op(op, arg)
+    assert isinstance(y.op, BinaryOps) or isinstance(y.op, UnaryOps)
+    return elementwise_op(y.op, *[replace_with_movement_op(z) for z in y.src])
+  return replace_with_movement_op(x.op)
+
+@Passes.register(opt=3)
+def shuffle_movement_ops(x:LazyBuffer, op:MovementOps, arg) -> Optional[LazyBuffer]: return _shuffle_movement_op(x, op, arg)
+
+# NOTE: 0/0 is NaN if you pad, so this can change the output
+@Passes.register(opt=4)
+def shuffle_pad_ops(x:LazyBuffer, op:MovementOps, arg) -> Optional[LazyBuffer]: return _shuffle_movement_op(x, op, arg)
 
-  if MERGE_ELEMENTWISE_OPS or (MERGE_UNARY_OPS and len(set(srcs)) == 1):
-    # remove the buffers from any (childless) BinaryOps that feed into this
-    srcs = tuple(x.op if x.optype == BinaryOps and len(x.children) == 0 and x.realized is None else x for x in srcs)  # type: ignore
+# TODO: movement ops that only change shape are really nops. treat them as such
+@Passes.register(opt=1)
+def remove_movement_nops(x:LazyBuffer, ret:LazyBuffer) -> Optional[LazyBuffer]:
+  # NOTE: if ret is in the cache, it can already be realized
+  if ret.realized is None and x.realized is None and ret.st.contiguous:
+    # MovementOps aren't stacked any more, they each have one parent, find the root
+    root = get_movementroot(x)
+    if root.st.contiguous and root != x and prod(ret.st.shape) == prod(root.shape):
+      return root.movement_op(MovementOps.RESHAPE, ret.st.shape) if ret.st.shape != root.shape else root
+  return None
+
+# remove the buffers from any (childless) BinaryOps that feed into this
+def _merge_elementwise_srcs(srcs:Tuple[LazyBuffer, ...]) -> Optional[Tuple[Union[LazyOp, LazyBuffer], ...]]:
+  ret = tuple(x.op if x.optype == BinaryOps and len(x.children) == 0 and x.realized is None else x for x in srcs)
+  return ret if any(x is not y for x,y in zip(ret, srcs)) else None
+
+@Passes.register(opt=2)
+def merge_elementwise_ops(srcs:Tuple[LazyBuffer, ...]) -> Optional[Tuple[Union[LazyOp, LazyBuffer], ...]]: return _merge_elementwise_srcs(srcs)
+
+@Passes.register(opt=1)
+def merge_unary_ops(srcs:Tuple[LazyBuffer, ...]) -> Optional[Tuple[Union[LazyOp, LazyBuffer], ...]]: return _merge_elementwise_srcs(srcs) if len(set(srcs)) == 1 else None
 
-  return LazyBuffer(out_device, out_shape, BinaryOps, LazyOp(op, srcs))
+def elementwise_op(op:Union[UnaryOps, BinaryOps], *srcs:LazyBuffer) -> LazyBuffer:
+  out_device, out_shape = srcs[0].device, srcs[0].shape
+  return LazyBuffer(out_device, out_shape, BinaryOps, LazyOp(op, merge_elementwise_ops(srcs) or merge_unary_ops(srcs) or srcs))
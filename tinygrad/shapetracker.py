@@ -1,12 +1,10 @@
 # ShapeTracker allows movement operations to a buffer that don't require a copy to be made.
 from __future__ import annotations
-import functools
-from typing import Tuple, Union, List
+import functools, weakref
+import numpy as np
+from typing import Tuple, Union, List, Optional
 from tinygrad.helpers import prod
-
-def divmodidx(acc, d, mod=True):
-  lr = f"(idx//{acc})" if acc != 1 else "idx"
-  return f"({lr}%{d})" if mod else lr  # don't mod the top shape dimension
+from tinygrad.symbolic import Node, Variable, NumNode
 
 @functools.lru_cache(maxsize=None)
 def to_shape_strides(shape:Tuple[int, ...], strides:Tuple[int, ...]) -> List[Tuple[int, int]]:
@@ -19,39 +17,75 @@ def to_shape_strides(shape:Tuple[int, ...], strides:Tuple[int, ...]) -> List[Tup
       ret.append((shape[i], strides[i]))
   return ret
 
+# views are immutable and interned, so equal views are the same object and can be cached on
 class View:
-  def __init__(self, shape, strides, offset:int=0):
-    self.shape, self.strides, self.offset = tuple(shape), tuple(strides), offset
-    self.shape_strides = to_shape_strides(self.shape, self.strides)
-
+  __slots__ = "shape", "strides", "offset", "shape_strides", "contiguous", "_expr", "__weakref__"
+  shape : Tuple[int, ...]
+  strides : Tuple[int, ...]
+  offset : int
+  shape_strides : List[Tuple[int, int]]
+  contiguous : bool
+  _expr : Optional[str]
+  cache : weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+  def __new__(cls, shape, strides, offset:int=0):
+    key = (tuple(shape), tuple(strides), offset)
+    if (ret := View.cache.get(key)) is None:
+      View.cache[key] = ret = super().__new__(cls)
+      for k,v in zip(("shape", "strides", "offset"), key): object.__setattr__(ret, k, v)
+      object.__setattr__(ret, "shape_strides", to_shape_strides(ret.shape, ret.strides))
+      object.__setattr__(ret, "contiguous", offset == 0 and all(s1 == s2 or s == 1 for s,s1,s2 in zip(ret.shape, ret.strides, strides_for_shape(ret.shape))))
+      object.__setattr__(ret, "_expr", None)
+    return ret
+
+  def __setattr__(self, k, v): raise AttributeError(f"{self!r} is immutable")
+  def __reduce__(self): return View, (self.shape, self.strides, self.offset)
   def __repr__(self): return f"View<{self.shape}, {self.strides}, {self.offset}>"
 
-  @functools.cached_property
-  def contiguous(self):
-    return self.offset == 0 and all(s1 == s2 or s == 1 for s,s1,s2 in zip(self.shape, self.strides, strides_for_shape(self.shape)))
-
-  @functools.cached_property
-  def expr(self):
-    ret = [f"{self.offset}"] if self.offset != 0 else []
+  def expr_node(self, idx:Node) -> Node:
+    ret : List[Node] = [NumNode(self.offset)]
     acc = 1
-    for i,(d,s) in enumerate(self.shape_strides[::-1]):
-      if d != 1 and s != 0:
-        lr = divmodidx(acc, d, i != len(self.shape_strides)-1 and d != prod(self.shape))
-        lr = f"({lr}*{s})" if s != 1 else lr
-        ret.append(lr)
+    for d,s in self.shape_strides[::-1]:
+      if d != 1 and s != 0: ret.append(((idx//acc)%d)*s)
       acc *= d
-    return 'idx=' + ('+'.join(ret) if len(ret) > 0 else "0")
+    return Variable.sum(ret)
+
+  @property
+  def expr(self):
+    if self._expr is None: object.__setattr__(self, "_expr", 'idx=' + self.expr_node(Variable('idx', 0, prod(self.shape)-1)).render())
+    return self._expr
 
 class ZeroView:
-  def __init__(self, old_shape, arg):
-    self.shape = []
-    expr, acc = ['valid'], 1
-    for s,(x,y) in list(zip(old_shape, arg))[::-1]:
-      self.shape = [y-x] + self.shape
-      base = divmodidx(acc, self.shape[0], len(self.shape) != len(old_shape)) + f"+{x}"
-      expr += ([f"(({base}) >= 0)"] if x < 0 else []) + ([f"(({base}) < {s})"] if y > s else [])
-      acc *= self.shape[0]
-    self.expr = 'valid=' + ' && '.join(expr)
+  __slots__ = "old_shape", "arg", "shape", "__weakref__"
+  old_shape : Tuple[int, ...]
+  arg : Tuple[Tuple[int, int], ...]
+  shape : Tuple[int, ...]
+  cache : weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+  def __new__(cls, old_shape, arg):
+    key = (tuple(old_shape), tuple(tuple(x) for x in arg))
+    if (ret := ZeroView.cache.get(key)) is None:
+      ZeroView.cache[key] = ret = super().__new__(cls)
+      for k,v in zip(("old_shape", "arg", "shape"), key + (tuple(y-x for x,y in key[1]),)): object.__setattr__(ret, k, v)
+    return ret
+
+  def __setattr__(self, k, v): raise AttributeError(f"{self!r} is immutable")
+  def __reduce__(self): return ZeroView, (self.old_shape, self.arg)
+  def __repr__(self): return f"ZeroView<{self.old_shape}, {self.arg}>"
+
+  # only the padded sides need a check, and those simplify away if the range of idx says they are always true
+  def expr_node(self, idx:Node) -> Node:
+    expr, acc = [], 1
+    for s,(x,y) in list(zip(self.old_shape, self.arg))[::-1]:
+      base = ((idx//acc)%(y-x)) + x
+      expr += ([base >= 0] if x < 0 else []) + ([base < s] if y > s else [])
+      acc *= y-x
+    return Variable.ands(expr)
+
+  @property
+  def expr(self):
+    node = self.expr_node(Variable('idx', 0, prod(self.shape)-1))
+    return 'valid=valid' if isinstance(node, NumNode) and node.b == 1 else f"valid=valid && {node.render()}"
 
 ViewTypes = Union[View, ZeroView]
 
@@ -67,9 +101,56 @@ def view_from_shape(shape:Tuple[int, ...]):
   assert all([isinstance(x, int) for x in shape]) and len(shape) != 0
   return View(tuple(shape), strides_for_shape(shape))
 
+# a reshape of a strided view is still one view if each group of old dims that becomes a group of new dims is contiguous in memory
+# this returns the strides for new_shape, or None if the reshape needs a new view
+def merge_reshape(shape:Tuple[int, ...], strides:Tuple[int, ...], new_shape:Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+  old = [(s,st) for s,st in zip(shape, strides) if s != 1]
+  new = [i for i,s in enumerate(new_shape) if s != 1]
+  new_strides = [0]*len(new_shape)
+  oi, ni = 0, 0
+  while oi < len(old) and ni < len(new):
+    oj, nj, osz, nsz = oi+1, ni+1, old[oi][0], new_shape[new[ni]]
+    while osz != nsz:
+      if osz < nsz: osz, oj = osz*old[oj][0], oj+1
+      else: nsz, nj = nsz*new_shape[new[nj]], nj+1
+    if any(old[k][1] != old[k+1][1]*old[k+1][0] for k in range(oi, oj-1)): return None
+    stride = old[oj-1][1]
+    for k in new[ni:nj][::-1]: new_strides[k], stride = stride, stride*new_shape[k]
+    oi, ni = oj, nj
+  return tuple(new_strides)
+
+# each view is simplified with the range of the idx coming out of the view after it
+@functools.lru_cache(maxsize=4096)
+def expr_nodes(views:Tuple[ViewTypes, ...]) -> Tuple[Tuple[str, Node], ...]:
+  ret : List[Tuple[str, Node]] = []
+  idx = Variable('idx', 0, prod(views[-1].shape)-1)
+  for v in views[::-1]:
+    node = v.expr_node(idx)
+    if isinstance(v, ZeroView):
+      if not isinstance(node, NumNode) or node.b != 1: ret.append(('valid', node))
+    else:
+      if node is not idx: ret.append(('idx', node))
+      idx = Variable('idx', node.min, node.max)
+  return tuple(ret)
+
+@functools.lru_cache(maxsize=4096)
+def expr(views:Tuple[ViewTypes, ...]) -> str: return ';'.join([f"{k}={node.render()}" if k == 'idx' else f"valid=valid && {node.render()}" for k,node in expr_nodes(views)])
+
+# the movement ops only look at the last view and whether it's the only one, so the views they leave behind can be cached on that
+@functools.lru_cache(maxsize=4096)
+def movement_tail(view:View, single:bool, op:str, arg:Tuple) -> Tuple[ViewTypes, ...]:
+  st = ShapeTracker.__new__(ShapeTracker)
+  st.views = (view,) if single else (view, view)
+  getattr(st, op)(*arg)
+  return st.views[0 if single else 1:]
+
+def hashable(x): return tuple(hashable(y) for y in x) if isinstance(x, (list, tuple)) else x
+
 class ShapeTracker:
+  __slots__ = "views"
+  # copies share the views tuple, the movement ops replace it
   def __init__(self, shape:Union[ShapeTracker, Tuple[int, ...]]):
-    self.views : List[ViewTypes] = shape.views[:] if isinstance(shape, ShapeTracker) else [view_from_shape(shape)]
+    self.views : Tuple[ViewTypes, ...] = shape.views if isinstance(shape, ShapeTracker) else (view_from_shape(shape),)
 
   @property
   def contiguous(self): return len(self.views) == 1 and self.views[-1].contiguous
@@ -83,19 +164,31 @@ class ShapeTracker:
   @property
   def offset(self): return self.views[-1].offset
 
-  def expr(self): return ';'.join([v.expr for v in self.views[::-1] if v.expr != 'idx=idx' and v.expr != 'valid=valid'])
-  def movement_op(self, op, arg): getattr(self, str(op).split(".")[1].lower())(*arg); return self
+  def expr_nodes(self) -> Tuple[Tuple[str, Node], ...]: return expr_nodes(self.views)
+  def expr(self): return expr(self.views)
+
+  def movement_op(self, op, arg):
+    self.views = self.views[:-1] + movement_tail(self.views[-1], len(self.views) == 1, str(op).split(".")[1].lower(), hashable(arg))
+    return self
   def needs_valid(self): return any(isinstance(v, ZeroView) for v in self.views)
 
+  # vectorized over an array of output indexes (the whole range by default), returns the gather indexes and the valid mask
+  def indexes(self, idx:Optional[np.ndarray]=None) -> Tuple[np.ndarray, np.ndarray]:
+    idxs = np.arange(prod(self.shape)) if idx is None else np.asarray(idx)
+    env = {"idx": idxs, "valid": 1}
+    for k,node in self.expr_nodes(): env[k] = node.eval(env) if k == 'idx' else env['valid'] * node.eval(env)
+    # the expressions can fold to constants (like in an expand), they are broadcast to the indexes asked for
+    valid = np.broadcast_to(np.asarray(env["valid"], dtype=np.bool_), idxs.shape)
+    return np.where(valid, np.broadcast_to(env["idx"], idxs.shape), 0), valid
+
   def __getitem__(self, val):
-    locals = {"idx": val, "valid": 1}
-    exec(self.expr(), None, locals)
-    return locals["idx"] if locals["valid"] else -1
+    idx, valid = self.indexes(val)
+    return int(idx) if valid else -1
 
   def strided(self, *arg):
     view = View([x[0] for x in arg], [x[1] for x in arg])
-    if self.contiguous: self.views[-1] = view
-    else: self.views.append(view)
+    if self.contiguous: self.views = (view,)
+    else: self.views += (view,)
 
   def reshape(self, *new_shape):
     assert all([isinstance(x, int) for x in new_shape])
@@ -105,17 +198,17 @@ class ShapeTracker:
     if tuple([x for x in self.shape if x != 1]) == tuple([x for x in new_shape if x != 1]):
       old_strides = [y for x,y in zip(self.shape, self.strides) if x != 1]
       new_strides = [0 if x == 1 else old_strides.pop(0) for x in new_shape]
-      self.views[-1] = View(new_shape, new_strides, self.offset)
+      self.views = self.views[:-1] + (View(new_shape, new_strides, self.offset),)
       return
 
-    view = View(new_shape, strides_for_shape(new_shape))
-    if self.contiguous: self.views[-1] = view   # NOTE: if it's contiguous it can't have an offset
-    else: self.views.append(view)
+    if self.contiguous: self.views = (View(new_shape, strides_for_shape(new_shape)),)   # NOTE: if it's contiguous it can't have an offset
+    elif (new_strides := merge_reshape(self.shape, self.strides, tuple(new_shape))) is not None: self.views = self.views[:-1] + (View(new_shape, new_strides, self.offset),)
+    else: self.views += (View(new_shape, strides_for_shape(new_shape)),)
 
   def permute(self, *axis):
     assert all([isinstance(x, int) and x >= 0 and x < len(self.shape) for x in axis])
     assert len(set(axis)) == len(axis) and len(axis) == len(self.shape)
-    self.views[-1] = View([self.shape[a] for a in axis], [self.strides[a] for a in axis], self.offset)
+    self.views = self.views[:-1] + (View([self.shape[a] for a in axis], [self.strides[a] for a in axis], self.offset),)
 
   # TODO: this is a special case of slice with strides, remove it
   # though it's nice that it can't change size
@@ -133,16 +226,16 @@ class ShapeTracker:
     assert len(arg) == len(self.shape)
     offset = sum([self.strides[i]*x for i,(x,_) in enumerate(arg)])
     zeroview = ZeroView(self.shape, arg)
-    self.views[-1] = View([y-x for x,y in arg], self.strides, self.offset+offset)
-    if zeroview.expr != "valid=valid":
+    self.views = self.views[:-1] + (View([y-x for x,y in arg], self.strides, self.offset+offset),)
+    if any(x < 0 or y > s for s,(x,y) in zip(zeroview.old_shape, arg)):
       # if we add a ZeroView, we add another (stock) view also for modding
-      self.views += [zeroview, View(self.shape, strides_for_shape(self.shape))]
+      self.views += (zeroview, View(self.shape, strides_for_shape(self.shape)))
 
   def expand(self, *new_shape):
     assert all([isinstance(x, int) for x in new_shape])
     assert all([x == y or x == 1 for x,y in zip(self.shape, new_shape)])
     strides = [s if x == y else 0 for s,(x,y) in zip(self.strides, zip(self.shape, new_shape))]
-    self.views[-1] = View(new_shape, strides, self.offset)
+    self.views = self.views[:-1] + (View(new_shape, strides, self.offset),)
 
   # TODO: combine with slice? this doesn't require a ZeroView, though slice shouldn't always either
   def stride(self, *mul):
@@ -150,5 +243,5 @@ class ShapeTracker:
     strides = [z*m for z,m in zip(self.strides, mul)]
     new_shape = [(s+(abs(m)-1))//abs(m) for s,m in zip(self.shape, mul)]
     offset = sum([(s-1)*z for s,z,m in zip(self.shape, self.strides, mul) if m < 0])
-    self.views[-1] = View(new_shape, strides, self.offset + offset)
+    self.views = self.views[:-1] + (View(new_shape, strides, self.offset + offset),)
 
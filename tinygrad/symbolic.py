@@ -0,0 +1,122 @@
+# a tiny symbolic integer IR for the index expressions. every node knows its range, and the ops simplify using it
+from __future__ import annotations
+import functools, operator
+from typing import List, Dict, Union, Any
+
+class Node:
+  min : int
+  max : int
+  def render(self) -> str: raise NotImplementedError
+  # NOTE: this works on ints and numpy arrays
+  def eval(self, env:Dict[str, Any]) -> Any: raise NotImplementedError
+  def __repr__(self): return f"<{self.render()} [{self.min}, {self.max}]>"
+
+  def __add__(self, b:Union[Node, int]) -> Node: return Variable.sum([self, b if isinstance(b, Node) else NumNode(b)])
+
+  def __mul__(self, b:int) -> Node:
+    if b == 0: return NumNode(0)
+    if b == 1: return self
+    if isinstance(self, NumNode): return NumNode(self.b*b)
+    if isinstance(self, MulNode): return self.a*(self.b*b)
+    if isinstance(self, SumNode): return Variable.sum([x*b for x in self.nodes])
+    return MulNode(self, b)
+
+  def __floordiv__(self, b:int) -> Node:
+    assert b > 0
+    if b == 1: return self
+    if isinstance(self, NumNode): return NumNode(self.b//b)
+    if self.min >= 0 and self.max < b: return NumNode(0)
+    if isinstance(self, DivNode) and self.min >= 0: return self.a//(self.b*b)
+    if isinstance(self, MulNode) and self.b % b == 0: return self.a*(self.b//b)
+    if isinstance(self, SumNode) and self.min >= 0:
+      # (x*b + r)//b is x + r//b if r isn't negative
+      whole, rest = [x for x in self.nodes if x.coeff % b == 0], [x for x in self.nodes if x.coeff % b != 0]
+      if len(whole) and Variable.sum(rest).min >= 0: return Variable.sum([x//b for x in whole]) + Variable.sum(rest)//b
+    return DivNode(self, b)
+
+  def __mod__(self, b:int) -> Node:
+    assert b > 0
+    if b == 1: return NumNode(0)
+    if isinstance(self, NumNode): return NumNode(self.b%b)
+    if self.min >= 0 and self.max < b: return self
+    if isinstance(self, MulNode) and self.b % b == 0: return NumNode(0)
+    if isinstance(self, ModNode) and self.min >= 0 and self.b % b == 0: return self.a%b
+    if isinstance(self, SumNode) and self.min >= 0:
+      rest = [x for x in self.nodes if x.coeff % b != 0]
+      if len(rest) != len(self.nodes) and Variable.sum(rest).min >= 0: return Variable.sum(rest)%b
+    return ModNode(self, b)
+
+  def __ge__(self, b:int) -> Node: return NumNode(1) if self.min >= b else (NumNode(0) if self.max < b else GeNode(self, b))
+  def __lt__(self, b:int) -> Node: return NumNode(1) if self.max < b else (NumNode(0) if self.min >= b else LtNode(self, b))
+
+  # the constant factor, what divides and mods can cancel against
+  @property
+  def coeff(self) -> int: return 1
+
+class Variable(Node):
+  def __init__(self, expr:str, nmin:int, nmax:int): self.expr, self.min, self.max = expr, nmin, nmax
+  def render(self): return self.expr
+  def eval(self, env): return env[self.expr]
+
+  @staticmethod
+  def sum(nodes:List[Node]) -> Node:
+    flat : List[Node] = []
+    for x in nodes: flat += x.nodes if isinstance(x, SumNode) else [x]
+    num = sum(x.b for x in flat if isinstance(x, NumNode))
+    flat = [x for x in flat if not isinstance(x, NumNode)] + ([NumNode(num)] if num != 0 else [])
+    if len(flat) == 0: return NumNode(0)
+    return flat[0] if len(flat) == 1 else SumNode(flat)
+
+  @staticmethod
+  def ands(nodes:List[Node]) -> Node:
+    if any(isinstance(x, NumNode) and x.b == 0 for x in nodes): return NumNode(0)
+    nodes = [x for x in nodes if not isinstance(x, NumNode)]
+    if len(nodes) == 0: return NumNode(1)
+    return nodes[0] if len(nodes) == 1 else AndNode(nodes)
+
+class NumNode(Node):
+  def __init__(self, num:int): self.b, self.min, self.max = num, num, num
+  def render(self): return str(self.b)
+  def eval(self, env): return self.b
+  @property
+  def coeff(self): return self.b
+
+class MulNode(Node):
+  def __init__(self, a:Node, b:int):
+    self.a, self.b = a, b
+    self.min, self.max = (a.min*b, a.max*b) if b >= 0 else (a.max*b, a.min*b)
+  def render(self): return f"({self.a.render()}*{self.b})"
+  def eval(self, env): return self.a.eval(env)*self.b
+  @property
+  def coeff(self): return self.b
+
+class DivNode(Node):
+  def __init__(self, a:Node, b:int): self.a, self.b, self.min, self.max = a, b, a.min//b, a.max//b
+  def render(self): return f"({self.a.render()}//{self.b})"
+  def eval(self, env): return self.a.eval(env)//self.b
+
+class ModNode(Node):
+  # NOTE: C's % can be negative, python's can't. only the invalid indexes are negative
+  def __init__(self, a:Node, b:int): self.a, self.b, self.min, self.max = a, b, (0 if a.min >= 0 else 1-b), b-1
+  def render(self): return f"({self.a.render()}%{self.b})"
+  def eval(self, env): return self.a.eval(env)%self.b
+
+class SumNode(Node):
+  def __init__(self, nodes:List[Node]): self.nodes, self.min, self.max = nodes, sum(x.min for x in nodes), sum(x.max for x in nodes)
+  def render(self): return '('+'+'.join(x.render() for x in self.nodes)+')'
+  def eval(self, env): return sum(x.eval(env) for x in self.nodes)
+
+class GeNode(Node):
+  def __init__(self, a:Node, b:int): self.a, self.b, self.min, self.max = a, b, 0, 1
+  def render(self): return f"({self.a.render()}>={self.b})"
+  def eval(self, env): return self.a.eval(env) >= self.b
+
+class LtNode(Node):
+  def __init__(self, a:Node, b:int): self.a, self.b, self.min, self.max = a, b, 0, 1
+  def render(self): return f"({self.a.render()}<{self.b})"
+  def eval(self, env): return self.a.eval(env) < self.b
+
+class AndNode(Node):
+  def __init__(self, nodes:List[Node]): self.nodes, self.min, self.max = nodes, 0, 1
+  def render(self): return ' && '.join(x.render() for x in self.nodes)
+  def eval(self, env): return functools.reduce(operator.mul, [x.eval(env) for x in self.nodes])
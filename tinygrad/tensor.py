@@ -162,20 +162,14 @@ class Tensor:
     return ret
 
   def matmul(x:Tensor, w:Tensor):
-    # NOTE: we use a 1x1 conv2d to do the matmul. mxk @ kxn = (1,k,m,1).conv2d(n,k,1,1)
+    # NOTE: this is a batched GEMM, (bs, m, k) @ (bs, k, n). the batch dims of w are the last batch dims of x
     bs, groups = prod(x.shape[0:-2]), prod(w.shape[0:-2])
-    cin, cout = w.shape[-2], w.shape[-1]
-    out_shape_t = tuple(list(x.shape[0:-2])+[cout,-1])
-    if len(x.shape) > 1: order = tuple(list(range(len(x.shape)-2))+[len(x.shape)-1, len(x.shape)-2])
-    else: order, out_shape_t = (0,), (cout, )
-    worder = tuple(list(range(len(w.shape)-2))+[len(w.shape)-1, len(w.shape)-2])
-
-    # NOTE: with NHWC we can remove the transposes
-    # bs x groups*cin x H x W
-    cx = x.transpose(order=order).reshape(shape=(bs//groups, groups*cin, -1, 1))
-    # groups*cout x cin x H, W
-    cw = w.transpose(order=worder).reshape(shape=(groups*cout, cin, 1, 1))
-    return cx.conv2d(cw, groups=groups).reshape(shape=out_shape_t).transpose(order=order)
+    m, k, n = x.shape[-2] if len(x.shape) > 1 else 1, w.shape[-2], w.shape[-1]
+    out_shape = tuple(list(x.shape[0:-2])+[m, n]) if len(x.shape) > 1 else (n,)
+    # when w isn't batched, the batch of x is just more rows
+    if groups == 1: return x.reshape(shape=(1, bs*m, k))._matmul(w.reshape(shape=(1, k, n))).reshape(shape=out_shape)
+    cw = w.reshape(shape=(1, groups, k, n)).expand(shape=(bs//groups, groups, k, n)).reshape(shape=(bs, k, n))
+    return x.reshape(shape=(bs, m, k))._matmul(cw).reshape(shape=out_shape)
 
   # TODO: what's the difference between dot and matmul?
   dot = matmul
@@ -195,6 +189,7 @@ class Tensor:
 
   def sum(self, axis=None, keepdim=False): return self._reduce(self._sum, axis, keepdim)
   def max(self, axis=None, keepdim=False): return self._reduce(self._max, axis, keepdim)
+  def var(self, axis=None, keepdim=False): return self._reduce(self._var, axis, keepdim)
 
   def mean(self, axis=None, keepdim=False):
     out = self.sum(axis=axis, keepdim=keepdim)